@@ -1,18 +1,29 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Query, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import List, Optional
+import asyncio
+import functools
 import json
 import os
+import time
 import base64
+import numpy as np
 from datetime import datetime
 
 # from src.database.models import ProcesamientoImagen, create_database, get_database_url  # Deshabilitado - usando solo Google Sheets
 # from src.database.database import get_db  # Deshabilitado - usando solo Google Sheets
-from src.services.procesamiento_service_v2 import ProcesamientoServiceV2
+from src.services.procesamiento_service_v2 import completar_lote, union_colores
+from src.services import ejecutor_inferencia as tareas
+from src.services.ejecutor_inferencia import EjecutorInferencia, ColaLlenaError
 from src.google_sheets.sheets_client import GoogleSheetsClient
+from src.google_sheets.cola_escritura import ColaEscrituraSheets
+from src.google_sheets.espejo_registros import EspejoRegistros, obtener_espejo
+from src.google_sheets.indice_jerarquia import obtener_indice
+from src.analisis.estadisticas_registros import MotorEstadisticas
+from src.metadata.parcelas import obtener_indice_parcelas, completar_ubicacion
 
 
 # Función para cargar configuración desde variables de entorno o archivo
@@ -77,62 +88,132 @@ app.add_middleware(
 # Inicializar base de datos
 # create_database()  # Deshabilitado - usando solo Google Sheets
 
-# Inicializar servicio de procesamiento con modelo optimizado
-procesamiento_service = ProcesamientoServiceV2()
+# Ejecutor para sacar el trabajo de CPU y E/S bloqueante del event loop
+ejecutor = EjecutorInferencia()
 
 # Inicializar cliente de Google Sheets
 sheets_client = GoogleSheetsClient()
 
-async def get_next_sequential_id() -> str:
+
+@app.on_event("shutdown")
+def cerrar_ejecutor():
+    ejecutor.cerrar()
+
+
+async def ejecutar_inferencia(funcion, *args, **kwargs):
     """
-    Obtiene el siguiente ID secuencial basado en los registros existentes en Google Sheets
+    Ejecuta una tarea de CPU en el pool de inferencia; si la cola está llena responde 503
     """
     try:
-        # Cargar configuración
-        config = load_google_sheets_config()
-        spreadsheet_id = config.get('spreadsheet_id')
-        sheet_name = config.get('sheet_name', 'Data-app')
-        
-        if not spreadsheet_id:
-            return "1"  # Si no hay configuración, empezar con 1
-        
-        # Autenticar con Google Sheets
-        if not sheets_client.authenticate():
-            return "1"  # Si no se puede autenticar, empezar con 1
-        
-        # Obtener registros existentes
-        records = sheets_client.get_processing_records(spreadsheet_id, limit=1000, sheet_name=sheet_name)
-        
-        if not records:
-            return "1"  # Si no hay registros, empezar con 1
-        
-        # Encontrar el ID más alto
-        max_id = 0
-        for record in records:
-            try:
-                # Extraer número del ID (formato: "IMG_1234567890_123" o solo "123")
-                record_id = record.get('id', '')
-                if record_id.startswith('IMG_'):
-                    # Extraer número del timestamp
-                    parts = record_id.split('_')
-                    if len(parts) >= 2:
-                        timestamp = int(parts[1])
-                        max_id = max(max_id, timestamp)
-                else:
-                    # Si es un número simple
-                    numeric_id = int(record_id)
-                    max_id = max(max_id, numeric_id)
-            except (ValueError, IndexError):
-                continue
-        
-        # Retornar el siguiente ID secuencial
-        next_id = str(max_id + 1)
-        print(f"🆔 ID secuencial generado: {next_id}")
-        return next_id
-        
+        return await ejecutor.ejecutar_cpu(funcion, *args, **kwargs)
+    except ColaLlenaError as e:
+        print(f"⏳ {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Servidor ocupado procesando otras imágenes, reintente en unos segundos",
+            headers={"Retry-After": "5"}
+        )
+
+
+async def procesar_lote_repartido(imagenes_bytes: List[bytes]) -> List[dict]:
+    """
+    Procesa un lote repartido en unas INFERENCIA_WORKERS tareas del pool de CPU: cada
+    parte calcula los histogramas de colores de sus imágenes, la unión de colores se
+    clasifica en partes también en paralelo y los conteos por imagen se combinan aquí
+    (sin cargar el modelo en este proceso). Cada color distinto se clasifica una sola vez.
+    """
+    max_partes = max(1, min(ejecutor.workers_cpu, ejecutor.max_pendientes))
+    partes = max(1, min(max_partes, len(imagenes_bytes)))
+    tamano = -(-len(imagenes_bytes) // partes)
+    histogramados = await asyncio.gather(*[
+        ejecutar_inferencia(tareas.histogramar_lote, imagenes_bytes[inicio:inicio + tamano])
+        for inicio in range(0, len(imagenes_bytes), tamano)
+    ])
+    
+    resultados, histogramas, claves = [], [], []
+    clases = None
+    for parte_resultados, parte_histogramas, parte_claves, clases in histogramados:
+        for resultado in parte_resultados:
+            resultado["indice"] += len(resultados)
+        resultados.extend(parte_resultados)
+        histogramas.extend(parte_histogramas)
+        claves.extend(parte_claves)
+    
+    colores = union_colores(histogramas)
+    if len(colores) == 0:
+        return resultados
+    
+    partes_colores = [parte for parte in np.array_split(colores, max_partes) if len(parte)]
+    ids_colores = np.concatenate(await asyncio.gather(*[
+        ejecutar_inferencia(tareas.clasificar_colores, parte) for parte in partes_colores
+    ]))
+    print(f"📦 Lote: {len(resultados)} imágenes, {len(colores)} colores distintos en {len(partes_colores)} partes")
+    return await ejecutor.ejecutar_io(completar_lote, resultados, histogramas, claves, colores, ids_colores, clases)
+
+
+async def get_next_sequential_id(cantidad: int = 1) -> str:
+    """
+    Obtiene el siguiente ID secuencial sin bloquear el event loop
+    """
+    try:
+        return await ejecutor.ejecutar_io(siguiente_id_secuencial, cantidad)
     except Exception as e:
+        # Sin contador no hay forma segura de numerar: un ID inventado podría estar en uso
         print(f"❌ Error generando ID secuencial: {e}")
-        return "1"  # Fallback a 1
+        raise HTTPException(status_code=503, detail=f"No se pudo reservar un ID secuencial: {str(e)}")
+
+
+def siguiente_id_secuencial(cantidad: int = 1) -> str:
+    """
+    Reserva `cantidad` IDs secuenciales con el contador local (sembrado una vez desde Google Sheets)
+    y retorna el primero
+    
+    Raises:
+        Exception: Si no se puede reservar (el ID no se adivina para no repetir uno existente)
+    """
+    # Cargar configuración
+    config = load_google_sheets_config()
+    spreadsheet_id = config.get('spreadsheet_id')
+    sheet_name = config.get('sheet_name', 'Data-app')
+    
+    if not spreadsheet_id:
+        return "1"  # Si no hay configuración, empezar con 1
+    
+    # Solo se accede a Google Sheets la primera vez, para sembrar el contador
+    next_id = str(sheets_client.reservar_ids(spreadsheet_id, sheet_name, cantidad))
+    print(f"🆔 ID secuencial generado: {next_id}")
+    return next_id
+
+
+def obtener_espejo_registros() -> Optional[EspejoRegistros]:
+    """
+    Espejo local de la hoja de registros configurada (None si no hay Spreadsheet ID)
+    """
+    config = load_google_sheets_config()
+    spreadsheet_id = config.get('spreadsheet_id')
+    sheet_name = config.get('sheet_name', 'Data-app')
+    
+    if not spreadsheet_id:
+        return None
+    
+    return obtener_espejo(
+        spreadsheet_id, sheet_name,
+        functools.partial(sheets_client.leer_filas, spreadsheet_id, sheet_name)
+    )
+
+
+async def leer_registros_espejo(limit: int = None) -> list:
+    """
+    Lee los registros desde el espejo local sin bloquear el event loop
+    """
+    espejo = obtener_espejo_registros()
+    if espejo is None:
+        raise HTTPException(status_code=500, detail="No se encontró Spreadsheet ID")
+    return await ejecutor.ejecutar_io(espejo.obtener_registros, limit)
+
+
+# Estadísticas columnares en caché hasta que el espejo reciba filas nuevas
+motor_estadisticas = MotorEstadisticas()
 
 
 # Montar archivos estáticos
@@ -178,6 +259,54 @@ def guardar_en_google_sheets_directo(record_data):
         print(f"❌ Error en Google Sheets: {e}")
         return False
 
+def guardar_lote_en_google_sheets_directo(records):
+    """
+    Guarda varios registros en Google Sheets con una sola llamada `append`
+    
+    Args:
+        records: Lista de diccionarios con los datos de cada procesamiento
+        
+    Returns:
+        bool: True si se guardaron correctamente
+    """
+    try:
+        config = load_google_sheets_config()
+        spreadsheet_id = config.get('spreadsheet_id')
+        
+        if not spreadsheet_id:
+            print("⚠️  No se encontró Spreadsheet ID en la configuración")
+            return False
+        
+        if not sheets_client.authenticate():
+            print("❌ Error autenticando con Google Sheets")
+            return False
+        
+        sheet_name = config.get('sheet_name', 'Procesamientos')
+        
+        if sheets_client.add_processing_records(spreadsheet_id, records, sheet_name):
+            print(f"✅ {len(records)} registros guardados en Google Sheets")
+            # Traer al espejo local las filas recién agregadas
+            espejo = obtener_espejo_registros()
+            if espejo is not None:
+                espejo.avisar()
+            return True
+        else:
+            print(f"❌ Error guardando {len(records)} registros en Google Sheets")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error en Google Sheets: {e}")
+        return False
+
+# Cola de escritura diferida: los endpoints encolan y un hilo envía los lotes a Google Sheets
+cola_sheets = ColaEscrituraSheets(guardar_lote_en_google_sheets_directo)
+
+
+@app.on_event("shutdown")
+def cerrar_cola_sheets():
+    cola_sheets.cerrar()
+
+
 def guardar_en_google_sheets(registro_db, metadata=None):
     """
     Guarda un registro de procesamiento en Google Sheets
@@ -235,6 +364,76 @@ def guardar_en_google_sheets(registro_db, metadata=None):
         return False
 
 
+def extraer_metadatos_imagen(imagen_bytes, filename):
+    """
+    Extrae metadatos EXIF (fecha y coordenadas GPS) de una imagen
+    
+    Returns:
+        tuple: (metadata, fecha_tomada, latitud, longitud); la fecha usa la actual si no hay EXIF
+    """
+    metadata = None
+    fecha_tomada = None
+    exif_latitud = None
+    exif_longitud = None
+    
+    try:
+        from src.metadata.gps_extractor import GPSMetadataExtractor
+        
+        extractor = GPSMetadataExtractor()
+        metadata = extractor.extract_metadata(imagen_bytes, filename)
+        
+        # Limpiar metadatos de caracteres nulos
+        if metadata:
+            for key, value in metadata.items():
+                if isinstance(value, str):
+                    metadata[key] = value.replace('\x00', '').strip()
+                elif isinstance(value, dict):
+                    for sub_key, sub_value in value.items():
+                        if isinstance(sub_value, str):
+                            metadata[key][sub_key] = sub_value.replace('\x00', '').strip()
+        
+        # Extraer fecha
+        fecha_tomada = metadata['fecha_tomada']
+        if not fecha_tomada:
+            fecha_tomada = datetime.now()
+            print(f"📅 Usando fecha actual: {fecha_tomada}")
+        else:
+            print(f"✅ Fecha EXIF extraída: {fecha_tomada}")
+        
+        # Extraer coordenadas GPS
+        exif_latitud = metadata['gps_latitud']
+        exif_longitud = metadata['gps_longitud']
+        
+        if exif_latitud and exif_longitud:
+            print(f"✅ Coordenadas GPS extraídas: {exif_latitud}, {exif_longitud}")
+        else:
+            print("📍 No se pudieron extraer coordenadas GPS del EXIF")
+        
+    except Exception as e:
+        print(f"Error extrayendo metadatos: {e}")
+        fecha_tomada = datetime.now()
+        exif_latitud = None
+        exif_longitud = None
+    
+    return metadata, fecha_tomada, exif_latitud, exif_longitud
+
+
+def asignar_parcelas(latitudes, longitudes):
+    """
+    Parcela (lote/hilera) de cada coordenada según el GeoJSON de parcelas, en una sola pasada
+    
+    Returns:
+        list: Propiedades de la parcela o None por coordenada (todo None si no hay archivo de parcelas)
+    """
+    indice = obtener_indice_parcelas()
+    if indice is None:
+        return [None] * len(latitudes)
+    return indice.asignar(
+        [lat if lat is not None else float('nan') for lat in latitudes],
+        [lon if lon is not None else float('nan') for lon in longitudes]
+    )
+
+
 @app.get("/health")
 async def health_check():
     """
@@ -243,37 +442,56 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.now()}
 
 @app.get("/historial")
-async def obtener_historial():
+async def obtener_historial(
+    limit: int = Query(100, ge=1, le=1000, description="Registros por página"),
+    cursor: Optional[int] = Query(None, description="Cursor devuelto por la página anterior (siguiente_cursor)"),
+    orden: str = Query("asc", description="asc: más antiguos primero, desc: más recientes primero"),
+    empresa: Optional[str] = None,
+    fundo: Optional[str] = None,
+    sector: Optional[str] = None,
+    lote: Optional[str] = None,
+    fecha_desde: Optional[str] = Query(None, description="Fecha mínima (YYYY-MM-DD)"),
+    fecha_hasta: Optional[str] = Query(None, description="Fecha máxima (YYYY-MM-DD)"),
+    luz_min: Optional[float] = None,
+    luz_max: Optional[float] = None,
+    sombra_min: Optional[float] = None,
+    sombra_max: Optional[float] = None
+):
     """
-    Obtiene el historial de procesamientos guardados en Google Sheets
+    Obtiene el historial de procesamientos guardados en Google Sheets, paginado y filtrado
+    sobre el espejo local
+    
+    - **limit** / **cursor**: Paginación; pasar `siguiente_cursor` para obtener la página siguiente
+    - **empresa**, **fundo**, **sector**, **lote**: Filtros exactos (opcionales)
+    - **fecha_desde**, **fecha_hasta**: Rango de fechas de la foto (opcional)
+    - **luz_min**, **luz_max**, **sombra_min**, **sombra_max**: Rangos de porcentaje (opcionales)
     """
     try:
-        # Cargar configuración de Google Sheets
-        config = load_google_sheets_config()
-        spreadsheet_id = config.get('spreadsheet_id')
+        if orden not in ("asc", "desc"):
+            raise HTTPException(status_code=400, detail="orden debe ser 'asc' o 'desc'")
         
-        if not spreadsheet_id:
+        espejo = obtener_espejo_registros()
+        if espejo is None:
             raise HTTPException(status_code=500, detail="No se encontró Spreadsheet ID")
         
-        # Autenticar con Google Sheets
-        if not sheets_client.authenticate():
-            raise HTTPException(status_code=500, detail="Error autenticando con Google Sheets")
-        
-        # Obtener nombre de la hoja desde la configuración
-        sheet_name = config.get('sheet_name', 'Procesamientos')
-        
-        # Obtener registros de Google Sheets
-        records = sheets_client.get_processing_records(spreadsheet_id, limit=100, sheet_name=sheet_name)
+        # Consulta indexada sobre el espejo local de Google Sheets
+        pagina, siguiente_cursor = await ejecutor.ejecutar_io(
+            espejo.consultar_registros,
+            limit=limit, cursor=cursor, descendente=(orden == "desc"),
+            empresa=empresa, fundo=fundo, sector=sector, lote=lote,
+            fecha_desde=fecha_desde, fecha_hasta=fecha_hasta,
+            luz_min=luz_min, luz_max=luz_max, sombra_min=sombra_min, sombra_max=sombra_max
+        )
         
         historial = []
-        for index, record in enumerate(records):
+        for fila, record in pagina:
             # Convertir los datos de Google Sheets al formato esperado por el frontend
             try:
                 # Manejar IDs que no son números
                 record_id = record.get('id', '')
                 if not record_id or not str(record_id).replace('_', '').replace('-', '').isdigit():
-                    # Si no es un ID válido, usar el índice + 1
-                    record_id = index + 1
+                    # Si no es un ID válido, usar la posición del registro en la hoja
+                    record_id = fila - 1
                 else:
                     # Mantener el ID original como string para evitar duplicados
                     record_id = str(record_id)
@@ -303,35 +521,42 @@ async def obtener_historial():
         return {
             "success": True,
             "total_procesamientos": len(historial),
-            "procesamientos": historial
+            "procesamientos": historial,
+            "siguiente_cursor": siguiente_cursor,
+            "hay_mas": siguiente_cursor is not None
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error obteniendo historial: {str(e)}")
 
 @app.get("/estadisticas")
-async def obtener_estadisticas():
+async def obtener_estadisticas(agrupar_por: Optional[str] = None, por_fecha: bool = False):
     """
-    Obtiene estadísticas generales de los procesamientos desde Google Sheets
+    Obtiene estadísticas de los procesamientos desde Google Sheets
+    
+    - **agrupar_por**: Niveles separados por coma (empresa, fundo, sector, lote, hilera) (opcional)
+    - **por_fecha**: Agrupar además por fecha de la foto (opcional)
     """
     try:
-        # Cargar configuración de Google Sheets
-        config = load_google_sheets_config()
-        spreadsheet_id = config.get('spreadsheet_id')
-        
-        if not spreadsheet_id:
+        espejo = obtener_espejo_registros()
+        if espejo is None:
             raise HTTPException(status_code=500, detail="No se encontró Spreadsheet ID")
         
-        # Autenticar con Google Sheets
-        if not sheets_client.authenticate():
-            raise HTTPException(status_code=500, detail="Error autenticando con Google Sheets")
+        niveles = [nivel.strip() for nivel in agrupar_por.split(',') if nivel.strip()] if agrupar_por else []
         
-        # Obtener nombre de la hoja desde la configuración
-        sheet_name = config.get('sheet_name', 'Procesamientos')
+        def calcular():
+            if espejo.version() is None:
+                espejo.sincronizar(completa=True)
+            return motor_estadisticas.calcular(espejo.version(), espejo.obtener_registros, niveles, por_fecha)
         
-        # Obtener registros de Google Sheets
-        records = sheets_client.get_processing_records(spreadsheet_id, limit=1000, sheet_name=sheet_name)
+        try:
+            estadisticas = await ejecutor.ejecutar_io(calcular)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        if not records:
+        resumen = estadisticas["global"]
+        if not resumen["total"]:
             return {
                 "success": True,
                 "total_procesamientos": 0,
@@ -340,30 +565,18 @@ async def obtener_estadisticas():
                 "mensaje": "No hay procesamientos registrados"
             }
         
-        # Calcular estadísticas
-        total_procesamientos = len(records)
-        porcentajes_luz = []
-        porcentajes_sombra = []
-        
-        for record in records:
-            try:
-                luz = float(record.get('porcentaje_luz', 0)) if record.get('porcentaje_luz') else 0
-                sombra = float(record.get('porcentaje_sombra', 0)) if record.get('porcentaje_sombra') else 0
-                porcentajes_luz.append(luz)
-                porcentajes_sombra.append(sombra)
-            except (ValueError, TypeError):
-                continue
-        
-        promedio_luz = sum(porcentajes_luz) / len(porcentajes_luz) if porcentajes_luz else 0
-        promedio_sombra = sum(porcentajes_sombra) / len(porcentajes_sombra) if porcentajes_sombra else 0
-        
         return {
             "success": True,
-            "total_procesamientos": total_procesamientos,
-            "promedio_luz": round(promedio_luz, 2),
-            "promedio_sombra": round(promedio_sombra, 2),
-            "ultimo_procesamiento": records[-1].get('timestamp', '') if records else None
+            "total_procesamientos": resumen["total"],
+            "promedio_luz": resumen["luz"]["promedio"] if resumen["luz"] else 0,
+            "promedio_sombra": resumen["sombra"]["promedio"] if resumen["sombra"] else 0,
+            "ultimo_procesamiento": estadisticas["ultimo_procesamiento"],
+            "luz": resumen["luz"],
+            "sombra": resumen["sombra"],
+            "grupos": estadisticas["grupos"]
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error obteniendo estadísticas: {str(e)}")
 
@@ -377,7 +590,8 @@ async def procesar_imagen_simple(
     hilera: Optional[str] = Form(None, description="Hilera del fundo"),
     numero_planta: Optional[str] = Form(None, description="Número de planta"),
     latitud: Optional[float] = Form(None, description="Latitud de la ubicación"),
-    longitud: Optional[float] = Form(None, description="Longitud de la ubicación")
+    longitud: Optional[float] = Form(None, description="Longitud de la ubicación"),
+    metodo: str = Form("luminancia", description="luminancia (umbral simple) o muestreo (modelo sobre una muestra de píxeles, con margen de error)")
 ):
     """
     Procesa una imagen de forma simplificada - Solo análisis y guardado en Google Sheets
@@ -390,91 +604,44 @@ async def procesar_imagen_simple(
         # Validar archivo
         if not imagen.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
             raise HTTPException(status_code=400, detail="La imagen debe ser JPG o PNG")
+        analizadores = {
+            "luminancia": tareas.analizar_luminancia,
+            "muestreo": tareas.estimar_porcentajes_muestreo
+        }
+        if metodo not in analizadores:
+            raise HTTPException(status_code=400, detail=f"Método inválido: {metodo} (luminancia o muestreo)")
         
         # Leer imagen
         imagen_bytes = await imagen.read()
         
-        # Análisis simple de la imagen
-        import cv2
-        import numpy as np
-        
-        # Decodificar imagen
-        nparr = np.frombuffer(imagen_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Análisis rápido (pool de CPU) y extracción de metadatos (pool de E/S) en
+        # paralelo, sin bloquear el event loop
+        analisis, (metadata, fecha_tomada, exif_latitud, exif_longitud) = await asyncio.gather(
+            ejecutar_inferencia(analizadores[metodo], imagen_bytes),
+            ejecutor.ejecutar_io(extraer_metadatos_imagen, imagen_bytes, imagen.filename)
+        )
         
-        if img is None:
+        if analisis is None:
             raise HTTPException(status_code=400, detail="No se pudo leer la imagen")
         
-        print(f"📏 Dimensiones de la imagen: {img.shape}")
-        
-        # Análisis simple basado en luminancia
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Crear máscara de luz/sombra basada en luminancia
-        light_mask = gray > 128  # Píxeles claros
-        shadow_mask = gray <= 128  # Píxeles oscuros
-        
-        # Calcular porcentajes
-        total_pixels = img.shape[0] * img.shape[1]
-        light_pixels = np.sum(light_mask)
-        shadow_pixels = np.sum(shadow_mask)
+        print(f"📏 Dimensiones de la imagen: {analisis['dimensiones']}")
         
-        light_percentage = (light_pixels / total_pixels) * 100
-        shadow_percentage = (shadow_pixels / total_pixels) * 100
+        light_percentage = analisis["porcentaje_luz"]
+        shadow_percentage = analisis["porcentaje_sombra"]
         
         print(f"✅ Análisis completado - Luz: {light_percentage:.1f}%, Sombra: {shadow_percentage:.1f}%")
         
-        # Extraer metadatos
-        metadata = None
-        fecha_tomada = None
-        exif_latitud = None
-        exif_longitud = None
-        
-        try:
-            from src.metadata.gps_extractor import GPSMetadataExtractor
-            
-            extractor = GPSMetadataExtractor()
-            metadata = extractor.extract_metadata(imagen_bytes, imagen.filename)
-            
-            # Limpiar metadatos de caracteres nulos
-            if metadata:
-                for key, value in metadata.items():
-                    if isinstance(value, str):
-                        metadata[key] = value.replace('\x00', '').strip()
-                    elif isinstance(value, dict):
-                        for sub_key, sub_value in value.items():
-                            if isinstance(sub_value, str):
-                                metadata[key][sub_key] = sub_value.replace('\x00', '').strip()
-            
-            # Extraer fecha
-            fecha_tomada = metadata['fecha_tomada']
-            if not fecha_tomada:
-                fecha_tomada = datetime.now()
-                print(f"📅 Usando fecha actual: {fecha_tomada}")
-            else:
-                print(f"✅ Fecha EXIF extraída: {fecha_tomada}")
-            
-            # Extraer coordenadas GPS
-            exif_latitud = metadata['gps_latitud']
-            exif_longitud = metadata['gps_longitud']
-            
-            if exif_latitud and exif_longitud:
-                print(f"✅ Coordenadas GPS extraídas: {exif_latitud}, {exif_longitud}")
-            else:
-                print("📍 No se pudieron extraer coordenadas GPS del EXIF")
-            
-        except Exception as e:
-            print(f"Error extrayendo metadatos: {e}")
-            fecha_tomada = datetime.now()
-            exif_latitud = None
-            exif_longitud = None
-        
         # Usar coordenadas EXIF si están disponibles, sino usar las del formulario
         latitud_final = exif_latitud if exif_latitud is not None else latitud
         longitud_final = exif_longitud if exif_longitud is not None else longitud
         
         print(f"📍 Coordenadas finales - Latitud: {latitud_final}, Longitud: {longitud_final}")
         
+        # Lote/hilera por GPS para los campos que no vinieron en el formulario
+        parcela = asignar_parcelas([latitud_final], [longitud_final])[0]
+        if parcela:
+            print(f"🗺️ Parcela por GPS: Lote={parcela['lote']}, Hilera={parcela['hilera']}")
+        
         # Generar ID secuencial para el registro
         registro_id = await get_next_sequential_id()
         
@@ -502,14 +669,16 @@ async def procesar_imagen_simple(
                 'direccion': str(metadata.get('direccion', '')) if metadata else '',
                 'timestamp': datetime.now().isoformat()
             }
+            completar_ubicacion(record_data, parcela)
+            sector = record_data['sector']
+            lote = record_data['lote']
+            hilera = record_data['hilera']
             
             print(f"📊 Datos a guardar en Google Sheets: {record_data}")
             
-            # Guardar en Google Sheets
-            if guardar_en_google_sheets_directo(record_data):
-                print(f"✅ Registro {registro_id} guardado en Google Sheets")
-            else:
-                print(f"❌ Error guardando en Google Sheets")
+            # Encolar para Google Sheets (se escribe en segundo plano)
+            cola_sheets.encolar(record_data)
+            print(f"📥 Registro {registro_id} encolado para Google Sheets")
         except Exception as e:
             print(f"Error guardando en Google Sheets: {e}")
         
@@ -519,17 +688,129 @@ async def procesar_imagen_simple(
             "porcentaje_sombra": shadow_percentage,
             "fundo": fundo,
             "sector": sector or "",
+            "lote": lote or "",
             "hilera": hilera or "",
             "latitud": latitud_final,
             "longitud": longitud_final,
             "fecha_tomada": fecha_tomada.isoformat() if fecha_tomada else None,
+            "estimacion": analisis.get("estimacion"),
             "mensaje": "Imagen procesada exitosamente"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error general: {e}")
         raise HTTPException(status_code=500, detail=f"Error procesando imagen: {str(e)}")
 
+@app.post("/procesar-lote")
+async def procesar_lote(
+    imagenes: List[UploadFile] = File(..., description="Imágenes agrícolas (JPG, PNG)"),
+    empresa: str = Form(..., description="Empresa"),
+    fundo: str = Form(..., description="Fundo al que pertenecen las imágenes"),
+    sector: Optional[str] = Form(None, description="Sector del fundo"),
+    lote: Optional[str] = Form(None, description="Lote del fundo"),
+    hilera: Optional[str] = Form(None, description="Hilera del fundo")
+):
+    """
+    Procesa un lote de imágenes con el modelo en el mínimo de llamadas y guarda
+    todos los registros en Google Sheets con una sola escritura
+    """
+    try:
+        print(f"📦 Procesando lote de {len(imagenes)} imágenes")
+        print(f"📍 Ubicación: Empresa={empresa}, Fundo={fundo}, Sector={sector}, Lote={lote}, Hilera={hilera}")
+        
+        # Validar archivos
+        for imagen in imagenes:
+            if not imagen.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+                raise HTTPException(status_code=400, detail=f"La imagen {imagen.filename} debe ser JPG o PNG")
+        
+        imagenes_bytes = [await imagen.read() for imagen in imagenes]
+        
+        # Clasificación conjunta del lote, repartida entre los procesos del pool de CPU
+        resultados = await procesar_lote_repartido(imagenes_bytes)
+        
+        # Metadatos de todas las imágenes en paralelo (pool de E/S)
+        metadatos = await asyncio.gather(*[
+            ejecutor.ejecutar_io(extraer_metadatos_imagen, imagen_bytes, imagen.filename)
+            for imagen, imagen_bytes, resultado in zip(imagenes, imagenes_bytes, resultados)
+            if "error" not in resultado
+        ])
+        
+        # Lote/hilera de cada foto por su GPS, todas en una sola consulta al índice de parcelas
+        parcelas = iter(asignar_parcelas(
+            [latitud for _, _, latitud, _ in metadatos],
+            [longitud for _, _, _, longitud in metadatos]
+        ))
+        metadatos = iter(metadatos)
+        
+        # Un solo rango de IDs reservado para todo el lote
+        total_validas = sum(1 for resultado in resultados if "error" not in resultado)
+        siguiente_id = int(await get_next_sequential_id(max(total_validas, 1)))
+        
+        records = []
+        procesadas = []
+        for imagen, imagen_bytes, resultado in zip(imagenes, imagenes_bytes, resultados):
+            if "error" in resultado:
+                procesadas.append({"imagen": imagen.filename, "success": False, "mensaje": resultado["error"]})
+                continue
+            
+            metadata, fecha_tomada, latitud, longitud = next(metadatos)
+            
+            record = completar_ubicacion({
+                'id': str(siguiente_id),
+                'fecha': fecha_tomada.strftime("%Y-%m-%d"),
+                'hora': fecha_tomada.strftime("%H:%M:%S"),
+                'imagen': imagen.filename or '',
+                'nombre_archivo': imagen.filename or '',
+                'empresa': empresa or '',
+                'fundo': fundo or '',
+                'sector': sector or '',
+                'lote': lote or '',
+                'hilera': hilera if hilera is not None else '',
+                'numero_planta': '',
+                'latitud': str(latitud) if latitud else '',
+                'longitud': str(longitud) if longitud else '',
+                'porcentaje_luz': str(round(resultado["porcentaje_luz"], 2)),
+                'porcentaje_sombra': str(round(resultado["porcentaje_sombra"], 2)),
+                'dispositivo': str(metadata.get('dispositivo', '')) if metadata else '',
+                'software': str(metadata.get('software', '')) if metadata else '',
+                'direccion': str(metadata.get('direccion', '')) if metadata else '',
+                'timestamp': datetime.now().isoformat()
+            }, next(parcelas))
+            records.append(record)
+            siguiente_id += 1
+            
+            procesadas.append({
+                "imagen": imagen.filename,
+                "success": True,
+                "porcentaje_luz": resultado["porcentaje_luz"],
+                "porcentaje_sombra": resultado["porcentaje_sombra"],
+                "lote": record['lote'],
+                "hilera": record['hilera'],
+                "latitud": latitud,
+                "longitud": longitud,
+                "fecha_tomada": fecha_tomada.isoformat() if fecha_tomada else None
+            })
+        
+        # Encolar para Google Sheets (se escribe en segundo plano)
+        cola_sheets.encolar_varios(records)
+        
+        return {
+            "success": True,
+            "total_imagenes": len(imagenes),
+            "total_procesadas": len(records),
+            "guardado_google_sheets": bool(records),  # Encolados; se escriben en segundo plano
+            "resultados": procesadas,
+            "mensaje": "Lote procesado exitosamente"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error procesando lote: {e}")
+        raise HTTPException(status_code=500, detail=f"Error procesando lote: {str(e)}")
+
 @app.post("/procesar-imagen")
 async def procesar_imagen(
     imagen: UploadFile = File(..., description="Imagen agrícola (JPG, PNG)"),
@@ -566,8 +847,9 @@ async def procesar_imagen(
         except json.JSONDecodeError:
             raise HTTPException(status_code=400, detail="El archivo JSON de anotaciones no es válido")
         
-        # Procesar imagen
-        resultado = procesamiento_service.procesar_imagen_bytes(
+        # Procesar imagen (pool de CPU)
+        resultado = await ejecutar_inferencia(
+            tareas.procesar_imagen_bytes,
             imagen_bytes=imagen_bytes,
             anotaciones_json=anotaciones_json,
             lugar=fundo,  # Usar fundo en lugar de lugar
@@ -595,10 +877,8 @@ async def procesar_imagen(
                 'timestamp': resultado["timestamp"].isoformat()
             }
             
-            if guardar_en_google_sheets_directo(record_data):
-                print(f"✅ Registro guardado en Google Sheets")
-            else:
-                print(f"❌ Error guardando en Google Sheets")
+            cola_sheets.encolar(record_data)
+            print(f"📥 Registro encolado para Google Sheets")
         except Exception as e:
             print(f"Error guardando en Google Sheets: {e}")
         
@@ -617,6 +897,8 @@ async def procesar_imagen(
         
         return JSONResponse(content=respuesta, status_code=200)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error procesando imagen: {str(e)}")
 
@@ -644,12 +926,14 @@ async def google_sheets_status():
             return {
                 "success": True,
                 "status": "connected",
+                "registros_pendientes": cola_sheets.pendientes,
                 "message": "Google Sheets conectado correctamente"
             }
         else:
             return {
                 "success": False,
                 "status": "disconnected",
+                "registros_pendientes": cola_sheets.pendientes,
                 "message": "Error conectando con Google Sheets"
             }
     except Exception as e:
@@ -667,19 +951,8 @@ async def google_sheets_records(limit: int = 10):
     - **limit**: Número máximo de registros a obtener (default: 10)
     """
     try:
-        config = load_google_sheets_config()
-        spreadsheet_id = config.get('spreadsheet_id')
-        
-        if not spreadsheet_id:
-            raise HTTPException(status_code=400, detail="No se encontró Spreadsheet ID")
-        
-        if not sheets_client.authenticate():
-            raise HTTPException(status_code=500, detail="Error autenticando con Google Sheets")
-        
-        # Obtener nombre de la hoja desde la configuración
-        sheet_name = config.get('sheet_name', 'Procesamientos')
-        
-        records = sheets_client.get_processing_records(spreadsheet_id, limit, sheet_name)
+        # Registros desde el espejo local de Google Sheets
+        records = await leer_registros_espejo(limit)
         
         return {
             "success": True,
@@ -719,23 +992,17 @@ async def check_gps_info(file: UploadFile = File(...)):
     Verifica si una imagen tiene información GPS en los metadatos EXIF
     """
     try:
-        # Leer el contenido del archivo
-        image_bytes = await file.read()
-        
-        # Usar el extractor de GPS para verificar si hay datos GPS
-        from src.metadata.gps_extractor import GPSExtractor
-        gps_extractor = GPSExtractor()
-        
-        # Extraer datos GPS
-        gps_data = gps_extractor._extract_gps_data(image_bytes)
+        # Solo se lee la cabecera EXIF del archivo subido, no la imagen completa
+        from src.metadata.lector_exif import leer_exif
+        datos = leer_exif(file.file)
         
         # Verificar si hay información GPS válida
-        has_gps = (
-            gps_data.get('latitud') is not None and 
-            gps_data.get('longitud') is not None and
-            gps_data.get('latitud') != 0 and 
-            gps_data.get('longitud') != 0
-        )
+        has_gps = datos.tiene_gps and datos.latitud != 0 and datos.longitud != 0
+        gps_data = {
+            'latitud': datos.latitud,
+            'longitud': datos.longitud,
+            'altitud': datos.altitud
+        }
         
         return {
             "has_gps": has_gps,
@@ -752,92 +1019,31 @@ async def check_gps_info(file: UploadFile = File(...)):
         }
 
 @app.get("/google-sheets/field-data")
-async def get_field_data():
+async def get_field_data(request: Request):
     """
-    Obtiene los datos de la hoja 'Data-campo' para los dropdowns con relaciones jerárquicas
+    Obtiene los datos de la hoja 'Data-campo' para los dropdowns con relaciones jerárquicas.
+    Se sirve desde un índice refrescado en segundo plano; responde 304 si el ETag no cambió.
     """
     try:
-        with open('google_sheets_config.json', 'r') as f:
-            config = json.load(f)
-        
-        # Autenticar con Google Sheets
-        if not sheets_client.authenticate():
-            raise HTTPException(status_code=500, detail="Error autenticando con Google Sheets")
-        
-        # Obtener datos de la hoja 'Data-campo'
+        config = load_google_sheets_config()
         spreadsheet_id = config.get('spreadsheet_id')
         if not spreadsheet_id:
             raise HTTPException(status_code=500, detail="ID de spreadsheet no configurado")
         
-        # Leer todos los datos de la hoja 'Data-campo' (columnas B, D, G, I)
-        range_name = 'Data-campo!B:I'  # Empresa, Fundo, Sector, Lote
-        all_data = sheets_client.service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id, range=range_name
-        ).execute()
-        
-        if 'values' not in all_data or len(all_data['values']) <= 1:
-            return {
-                "empresa": [],
-                "fundo": [],
-                "sector": [],
-                "lote": [],
-                "hierarchical": {}
-            }
+        indice = obtener_indice(
+            spreadsheet_id, functools.partial(sheets_client.leer_datos_campo, spreadsheet_id)
+        )
+        datos, etag = await ejecutor.ejecutar_io(indice.obtener)
         
-        # Procesar datos (eliminar primera fila que contiene títulos)
-        rows = all_data['values'][1:]  # Saltar encabezados
-        
-        # Crear estructuras jerárquicas
-        empresas = set()
-        empresa_fundos = {}  # {empresa: [fundos]}
-        fundo_sectores = {}  # {fundo: [sectores]}
-        sector_lotes = {}    # {sector: [lotes]}
-        
-        for row in rows:
-            if len(row) >= 4:  # Asegurar que tenemos al menos 4 columnas
-                empresa = row[0].strip() if len(row) > 0 and row[0] else ''
-                fundo = row[2].strip() if len(row) > 2 and row[2] else ''  # Columna D (índice 2)
-                sector = row[5].strip() if len(row) > 5 and row[5] else ''  # Columna G (índice 5)
-                lote = row[7].strip() if len(row) > 7 and row[7] else ''    # Columna I (índice 7)
-                
-                if empresa:
-                    empresas.add(empresa)
-                    
-                    if empresa not in empresa_fundos:
-                        empresa_fundos[empresa] = set()
-                    if fundo:
-                        empresa_fundos[empresa].add(fundo)
-                        
-                        if fundo not in fundo_sectores:
-                            fundo_sectores[fundo] = set()
-                        if sector:
-                            fundo_sectores[fundo].add(sector)
-                            
-                            if sector not in sector_lotes:
-                                sector_lotes[sector] = set()
-                            if lote:
-                                sector_lotes[sector].add(lote)
-        
-        # Convertir sets a listas ordenadas
-        empresas_list = sorted(list(empresas))
-        
-        # Crear estructura jerárquica completa
-        hierarchical = {}
-        for empresa in empresas_list:
-            hierarchical[empresa] = {}
-            for fundo in sorted(list(empresa_fundos.get(empresa, set()))):
-                hierarchical[empresa][fundo] = {}
-                for sector in sorted(list(fundo_sectores.get(fundo, set()))):
-                    hierarchical[empresa][fundo][sector] = sorted(list(sector_lotes.get(sector, set())))
+        # El cliente ya tiene esta versión del índice
+        etags_cliente = request.headers.get('if-none-match', '')
+        if etag in [valor.strip().removeprefix('W/') for valor in etags_cliente.split(',')]:
+            return Response(status_code=304, headers={"ETag": etag})
         
-        return {
-            "empresa": empresas_list,
-            "fundo": sorted(list(set().union(*empresa_fundos.values()))),
-            "sector": sorted(list(set().union(*fundo_sectores.values()))),
-            "lote": sorted(list(set().union(*sector_lotes.values()))),
-            "hierarchical": hierarchical
-        }
+        return JSONResponse(content=datos, headers={"ETag": etag, "Cache-Control": "no-cache"})
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error obteniendo datos de campo: {e}")
         raise HTTPException(status_code=500, detail=f"Error obteniendo datos de campo: {str(e)}")
@@ -859,7 +1065,7 @@ async def update_headers():
         if not sheets_client.authenticate():
             raise HTTPException(status_code=500, detail="Error autenticando con Google Sheets")
         
-        # Forzar actualización de encabezados
+        # Forzar actualización de encabezados (también descarta la verificación en caché)
         if sheets_client.force_update_headers(spreadsheet_id, sheet_name):
             return {
                 "success": True,
@@ -878,7 +1084,8 @@ async def procesar_imagen_visual(
     empresa: str = Form(""),
     fundo: str = Form("Test Modelo"),
     sector: str = Form(""),
-    lote: str = Form("")
+    lote: str = Form(""),
+    preview: bool = Form(False, description="Vista previa rápida: clasifica una muestra de píxeles y devuelve el margen de error")
 ):
     """
     Procesa una imagen y devuelve la imagen con superposición visual de luz y sombra
@@ -891,69 +1098,32 @@ async def procesar_imagen_visual(
         
         # Leer la imagen
         image_data = await imagen.read()
-        import cv2
-        import numpy as np
-        from io import BytesIO
-        import base64
         
-        # Convertir bytes a imagen OpenCV
-        nparr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Clasificación y visualización en el pool de CPU
+        resultado = await ejecutar_inferencia(tareas.procesar_imagen_visual_bytes, image_data, preview)
         
-        if img is None:
+        if resultado is None:
             raise HTTPException(status_code=400, detail="No se pudo procesar la imagen")
         
-        print(f"📏 Dimensiones de la imagen: {img.shape}")
-        
-        # Procesar con el modelo
-        procesamiento_service = ProcesamientoServiceV2()
-        light_percentage, shadow_percentage, light_mask = procesamiento_service.procesar_imagen_visual(img)
+        light_percentage = resultado["porcentaje_luz"]
+        shadow_percentage = resultado["porcentaje_sombra"]
         
         print(f"✅ Análisis completado - Luz: {light_percentage:.1f}%, Sombra: {shadow_percentage:.1f}%")
         
-        # Crear imagen de análisis como las de la carpeta "resultados"
-        height, width = img.shape[:2]
-        result_img = np.zeros((height, width, 3), dtype=np.uint8)
-        
-        # Crear máscaras como en el código original
-        mask_luz_2d = light_mask == 255
-        mask_sombra_2d = light_mask == 128
-        
-        # Aplicar colores exactamente como en el código original (BGR format)
-        result_img[mask_luz_2d] = [0, 255, 255]      # Amarillo para luz (BGR)
-        result_img[mask_sombra_2d] = [50, 50, 50]    # Gris para sombra
-        
-        # Agregar leyenda visual en la esquina superior izquierda
-        cv2.rectangle(result_img, (20, 20), (300, 120), (255, 255, 255), -1)
-        cv2.rectangle(result_img, (20, 20), (300, 120), (0, 0, 0), 2)
-        
-        # Texto de la leyenda
-        cv2.putText(result_img, "ANALISIS LUZ-SOMBRA", (30, 45), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
-        cv2.putText(result_img, f"Luz: {light_percentage:.1f}%", (30, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
-        cv2.putText(result_img, f"Sombra: {shadow_percentage:.1f}%", (30, 95), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
-        
-        # Agregar indicadores de color - CORREGIDOS
-        cv2.rectangle(result_img, (200, 50), (220, 70), (0, 255, 255), -1)  # Cuadrado amarillo para luz
-        cv2.putText(result_img, "Luz", (225, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
-        
-        cv2.rectangle(result_img, (200, 75), (220, 95), (50, 50, 50), -1)  # Cuadrado gris para sombra
-        cv2.putText(result_img, "Sombra", (225, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
-        
-        # Convertir a base64 para enviar al frontend
-        _, buffer = cv2.imencode('.jpg', result_img)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
-        
         return {
             "success": True,
             "porcentaje_luz": light_percentage,
             "porcentaje_sombra": shadow_percentage,
-            "imagen_visual": f"data:image/jpeg;base64,{img_base64}",
+            "imagen_visual": resultado["imagen_visual"],
+            "estimacion": resultado["estimacion"],
             "fundo": fundo,
             "sector": sector or "",
-            "hilera": hilera or "",
+            "hilera": "",
             "mensaje": "Imagen procesada con visualización exitosamente"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error procesando imagen visual: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error procesando imagen: {str(e)}")
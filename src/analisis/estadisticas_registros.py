@@ -0,0 +1,184 @@
+"""
+Estadísticas de los registros de procesamiento sobre una tabla columnar (pandas).
+
+Los registros (diccionarios de texto, como vienen de Google Sheets) se convierten una
+sola vez en un DataFrame tipado; las agregaciones por empresa/fundo/sector/lote/hilera
+y por fecha se calculan con groupby vectorizado. Los resultados se guardan en caché
+hasta que cambie la versión de los datos (llegada de filas nuevas).
+"""
+
+import math
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# Niveles de agrupación disponibles, de mayor a menor
+NIVELES_AGRUPACION = ['empresa', 'fundo', 'sector', 'lote', 'hilera']
+
+# Percentiles reportados para luz y sombra
+PERCENTILES = [10, 25, 50, 75, 90]
+
+COLUMNAS_PORCENTAJE = {'porcentaje_luz': 'luz', 'porcentaje_sombra': 'sombra'}
+
+
+def construir_tabla(records: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Convierte los registros en una tabla tipada
+
+    Args:
+        records: Registros con valores de texto (claves de la hoja Data-app)
+
+    Returns:
+        pd.DataFrame: Columnas de agrupación (str), `fecha` (datetime64), porcentajes (float64)
+            y `timestamp` (str)
+    """
+    campos = NIVELES_AGRUPACION + ['fecha', 'timestamp'] + list(COLUMNAS_PORCENTAJE)
+    tabla = pd.DataFrame.from_records(
+        [tuple(record.get(campo, '') for campo in campos) for record in records],
+        columns=campos
+    )
+
+    for nivel in NIVELES_AGRUPACION:
+        tabla[nivel] = tabla[nivel].fillna('').astype(str).str.strip()
+
+    tabla['fecha'] = pd.to_datetime(tabla['fecha'], format='%Y-%m-%d', errors='coerce')
+    tabla['timestamp'] = tabla['timestamp'].fillna('').astype(str)
+
+    for columna in COLUMNAS_PORCENTAJE:
+        texto = tabla[columna].fillna('').astype(str).str.strip()
+        # Igual que el cálculo anterior: vacío cuenta como 0, texto no numérico se descarta
+        tabla[columna] = pd.to_numeric(texto.mask(texto == '', '0'), errors='coerce').astype(np.float64)
+
+    return tabla
+
+
+def _valor(x) -> Optional[float]:
+    """Redondea para JSON (NaN -> None)"""
+    return None if x is None or (isinstance(x, float) and math.isnan(x)) else round(float(x), 2)
+
+
+def _lista(serie: pd.Series) -> List[Optional[float]]:
+    """Columna redondeada como lista de Python (NaN -> None)"""
+    return [None if math.isnan(v) else v for v in np.round(serie.to_numpy(dtype=np.float64), 2).tolist()]
+
+
+def _resumen_global(tabla: pd.DataFrame) -> Dict[str, Any]:
+    resumen = {"total": int(len(tabla))}
+    for columna, nombre in COLUMNAS_PORCENTAJE.items():
+        valores = tabla[columna].to_numpy()
+        valores = valores[~np.isnan(valores)]
+        if len(valores) == 0:
+            resumen[nombre] = None
+            continue
+        percentiles = np.percentile(valores, PERCENTILES)
+        resumen[nombre] = {
+            "promedio": _valor(valores.mean()),
+            "desviacion": _valor(valores.std(ddof=1)) if len(valores) > 1 else None,
+            "min": _valor(valores.min()),
+            "max": _valor(valores.max()),
+            **{f"p{p}": _valor(v) for p, v in zip(PERCENTILES, percentiles)}
+        }
+    return resumen
+
+
+def agrupar(tabla: pd.DataFrame, niveles: Sequence[str], por_fecha: bool = False) -> List[Dict[str, Any]]:
+    """
+    Estadísticas de luz y sombra por grupo
+
+    Args:
+        tabla: Tabla construida con `construir_tabla`
+        niveles: Subconjunto de NIVELES_AGRUPACION
+        por_fecha: Si es True, agrupa además por la fecha de la foto
+
+    Returns:
+        List[Dict]: Un elemento por grupo con sus claves, `total` y los resúmenes de luz y sombra
+    """
+    claves = list(niveles) + (['fecha'] if por_fecha else [])
+    if not claves:
+        return [_resumen_global(tabla)]
+    if tabla.empty:
+        return []
+
+    columnas = list(COLUMNAS_PORCENTAJE)
+    if por_fecha:
+        # Fecha como texto ('' si no es válida): groupby.quantile descarta los grupos con clave nula
+        tabla = tabla.assign(fecha=tabla['fecha'].dt.strftime('%Y-%m-%d').fillna(''))
+    grupos = tabla.groupby(claves, sort=True)
+
+    totales = grupos.size()
+    # Se alinean explícitamente con el orden de grupos de `totales`
+    agregados = grupos[columnas].agg(['mean', 'std', 'min', 'max']).reindex(totales.index)
+    cuantiles = grupos[columnas].quantile([p / 100 for p in PERCENTILES]).unstack().reindex(totales.index)
+
+    # Todas las salidas comparten el orden de grupos de `totales`: se arman por columnas
+    claves_grupo = totales.index.to_frame(index=False)
+    columnas_salida = {nombre: claves_grupo[nombre].tolist() for nombre in claves}
+    if por_fecha:
+        columnas_salida['fecha'] = [fecha or None for fecha in columnas_salida['fecha']]
+    columnas_salida["total"] = totales.to_numpy().tolist()
+
+    resumenes = {}
+    for columna, nombre in COLUMNAS_PORCENTAJE.items():
+        estadisticos = {
+            "promedio": _lista(agregados[(columna, 'mean')]),
+            "desviacion": _lista(agregados[(columna, 'std')]),
+            "min": _lista(agregados[(columna, 'min')]),
+            "max": _lista(agregados[(columna, 'max')]),
+            **{f"p{p}": _lista(cuantiles[(columna, p / 100)]) for p in PERCENTILES}
+        }
+        resumenes[nombre] = [dict(zip(estadisticos, valores)) for valores in zip(*estadisticos.values())]
+
+    return [
+        {**dict(zip(columnas_salida, valores)), **{nombre: resumenes[nombre][i] for nombre in resumenes}}
+        for i, valores in enumerate(zip(*columnas_salida.values()))
+    ]
+
+
+class MotorEstadisticas:
+    """Tabla columnar y resultados en caché mientras no cambie la versión de los datos"""
+
+    def __init__(self):
+        self._version: Hashable = None
+        self._tabla: Optional[pd.DataFrame] = None
+        self._resultados: Dict[Hashable, Any] = {}
+        self._lock = threading.Lock()
+
+    def _obtener_tabla(self, version: Hashable, cargar_registros: Callable[[], List[Dict[str, Any]]]) -> pd.DataFrame:
+        if self._tabla is None or version is None or version != self._version:
+            self._tabla = construir_tabla(cargar_registros())
+            self._version = version
+            self._resultados = {}
+        return self._tabla
+
+    def calcular(self, version: Hashable, cargar_registros: Callable[[], List[Dict[str, Any]]],
+                 niveles: Sequence[str] = (), por_fecha: bool = False) -> Dict[str, Any]:
+        """
+        Estadísticas globales y, si se piden, por grupo
+
+        Args:
+            version: Identifica el estado de los datos; si cambia se reconstruye la tabla
+                     (None desactiva la caché)
+            cargar_registros: Retorna los registros actuales
+            niveles: Niveles de agrupación (subconjunto de NIVELES_AGRUPACION)
+            por_fecha: Agrupar además por fecha
+
+        Returns:
+            Dict: `global`, `grupos` (lista, vacía si no se agrupa) y `ultimo_procesamiento`
+        """
+        niveles = tuple(niveles)
+        invalidos = [nivel for nivel in niveles if nivel not in NIVELES_AGRUPACION]
+        if invalidos:
+            raise ValueError(f"Niveles de agrupación no válidos: {invalidos}. Use: {NIVELES_AGRUPACION}")
+
+        with self._lock:
+            tabla = self._obtener_tabla(version, cargar_registros)
+            clave = (niveles, por_fecha)
+            if clave not in self._resultados:
+                self._resultados[clave] = {
+                    "global": _resumen_global(tabla),
+                    "grupos": agrupar(tabla, niveles, por_fecha) if niveles or por_fecha else [],
+                    "ultimo_procesamiento": tabla['timestamp'].iat[-1] if len(tabla) else None
+                }
+            return self._resultados[clave]
@@ -1,6 +1,7 @@
-import pickle
 import numpy as np
 
+from src.services.registro_modelos import obtener_modelo
+
 def clasificar_imagen(X_pixels, modelo_path="modelo_rf.pkl"):
     """
     Clasifica cada píxel usando un modelo Random Forest entrenado.
@@ -13,8 +14,8 @@ def clasificar_imagen(X_pixels, modelo_path="modelo_rf.pkl"):
     - Array con etiquetas por píxel (ej. ["LUZ", "SUELO", "SOMBRA", ...])
     """
     try:
-        with open(modelo_path, "rb") as f:
-            model, encoder = pickle.load(f)
+        # El registro carga el modelo una sola vez por proceso (y lo recarga si cambia en disco)
+        model, encoder = obtener_modelo(modelo_path)
     except FileNotFoundError:
         raise FileNotFoundError(f"❌ No se encontró el archivo de modelo en: {modelo_path}")
     except Exception as e:
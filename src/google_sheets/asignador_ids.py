@@ -0,0 +1,99 @@
+"""
+Asignador local de IDs secuenciales.
+
+Guarda el último ID entregado por hoja en una fila de SQLite, así que pedir IDs no
+requiere leer la hoja de cálculo. La fila se siembra una sola vez con el ID máximo
+existente en la hoja. Cada reserva corre en una transacción `BEGIN IMMEDIATE`, por lo
+que es atómica entre hilos y entre procesos (workers de la API y Streamlit) que
+compartan el mismo archivo.
+
+Configuración por variables de entorno:
+- IDS_DB: ruta de la base SQLite (por defecto ids_secuenciales.sqlite3)
+"""
+
+import os
+import sqlite3
+from contextlib import closing
+from typing import Callable
+
+
+class AsignadorIds:
+    """Contadores persistentes de IDs secuenciales, uno por clave (hoja de cálculo + hoja)"""
+
+    def __init__(self, ruta_db: str = None):
+        self.ruta_db = ruta_db or os.getenv('IDS_DB', 'ids_secuenciales.sqlite3')
+        with closing(self._conectar()) as conexion:
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS contadores (clave TEXT PRIMARY KEY, ultimo INTEGER NOT NULL)"
+            )
+
+    def _conectar(self) -> sqlite3.Connection:
+        # Una conexión por operación: válida desde cualquier hilo y sin estado compartido
+        return sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+
+    def reservar(self, clave: str, sembrar: Callable[[], int], cantidad: int = 1) -> int:
+        """
+        Reserva `cantidad` IDs consecutivos para `clave`
+
+        Args:
+            clave: Identifica el contador (ej. "<spreadsheet_id>/<hoja>")
+            sembrar: Retorna el ID máximo existente; solo se llama si la clave aún no existe
+            cantidad: Número de IDs a reservar
+
+        Returns:
+            int: Primer ID del rango reservado (el rango es [primero, primero + cantidad))
+        """
+        conexion = self._conectar()
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            fila = conexion.execute("SELECT ultimo FROM contadores WHERE clave = ?", (clave,)).fetchone()
+            if fila is None:
+                # Se siembra dentro de la transacción para que un solo proceso lea la hoja
+                ultimo = int(sembrar())
+                print(f"🌱 Contador de IDs '{clave}' sembrado con {ultimo}")
+            else:
+                ultimo = fila[0]
+
+            conexion.execute(
+                "INSERT OR REPLACE INTO contadores (clave, ultimo) VALUES (?, ?)",
+                (clave, ultimo + cantidad)
+            )
+            conexion.execute("COMMIT")
+            return ultimo + 1
+        except BaseException:
+            if conexion.in_transaction:
+                conexion.execute("ROLLBACK")
+            raise
+        finally:
+            conexion.close()
+
+    def olvidar(self, clave: str):
+        """Elimina el contador; el próximo `reservar` volverá a sembrarlo desde la hoja"""
+        with closing(self._conectar()) as conexion:
+            conexion.execute("DELETE FROM contadores WHERE clave = ?", (clave,))
+
+
+def max_id_numerico(ids) -> int:
+    """
+    ID numérico más alto de una secuencia de IDs
+
+    Acepta los mismos formatos que se usaban al numerar leyendo la hoja: "123" y
+    "IMG_<timestamp>_<n>" (cuenta el timestamp). Los demás valores se ignoran.
+
+    Args:
+        ids: Valores de la columna ID
+
+    Returns:
+        int: ID máximo, o 0 si no hay ninguno numérico
+    """
+    max_id = 0
+    for valor in ids:
+        try:
+            texto = str(valor).strip()
+            if texto.startswith('IMG_'):
+                max_id = max(max_id, int(texto.split('_')[1]))
+            else:
+                max_id = max(max_id, int(texto))
+        except (ValueError, IndexError):
+            continue
+    return max_id
@@ -0,0 +1,251 @@
+"""
+Cola de escritura diferida (write-behind) para Google Sheets.
+
+Los endpoints encolan registros y responden sin esperar a Google Sheets; un hilo en
+segundo plano los envía en una sola llamada `append` cada `max_lote` registros o cada
+`intervalo` segundos, reintentando con backoff exponencial si la escritura falla.
+
+Los registros pendientes se guardan en un journal local (JSON Lines) para que no se
+pierdan si el proceso se reinicia antes de enviarlos. Cada proceso (ej. cada worker de
+uvicorn) escribe su propio journal, `<base>.<pid>.jsonl`, y mantiene bloqueado su archivo
+`.lock` mientras vive. Al arrancar, un proceso adopta los journals cuyo bloqueo puede
+tomar (su dueño ya terminó), así nadie reenvía registros que otro proceso aún gestiona.
+
+Configuración por variables de entorno:
+- SHEETS_LOTE_MAX: registros por llamada `append` (por defecto 50)
+- SHEETS_FLUSH_SEGUNDOS: espera máxima antes de enviar un lote incompleto (por defecto 5)
+- SHEETS_JOURNAL: ruta base de los journals (por defecto sheets_pendientes.jsonl)
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _bloquear(archivo) -> bool:
+    """Intenta tomar sin esperar un bloqueo exclusivo sobre un archivo abierto (se libera al cerrarlo)"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(archivo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            archivo.seek(0)
+            msvcrt.locking(archivo.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _eliminar(ruta: str):
+    try:
+        os.remove(ruta)
+    except OSError:
+        pass
+
+
+class ColaEscrituraSheets:
+    """Cola de registros pendientes con envío por lotes, reintentos y journal en disco"""
+
+    def __init__(self, escribir: Callable[[List[Dict[str, Any]]], bool], ruta_journal: str = None,
+                 max_lote: int = None, intervalo: float = None,
+                 backoff_inicial: float = 2.0, backoff_max: float = 300.0):
+        """
+        Args:
+            escribir: Función que envía una lista de registros a Google Sheets y retorna True si tuvo éxito
+            ruta_journal: Archivo donde se persisten los registros pendientes
+            max_lote: Registros que disparan un envío inmediato
+            intervalo: Segundos máximos que un registro espera antes de enviarse
+            backoff_inicial: Espera tras el primer fallo (se duplica en cada fallo consecutivo)
+            backoff_max: Espera máxima entre reintentos
+        """
+        self.escribir = escribir
+        self.ruta_base = ruta_journal or os.getenv('SHEETS_JOURNAL', 'sheets_pendientes.jsonl')
+        raiz, extension = os.path.splitext(self.ruta_base)
+        self.ruta_journal = f"{raiz}.{os.getpid()}{extension}"
+        self.max_lote = max_lote or int(os.getenv('SHEETS_LOTE_MAX', 50))
+        self.intervalo = intervalo or float(os.getenv('SHEETS_FLUSH_SEGUNDOS', 5))
+        self.backoff_inicial = backoff_inicial
+        self.backoff_max = backoff_max
+
+        # Bloqueo propio durante toda la vida del proceso: marca el journal como en uso
+        self._bloqueo = open(self.ruta_journal + '.lock', 'a+')
+        if not _bloquear(self._bloqueo):
+            print(f"⚠️ No se pudo bloquear el journal {self.ruta_journal}")
+        # Un journal con el PID propio es de un proceso anterior que ya terminó
+        self._pendientes: List[Dict[str, Any]] = self._leer_journal(self.ruta_journal)
+        self._adoptar_journals_huerfanos()
+        self._condicion = threading.Condition()
+        self._cerrando = False
+
+        if self._pendientes:
+            print(f"📒 {len(self._pendientes)} registros pendientes recuperados del journal: {self.ruta_journal}")
+
+        self._hilo = threading.Thread(target=self._bucle, name="cola-sheets", daemon=True)
+        self._hilo.start()
+
+    @property
+    def pendientes(self) -> int:
+        """Registros encolados que aún no se han escrito en Google Sheets"""
+        return len(self._pendientes)
+
+    def encolar(self, record: Dict[str, Any]):
+        """Encola un registro para escribirlo en segundo plano"""
+        self.encolar_varios([record])
+
+    def encolar_varios(self, records: List[Dict[str, Any]]):
+        """Encola varios registros (se persisten en el journal antes de retornar)"""
+        if not records:
+            return
+        with self._condicion:
+            self._pendientes.extend(records)
+            self._anexar_journal(records)
+            if len(self._pendientes) >= self.max_lote:
+                self._condicion.notify()
+
+    def cerrar(self, timeout: float = 10.0):
+        """Intenta enviar lo pendiente y detiene el hilo; lo no enviado queda en el journal"""
+        with self._condicion:
+            self._cerrando = True
+            self._condicion.notify()
+        self._hilo.join(timeout)
+        if not self._hilo.is_alive() and not self._pendientes:
+            _eliminar(self.ruta_journal)
+            self._bloqueo.close()
+            _eliminar(self.ruta_journal + '.lock')
+
+    def _bucle(self):
+        espera_fallo = 0.0
+        while True:
+            with self._condicion:
+                if espera_fallo:
+                    # Backoff tras un fallo; al cerrar, lo pendiente queda en el journal
+                    limite = time.monotonic() + espera_fallo
+                    while not self._cerrando and limite - time.monotonic() > 0:
+                        self._condicion.wait(limite - time.monotonic())
+                    if self._cerrando:
+                        return
+                else:
+                    # Esperar a tener un lote completo, a que venza el intervalo o al cierre
+                    limite = time.monotonic() + self.intervalo
+                    while not self._cerrando and len(self._pendientes) < self.max_lote:
+                        restante = limite - time.monotonic()
+                        if restante <= 0:
+                            break
+                        self._condicion.wait(restante)
+                    if self._cerrando and not self._pendientes:
+                        return
+                # Solo este hilo retira registros, así que el prefijo no cambia mientras se envía
+                lote = self._pendientes[:self.max_lote]
+
+            if not lote:
+                continue
+
+            try:
+                exito = self.escribir(lote)
+            except Exception as e:
+                print(f"❌ Error enviando lote a Google Sheets: {e}")
+                exito = False
+
+            if exito:
+                with self._condicion:
+                    del self._pendientes[:len(lote)]
+                    self._reescribir_journal()
+                print(f"📤 {len(lote)} registros enviados a Google Sheets ({len(self._pendientes)} pendientes)")
+                espera_fallo = 0.0
+            else:
+                espera_fallo = min(self.backoff_max, espera_fallo * 2 or self.backoff_inicial)
+                print(f"⚠️ Falló el envío de {len(lote)} registros, reintento en {espera_fallo:.0f}s")
+
+    def _adoptar_journals_huerfanos(self):
+        """
+        Agrega a los pendientes propios los journals de procesos que ya terminaron (y el
+        journal único de versiones anteriores), tomando su bloqueo para que solo un
+        proceso los adopte
+        """
+        directorio = os.path.dirname(self.ruta_base) or '.'
+        raiz, extension = os.path.splitext(os.path.basename(self.ruta_base))
+        patron = re.compile(re.escape(raiz) + r'\.\d+' + re.escape(extension) + '$')
+        try:
+            nombres = os.listdir(directorio)
+        except OSError:
+            return
+        candidatos = [self.ruta_base] + [
+            os.path.join(directorio, nombre) for nombre in sorted(nombres) if patron.match(nombre)
+        ]
+
+        adoptados = []
+        for ruta in candidatos:
+            if os.path.abspath(ruta) == os.path.abspath(self.ruta_journal) or not os.path.exists(ruta):
+                continue
+            try:
+                bloqueo = open(ruta + '.lock', 'a+')
+            except OSError:
+                continue
+            if not _bloquear(bloqueo):
+                bloqueo.close()  # Su proceso sigue vivo
+                continue
+            if not os.path.exists(ruta):
+                bloqueo.close()  # Otro proceso lo adoptó mientras tanto
+                continue
+            records = self._leer_journal(ruta)
+            self._pendientes.extend(records)
+            adoptados.append((ruta, bloqueo))
+            print(f"📒 {len(records)} registros adoptados del journal: {ruta}")
+
+        if adoptados:
+            # Primero queda todo en el journal propio; recién después se borran los adoptados
+            self._reescribir_journal()
+            for ruta, bloqueo in adoptados:
+                _eliminar(ruta)
+                bloqueo.close()
+                _eliminar(ruta + '.lock')
+
+    def _leer_journal(self, ruta: str) -> List[Dict[str, Any]]:
+        if not os.path.exists(ruta):
+            return []
+        records = []
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    linea = linea.strip()
+                    if not linea:
+                        continue
+                    try:
+                        records.append(json.loads(linea))
+                    except json.JSONDecodeError:
+                        # Línea truncada por una caída durante la escritura
+                        print(f"⚠️ Línea inválida ignorada en el journal: {linea[:80]}")
+        except OSError as e:
+            print(f"⚠️ No se pudo leer el journal {ruta}: {e}")
+        return records
+
+    def _anexar_journal(self, records: List[Dict[str, Any]]):
+        try:
+            with open(self.ruta_journal, 'a', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(f"⚠️ No se pudo escribir el journal {self.ruta_journal}: {e}")
+
+    def _reescribir_journal(self):
+        # Reemplazo atómico: una caída a mitad nunca deja el journal a medias
+        temporal = self.ruta_journal + '.tmp'
+        try:
+            with open(temporal, 'w', encoding='utf-8') as f:
+                for record in self._pendientes:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporal, self.ruta_journal)
+        except OSError as e:
+            print(f"⚠️ No se pudo actualizar el journal {self.ruta_journal}: {e}")
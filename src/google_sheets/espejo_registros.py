@@ -0,0 +1,286 @@
+"""
+Espejo local (SQLite) de la hoja de registros de procesamiento (Data-app).
+
+Las lecturas (historial, estadísticas, registros) se sirven desde el espejo en
+milisegundos y sin consumir cuota de lectura de Google Sheets. Un hilo en segundo plano
+trae solo las filas agregadas desde la última sincronización (la hoja se escribe con
+`append`, así que las filas nuevas siempre quedan al final) y, cada cierto tiempo,
+hace una sincronización completa para recoger ediciones o borrados manuales.
+
+Varios procesos (workers de la API, Streamlit) pueden compartir el mismo archivo:
+las filas se indexan por su número de fila en la hoja y se insertan de forma idempotente.
+
+Configuración por variables de entorno:
+- ESPEJO_DB: ruta de la base SQLite (por defecto espejo_registros.sqlite3)
+- ESPEJO_INTERVALO_SEGUNDOS: periodo de la sincronización incremental (por defecto 60)
+- ESPEJO_COMPLETA_SEGUNDOS: periodo de la sincronización completa (por defecto 3600)
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Columnas A:S de la hoja, en orden (las mismas que escribe GoogleSheetsClient._record_a_fila)
+CAMPOS_REGISTRO = [
+    'id', 'fecha', 'hora', 'imagen', 'nombre_archivo', 'empresa', 'fundo', 'sector', 'lote',
+    'hilera', 'numero_planta', 'latitud', 'longitud', 'porcentaje_luz', 'porcentaje_sombra',
+    'dispositivo', 'software', 'direccion', 'timestamp'
+]
+
+# Primera fila de datos (la fila 1 son los encabezados)
+PRIMERA_FILA = 2
+
+
+class EspejoRegistros:
+    """Copia local de una hoja de registros, sincronizada de forma incremental"""
+
+    def __init__(self, origen: str, leer_filas: Callable[[int], List[List[str]]], ruta_db: str = None,
+                 intervalo: float = None, intervalo_completa: float = None):
+        """
+        Args:
+            origen: Identifica la hoja reflejada (ej. "<spreadsheet_id>/<hoja>")
+            leer_filas: Retorna las filas de la hoja a partir del número de fila indicado
+            ruta_db: Archivo SQLite del espejo
+            intervalo: Segundos entre sincronizaciones incrementales
+            intervalo_completa: Segundos entre sincronizaciones completas
+        """
+        self.origen = origen
+        self.leer_filas = leer_filas
+        self.ruta_db = ruta_db or os.getenv('ESPEJO_DB', 'espejo_registros.sqlite3')
+        self.intervalo = intervalo or float(os.getenv('ESPEJO_INTERVALO_SEGUNDOS', 60))
+        self.intervalo_completa = intervalo_completa or float(os.getenv('ESPEJO_COMPLETA_SEGUNDOS', 3600))
+
+        self._lock_sincronizacion = threading.Lock()
+        self._aviso = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+
+        columnas = ", ".join(f"{campo} TEXT" for campo in CAMPOS_REGISTRO)
+        with closing(self._conectar()) as conexion:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                f"CREATE TABLE IF NOT EXISTS registros (origen TEXT NOT NULL, fila INTEGER NOT NULL, "
+                f"{columnas}, PRIMARY KEY (origen, fila))"
+            )
+            # Índices para las consultas filtradas y paginadas del historial
+            conexion.execute(
+                "CREATE INDEX IF NOT EXISTS idx_registros_jerarquia "
+                "ON registros (origen, empresa, fundo, sector, lote, fila)"
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS idx_registros_fecha ON registros (origen, fecha, fila)")
+            conexion.execute(
+                "CREATE INDEX IF NOT EXISTS idx_registros_luz ON registros (origen, CAST(porcentaje_luz AS REAL))"
+            )
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS sincronizacion (origen TEXT PRIMARY KEY, "
+                "ultima_fila INTEGER NOT NULL, ultima_completa REAL NOT NULL, ultima REAL NOT NULL)"
+            )
+
+    def _conectar(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+
+    def _estado(self, conexion: sqlite3.Connection) -> Optional[Tuple[int, float, float]]:
+        return conexion.execute(
+            "SELECT ultima_fila, ultima_completa, ultima FROM sincronizacion WHERE origen = ?", (self.origen,)
+        ).fetchone()
+
+    def sincronizar(self, completa: bool = False) -> int:
+        """
+        Trae a la base local las filas nuevas de la hoja
+
+        Args:
+            completa: Si es True, vuelve a leer la hoja entera en lugar de solo las filas nuevas
+
+        Returns:
+            int: Número de filas leídas de la hoja
+        """
+        with self._lock_sincronizacion:
+            with closing(self._conectar()) as conexion:
+                estado = self._estado(conexion)
+
+            ahora = time.time()
+            if estado is None or ahora - estado[1] >= self.intervalo_completa:
+                completa = True
+            fila_inicial = PRIMERA_FILA if completa else estado[0] + 1
+
+            filas = self.leer_filas(fila_inicial)
+
+            valores = []
+            for desplazamiento, fila in enumerate(filas):
+                # Mismo criterio que get_processing_records: solo filas con las 19 columnas
+                if len(fila) >= len(CAMPOS_REGISTRO):
+                    valores.append((self.origen, fila_inicial + desplazamiento, *fila[:len(CAMPOS_REGISTRO)]))
+            ultima_fila = fila_inicial + len(filas) - 1
+
+            marcadores = ", ".join("?" for _ in range(len(CAMPOS_REGISTRO) + 2))
+            with closing(self._conectar()) as conexion:
+                conexion.execute("BEGIN IMMEDIATE")
+                try:
+                    if completa:
+                        conexion.execute("DELETE FROM registros WHERE origen = ?", (self.origen,))
+                    conexion.executemany(f"INSERT OR REPLACE INTO registros VALUES ({marcadores})", valores)
+                    if not completa and estado is not None:
+                        # Otro proceso pudo avanzar más mientras se leía la hoja
+                        ultima_fila = max(ultima_fila, self._estado(conexion)[0])
+                    conexion.execute(
+                        "INSERT OR REPLACE INTO sincronizacion (origen, ultima_fila, ultima_completa, ultima) "
+                        "VALUES (?, ?, ?, ?)",
+                        (self.origen, ultima_fila, ahora if completa else estado[1], ahora)
+                    )
+                    conexion.execute("COMMIT")
+                except BaseException:
+                    conexion.execute("ROLLBACK")
+                    raise
+
+            print(f"🔁 Espejo '{self.origen}' sincronizado ({'completo' if completa else 'incremental'}): "
+                  f"{len(valores)} filas desde la fila {fila_inicial}")
+            return len(filas)
+
+    def version(self) -> Optional[Tuple[int, float]]:
+        """
+        Identifica el contenido actual del espejo: cambia cuando llegan filas nuevas o hay
+        una sincronización completa (None si nunca se sincronizó)
+        """
+        with closing(self._conectar()) as conexion:
+            estado = self._estado(conexion)
+        return None if estado is None else (estado[0], estado[1])
+
+    def obtener_registros(self, limit: int = None) -> List[Dict[str, Any]]:
+        """
+        Registros del espejo en el orden de la hoja (como get_processing_records).
+        Si el espejo nunca se sincronizó, sincroniza antes de responder.
+
+        Args:
+            limit: Número máximo de registros (None = todos)
+
+        Returns:
+            List[Dict]: Registros con las claves de CAMPOS_REGISTRO
+        """
+        with closing(self._conectar()) as conexion:
+            sincronizado = self._estado(conexion) is not None
+        if not sincronizado:
+            self.sincronizar(completa=True)
+
+        consulta = f"SELECT {', '.join(CAMPOS_REGISTRO)} FROM registros WHERE origen = ? ORDER BY fila"
+        parametros: Tuple = (self.origen,)
+        if limit is not None:
+            consulta += " LIMIT ?"
+            parametros += (int(limit),)
+
+        with closing(self._conectar()) as conexion:
+            filas = conexion.execute(consulta, parametros).fetchall()
+        return [dict(zip(CAMPOS_REGISTRO, fila)) for fila in filas]
+
+    def consultar_registros(self, limit: int = 100, cursor: Optional[int] = None, descendente: bool = False,
+                            empresa: str = None, fundo: str = None, sector: str = None, lote: str = None,
+                            fecha_desde: str = None, fecha_hasta: str = None,
+                            luz_min: float = None, luz_max: float = None,
+                            sombra_min: float = None, sombra_max: float = None
+                            ) -> Tuple[List[Tuple[int, Dict[str, Any]]], Optional[int]]:
+        """
+        Página de registros filtrados, paginada por número de fila (keyset)
+
+        Args:
+            limit: Registros por página
+            cursor: Número de fila a partir del cual continuar (el `siguiente_cursor` de la página anterior)
+            descendente: Si es True, de la fila más reciente a la más antigua
+            empresa, fundo, sector, lote: Filtros por igualdad
+            fecha_desde, fecha_hasta: Rango de fechas inclusivo (YYYY-MM-DD)
+            luz_min, luz_max, sombra_min, sombra_max: Rangos inclusivos de porcentaje
+
+        Returns:
+            Tuple: (lista de (fila, registro), siguiente_cursor o None si no hay más)
+        """
+        with closing(self._conectar()) as conexion:
+            sincronizado = self._estado(conexion) is not None
+        if not sincronizado:
+            self.sincronizar(completa=True)
+
+        condiciones = ["origen = ?"]
+        parametros: List[Any] = [self.origen]
+        for campo, valor in (('empresa', empresa), ('fundo', fundo), ('sector', sector), ('lote', lote)):
+            if valor is not None:
+                condiciones.append(f"{campo} = ?")
+                parametros.append(valor)
+        if fecha_desde is not None:
+            condiciones.append("fecha >= ?")
+            parametros.append(fecha_desde)
+        if fecha_hasta is not None:
+            condiciones.append("fecha <= ?")
+            parametros.append(fecha_hasta)
+        # Un porcentaje vacío cuenta como 0 (CAST('' AS REAL) = 0.0), igual que en la API
+        for campo, minimo, maximo in (('porcentaje_luz', luz_min, luz_max),
+                                      ('porcentaje_sombra', sombra_min, sombra_max)):
+            if minimo is not None:
+                condiciones.append(f"CAST({campo} AS REAL) >= ?")
+                parametros.append(minimo)
+            if maximo is not None:
+                condiciones.append(f"CAST({campo} AS REAL) <= ?")
+                parametros.append(maximo)
+        if cursor is not None:
+            condiciones.append("fila < ?" if descendente else "fila > ?")
+            parametros.append(int(cursor))
+
+        consulta = (
+            f"SELECT fila, {', '.join(CAMPOS_REGISTRO)} FROM registros WHERE {' AND '.join(condiciones)} "
+            f"ORDER BY fila {'DESC' if descendente else 'ASC'} LIMIT ?"
+        )
+        # Se pide un registro extra para saber si hay una página siguiente
+        parametros.append(int(limit) + 1)
+
+        with closing(self._conectar()) as conexion:
+            filas = conexion.execute(consulta, parametros).fetchall()
+
+        pagina = [(fila[0], dict(zip(CAMPOS_REGISTRO, fila[1:]))) for fila in filas[:limit]]
+        siguiente_cursor = pagina[-1][0] if len(filas) > limit else None
+        return pagina, siguiente_cursor
+
+    def iniciar(self):
+        """Arranca (una sola vez) el hilo de sincronización en segundo plano"""
+        if self._hilo is not None:
+            return
+        self._hilo = threading.Thread(target=self._bucle, name="espejo-registros", daemon=True)
+        self._hilo.start()
+
+    def avisar(self):
+        """Pide una sincronización incremental inmediata (ej. tras escribir registros nuevos)"""
+        self._aviso.set()
+
+    def _bucle(self):
+        while True:
+            self._aviso.wait(self.intervalo)
+            self._aviso.clear()
+            try:
+                self.sincronizar()
+            except Exception as e:
+                print(f"⚠️ Error sincronizando espejo '{self.origen}': {e}")
+
+
+_espejos: Dict[str, EspejoRegistros] = {}
+_lock_espejos = threading.Lock()
+
+
+def obtener_espejo(spreadsheet_id: str, sheet_name: str,
+                   leer_filas: Callable[[int], List[List[str]]]) -> EspejoRegistros:
+    """
+    Espejo compartido por el proceso para una hoja, con la sincronización en segundo plano ya iniciada
+
+    Args:
+        spreadsheet_id: ID de la hoja de cálculo
+        sheet_name: Nombre de la hoja
+        leer_filas: Retorna las filas de la hoja a partir de un número de fila
+                    (solo se usa la primera vez que se pide esta hoja)
+
+    Returns:
+        EspejoRegistros: Espejo de la hoja
+    """
+    origen = f"{spreadsheet_id}/{sheet_name}"
+    with _lock_espejos:
+        espejo = _espejos.get(origen)
+        if espejo is None:
+            espejo = EspejoRegistros(origen, leer_filas)
+            espejo.iniciar()
+            _espejos[origen] = espejo
+        return espejo
@@ -0,0 +1,247 @@
+"""
+Índice jerárquico empresa → fundo → sector → lote de la hoja "Data-campo".
+
+Se construye una vez a partir de las columnas B:I y se refresca en segundo plano; las
+listas de los dropdowns en cascada pasan a ser búsquedas en diccionarios. Cada versión
+lleva un ETag (hash del contenido) para que la API responda 304 si el cliente ya la tiene.
+
+El índice se guarda además en un archivo JSON, así la API y Streamlit arrancan con la
+última versión conocida sin esperar a Google Sheets.
+
+Configuración por variables de entorno:
+- JERARQUIA_INTERVALO_SEGUNDOS: periodo de refresco (por defecto 300)
+- JERARQUIA_ARCHIVO: ruta del archivo del índice (por defecto jerarquia_campo.json)
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Posiciones dentro del rango B:I
+COLUMNA_EMPRESA = 0  # B
+COLUMNA_FUNDO = 2    # D
+COLUMNA_SECTOR = 5   # G
+COLUMNA_LOTE = 7     # I
+
+
+def construir_jerarquia(filas: List[List[str]]) -> Dict[str, Any]:
+    """
+    Construye el índice a partir de las filas de Data-campo!B:I (sin encabezados)
+
+    Args:
+        filas: Filas de la hoja
+
+    Returns:
+        Dict: Listas "empresa", "fundo", "sector", "lote" y el árbol "hierarchical"
+            (el mismo formato que /google-sheets/field-data)
+    """
+    empresa_fundos: Dict[str, set] = {}  # {empresa: {fundos}}
+    fundo_sectores: Dict[str, set] = {}  # {fundo: {sectores}}
+    sector_lotes: Dict[str, set] = {}    # {sector: {lotes}}
+
+    def celda(fila, indice):
+        return fila[indice].strip() if len(fila) > indice and fila[indice] else ''
+
+    for fila in filas:
+        if len(fila) < 4:
+            continue
+        empresa = celda(fila, COLUMNA_EMPRESA)
+        fundo = celda(fila, COLUMNA_FUNDO)
+        sector = celda(fila, COLUMNA_SECTOR)
+        lote = celda(fila, COLUMNA_LOTE)
+
+        if not empresa:
+            continue
+        empresa_fundos.setdefault(empresa, set())
+        if not fundo:
+            continue
+        empresa_fundos[empresa].add(fundo)
+        fundo_sectores.setdefault(fundo, set())
+        if not sector:
+            continue
+        fundo_sectores[fundo].add(sector)
+        sector_lotes.setdefault(sector, set())
+        if lote:
+            sector_lotes[sector].add(lote)
+
+    hierarchical = {
+        empresa: {
+            fundo: {
+                sector: sorted(sector_lotes.get(sector, set()))
+                for sector in sorted(fundo_sectores.get(fundo, set()))
+            }
+            for fundo in sorted(fundos)
+        }
+        for empresa, fundos in sorted(empresa_fundos.items())
+    }
+
+    return {
+        "empresa": sorted(empresa_fundos),
+        "fundo": sorted(set().union(*empresa_fundos.values())),
+        "sector": sorted(set().union(*fundo_sectores.values())),
+        "lote": sorted(set().union(*sector_lotes.values())),
+        "hierarchical": hierarchical
+    }
+
+
+def calcular_etag(datos: Dict[str, Any]) -> str:
+    """ETag fuerte (entre comillas) derivado del contenido del índice"""
+    contenido = json.dumps(datos, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return f'"{hashlib.sha256(contenido).hexdigest()[:32]}"'
+
+
+class IndiceJerarquia:
+    """Índice versionado de Data-campo con refresco periódico en segundo plano"""
+
+    def __init__(self, leer_filas: Callable[[], List[List[str]]], ruta_archivo: str = None,
+                 intervalo: float = None):
+        """
+        Args:
+            leer_filas: Retorna las filas de Data-campo!B:I, incluyendo la fila de encabezados
+            ruta_archivo: Archivo JSON donde se guarda la última versión del índice
+            intervalo: Segundos entre refrescos
+        """
+        self.leer_filas = leer_filas
+        self.ruta_archivo = ruta_archivo or os.getenv('JERARQUIA_ARCHIVO', 'jerarquia_campo.json')
+        self.intervalo = intervalo or float(os.getenv('JERARQUIA_INTERVALO_SEGUNDOS', 300))
+
+        self._datos: Optional[Dict[str, Any]] = None
+        self._etag: Optional[str] = None
+        self._fundos_por_empresa: Dict[str, List[str]] = {}
+        self._sectores_por_fundo: Dict[str, List[str]] = {}
+        self._lotes_por_sector: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        self._lock_refresco = threading.Lock()
+        self._hilo: Optional[threading.Thread] = None
+
+        self._cargar_archivo()
+
+    def _publicar(self, datos: Dict[str, Any], etag: str):
+        fundos_por_empresa = {empresa: list(fundos) for empresa, fundos in datos["hierarchical"].items()}
+        sectores_por_fundo: Dict[str, set] = {}
+        lotes_por_sector: Dict[str, set] = {}
+        for fundos in datos["hierarchical"].values():
+            for fundo, sectores in fundos.items():
+                sectores_por_fundo.setdefault(fundo, set()).update(sectores)
+                for sector, lotes in sectores.items():
+                    lotes_por_sector.setdefault(sector, set()).update(lotes)
+
+        # Se reemplazan las referencias de una vez: los lectores nunca ven un índice a medias
+        with self._lock:
+            self._datos = datos
+            self._etag = etag
+            self._fundos_por_empresa = fundos_por_empresa
+            self._sectores_por_fundo = {fundo: sorted(s) for fundo, s in sectores_por_fundo.items()}
+            self._lotes_por_sector = {sector: sorted(l) for sector, l in lotes_por_sector.items()}
+
+    def _cargar_archivo(self):
+        if not os.path.exists(self.ruta_archivo):
+            return
+        try:
+            with open(self.ruta_archivo, 'r', encoding='utf-8') as f:
+                guardado = json.load(f)
+            self._publicar(guardado["datos"], guardado["etag"])
+            print(f"✅ Índice de Data-campo cargado desde {self.ruta_archivo}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ No se pudo leer el índice de Data-campo {self.ruta_archivo}: {e}")
+
+    def _guardar_archivo(self, datos: Dict[str, Any], etag: str):
+        temporal = self.ruta_archivo + '.tmp'
+        try:
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump({"etag": etag, "datos": datos}, f, ensure_ascii=False)
+            os.replace(temporal, self.ruta_archivo)
+        except OSError as e:
+            print(f"⚠️ No se pudo guardar el índice de Data-campo {self.ruta_archivo}: {e}")
+
+    def refrescar(self) -> bool:
+        """
+        Vuelve a leer Data-campo y publica una nueva versión si el contenido cambió
+
+        Returns:
+            bool: True si el índice cambió
+        """
+        with self._lock_refresco:
+            return self._refrescar()
+
+    def _refrescar(self) -> bool:
+        filas = self.leer_filas()
+        datos = construir_jerarquia(filas[1:])  # Saltar encabezados
+        etag = calcular_etag(datos)
+        if etag == self._etag:
+            return False
+        self._publicar(datos, etag)
+        self._guardar_archivo(datos, etag)
+        print(f"🌳 Índice de Data-campo actualizado: {len(datos['empresa'])} empresas, {len(datos['lote'])} lotes")
+        return True
+
+    def obtener(self) -> Tuple[Dict[str, Any], str]:
+        """
+        Versión actual del índice (la construye si aún no existe)
+
+        Returns:
+            Tuple: (datos en el formato de /google-sheets/field-data, etag)
+        """
+        if self._datos is None:
+            with self._lock_refresco:
+                if self._datos is None:
+                    self._refrescar()
+        with self._lock:
+            return self._datos, self._etag
+
+    def fundos(self, empresa: str = None) -> List[str]:
+        """Fundos de una empresa (o todos si no se indica)"""
+        datos, _ = self.obtener()
+        return datos["fundo"] if not empresa else self._fundos_por_empresa.get(empresa, [])
+
+    def sectores(self, fundo: str = None) -> List[str]:
+        """Sectores de un fundo (o todos si no se indica)"""
+        datos, _ = self.obtener()
+        return datos["sector"] if not fundo else self._sectores_por_fundo.get(fundo, [])
+
+    def lotes(self, sector: str = None) -> List[str]:
+        """Lotes de un sector (o todos si no se indica)"""
+        datos, _ = self.obtener()
+        return datos["lote"] if not sector else self._lotes_por_sector.get(sector, [])
+
+    def iniciar(self):
+        """Arranca (una sola vez) el hilo de refresco en segundo plano"""
+        if self._hilo is not None:
+            return
+        self._hilo = threading.Thread(target=self._bucle, name="indice-jerarquia", daemon=True)
+        self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            try:
+                self.refrescar()
+            except Exception as e:
+                print(f"⚠️ Error refrescando el índice de Data-campo: {e}")
+            time.sleep(self.intervalo)
+
+
+_indices: Dict[str, IndiceJerarquia] = {}
+_lock_indices = threading.Lock()
+
+
+def obtener_indice(spreadsheet_id: str, leer_filas: Callable[[], List[List[str]]]) -> IndiceJerarquia:
+    """
+    Índice compartido por el proceso para una hoja de cálculo, con el refresco en segundo plano iniciado
+
+    Args:
+        spreadsheet_id: ID de la hoja de cálculo
+        leer_filas: Retorna las filas de Data-campo!B:I (solo se usa la primera vez)
+
+    Returns:
+        IndiceJerarquia: Índice de la hoja
+    """
+    with _lock_indices:
+        indice = _indices.get(spreadsheet_id)
+        if indice is None:
+            indice = IndiceJerarquia(leer_filas)
+            indice.iniciar()
+            _indices[spreadsheet_id] = indice
+        return indice
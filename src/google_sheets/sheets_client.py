@@ -6,8 +6,10 @@ Integración con Google Sheets para almacenar datos de procesamiento de imágene
 
 import os
 import json
+import sqlite3
+import time
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -16,9 +18,14 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import streamlit as st
 
+from .asignador_ids import AsignadorIds, max_id_numerico
+
 # Scopes necesarios para Google Sheets
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+# Segundos durante los que se confía en una verificación de encabezados ya hecha
+HEADERS_TTL_SEGUNDOS = float(os.getenv('SHEETS_HEADERS_TTL', 3600))
+
 class GoogleSheetsClient:
     """Cliente para interactuar con Google Sheets"""
     
@@ -28,6 +35,9 @@ class GoogleSheetsClient:
         self.service = None
         self.creds = None
         self.use_streamlit_secrets = False
+        self.asignador_ids = None  # Se crea al reservar el primer ID
+        # (spreadsheet_id, hoja) -> instante (monotonic) de la última verificación de encabezados
+        self._encabezados_verificados: Dict[Tuple[str, str], float] = {}
         
         # Intentar cargar desde Streamlit secrets primero (para producción)
         try:
@@ -209,6 +219,7 @@ class GoogleSheetsClient:
             ).execute()
             
             print("✅ Encabezados configurados correctamente")
+            self._encabezados_verificados[(spreadsheet_id, sheet_name or '')] = time.monotonic()
             return True
             
         except HttpError as e:
@@ -226,6 +237,11 @@ class GoogleSheetsClient:
         Returns:
             bool: True si los encabezados están correctos
         """
+        # Verificación reciente en caché: evita una lectura por cada registro agregado
+        verificado = self._encabezados_verificados.get((spreadsheet_id, sheet_name or ''))
+        if verificado is not None and time.monotonic() - verificado < HEADERS_TTL_SEGUNDOS:
+            return True
+        
         try:
             # Obtener encabezados actuales
             range_name = f"'{sheet_name}'!A1:S1" if sheet_name else 'A1:S1'
@@ -259,6 +275,7 @@ class GoogleSheetsClient:
             
             if matches == len(expected_headers):  # 100% de coincidencia exacta
                 print("✅ Encabezados ya están actualizados")
+                self._encabezados_verificados[(spreadsheet_id, sheet_name or '')] = time.monotonic()
                 return True
             else:
                 print(f"🔄 Solo {matches}/{len(expected_headers)} encabezados coinciden")
@@ -269,6 +286,21 @@ class GoogleSheetsClient:
             print(f"❌ Error verificando encabezados: {e}")
             return False
     
+    def invalidar_encabezados(self, spreadsheet_id: str = None, sheet_name: str = None):
+        """
+        Olvida verificaciones de encabezados en caché (todas, las de una hoja de cálculo o las de una hoja)
+        
+        Args:
+            spreadsheet_id: ID de la hoja de cálculo (None = todas)
+            sheet_name: Nombre de la hoja (None = todas las de la hoja de cálculo)
+        """
+        if spreadsheet_id is None:
+            self._encabezados_verificados.clear()
+            return
+        for clave in list(self._encabezados_verificados):
+            if clave[0] == spreadsheet_id and (sheet_name is None or clave[1] == sheet_name):
+                self._encabezados_verificados.pop(clave, None)
+    
     def force_update_headers(self, spreadsheet_id: str, sheet_name: str = None) -> bool:
         """
         Fuerza la actualización de los encabezados de la hoja
@@ -281,41 +313,103 @@ class GoogleSheetsClient:
             bool: True si se actualizaron correctamente
         """
         print("🔄 Forzando actualización de encabezados...")
+        self.invalidar_encabezados(spreadsheet_id, sheet_name or '')
         return self._setup_headers(spreadsheet_id, sheet_name)
     
-    def _get_next_id(self, spreadsheet_id: str, sheet_name: str = None) -> int:
+    def _leer_ids_hoja(self, spreadsheet_id: str, sheet_name: str = None) -> List[str]:
         """
-        Obtiene el siguiente ID secuencial
+        Lee solo la columna de IDs (A) de la hoja, sin límite de filas
         
         Args:
             spreadsheet_id: ID de la hoja de cálculo
             sheet_name: Nombre de la hoja
             
         Returns:
-            int: Siguiente ID disponible
+            List[str]: Valores de la columna ID (sin encabezado)
         """
-        try:
-            # Obtener registros existentes
-            records = self.get_processing_records(spreadsheet_id, limit=1000, sheet_name=sheet_name)
-            
-            if not records:
-                return 1
+        range_name = f"'{sheet_name}'!A2:A" if sheet_name else 'A2:A'
+        result = self.service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=range_name
+        ).execute()
+        return [fila[0] for fila in result.get('values', []) if fila]
+    
+    def reservar_ids(self, spreadsheet_id: str, sheet_name: str = None, cantidad: int = 1) -> int:
+        """
+        Reserva IDs secuenciales con el contador local (sin leer la hoja, salvo la primera vez)
+        
+        Args:
+            spreadsheet_id: ID de la hoja de cálculo
+            sheet_name: Nombre de la hoja
+            cantidad: Número de IDs consecutivos a reservar
             
-            # Encontrar el ID más alto
-            max_id = 0
-            for record in records:
-                try:
-                    record_id = int(record.get('id', 0))
-                    if record_id > max_id:
-                        max_id = record_id
-                except (ValueError, TypeError):
-                    continue
+        Returns:
+            int: Primer ID reservado
+        
+        Raises:
+            RuntimeError: Si el contador local no está disponible o no se pudo sembrar
+        """
+        def sembrar():
+            if self.service is None and not self.authenticate():
+                raise RuntimeError("No se pudo autenticar con Google Sheets para sembrar el contador de IDs")
+            return max_id_numerico(self._leer_ids_hoja(spreadsheet_id, sheet_name))
+        
+        try:
+            if self.asignador_ids is None:
+                self.asignador_ids = AsignadorIds()
+            return self.asignador_ids.reservar(f"{spreadsheet_id}/{sheet_name or ''}", sembrar, cantidad)
+        except sqlite3.Error as e:
+            # Sin el contador no se reserva nada: leer el máximo de la hoja y sumar uno
+            # entregaría el mismo ID a dos escrituras concurrentes
+            raise RuntimeError(f"Contador local de IDs no disponible: {e}") from e
+    
+    def _get_next_id(self, spreadsheet_id: str, sheet_name: str = None) -> int:
+        """
+        Obtiene (y reserva) el siguiente ID secuencial
+        
+        Args:
+            spreadsheet_id: ID de la hoja de cálculo
+            sheet_name: Nombre de la hoja
             
-            return max_id + 1
+        Returns:
+            int: Siguiente ID disponible
+        
+        Raises:
+            RuntimeError: Si no se pudo reservar el ID
+        """
+        return self.reservar_ids(spreadsheet_id, sheet_name)
+
+    def _record_a_fila(self, record: Dict[str, Any]) -> List[Any]:
+        """
+        Convierte un registro en la fila de 19 columnas de la hoja (incluyendo "Nombre Archivo")
+        
+        Args:
+            record: Diccionario con los datos del procesamiento
             
-        except Exception as e:
-            print(f"⚠️ Error obteniendo siguiente ID: {e}")
-            return 1
+        Returns:
+            List: Valores de la fila en el orden de los encabezados
+        """
+        return [
+            record.get('id', ''),
+            record.get('fecha', ''),
+            record.get('hora', ''),
+            record.get('imagen', ''),
+            record.get('nombre_archivo', record.get('imagen', '')),  # Nombre Archivo (usar imagen como fallback)
+            record.get('empresa', ''),
+            record.get('fundo', ''),
+            record.get('sector', ''),
+            record.get('lote', ''),
+            record.get('hilera') if record.get('hilera') is not None else '',  # Hilera puede ser null
+            record.get('numero_planta') if record.get('numero_planta') is not None else '',  # N° Planta puede ser null
+            record.get('latitud', ''),
+            record.get('longitud', ''),
+            record.get('porcentaje_luz', ''),
+            record.get('porcentaje_sombra', ''),
+            record.get('dispositivo', ''),
+            record.get('software', ''),
+            record.get('direccion', ''),
+            record.get('timestamp', '')
+        ]
 
     def add_processing_record(self, spreadsheet_id: str, record: Dict[str, Any], sheet_name: str = None) -> bool:
         """
@@ -329,44 +423,49 @@ class GoogleSheetsClient:
         Returns:
             bool: True si se agregó correctamente
         """
+        return self.add_processing_records(spreadsheet_id, [record], sheet_name)
+    
+    def add_processing_records(self, spreadsheet_id: str, records: List[Dict[str, Any]], sheet_name: str = None) -> bool:
+        """
+        Agrega varios registros de procesamiento con una sola llamada `append`
+        
+        Args:
+            spreadsheet_id: ID de la hoja de cálculo
+            records: Lista de diccionarios con los datos de cada procesamiento
+            sheet_name: Nombre de la hoja (opcional, por defecto usa 'Procesamientos')
+            
+        Returns:
+            bool: True si se agregaron correctamente
+        """
+        if not records:
+            return True
+        
         try:
             # Verificar y actualizar encabezados si es necesario
             self.ensure_headers_updated(spreadsheet_id, sheet_name)
             
-            # Generar ID automáticamente si no se proporciona
-            if not record.get('id') or record.get('id') == '':
-                next_id = self._get_next_id(spreadsheet_id, sheet_name)
-                record['id'] = str(next_id)
-                print(f"🆔 ID generado automáticamente: {next_id}")
-            
-            # Preparar datos para la fila (19 columnas, incluyendo "Nombre Archivo")
-            row_data = [
-                record.get('id', ''),
-                record.get('fecha', ''),
-                record.get('hora', ''),
-                record.get('imagen', ''),
-                record.get('nombre_archivo', record.get('imagen', '')),  # Nombre Archivo (usar imagen como fallback)
-                record.get('empresa', ''),
-                record.get('fundo', ''),
-                record.get('sector', ''),
-                record.get('lote', ''),
-                record.get('hilera') if record.get('hilera') is not None else '',  # Hilera puede ser null
-                record.get('numero_planta') if record.get('numero_planta') is not None else '',  # N° Planta puede ser null
-                record.get('latitud', ''),
-                record.get('longitud', ''),
-                record.get('porcentaje_luz', ''),
-                record.get('porcentaje_sombra', ''),
-                record.get('dispositivo', ''),
-                record.get('software', ''),
-                record.get('direccion', ''),
-                record.get('timestamp', '')
-            ]
+            # Generar IDs automáticamente para los registros que no lo traen
+            # (un solo rango reservado para todo el lote)
+            sin_id = [record for record in records if not record.get('id')]
+            if sin_id:
+                try:
+                    next_id = self.reservar_ids(spreadsheet_id, sheet_name, len(sin_id))
+                except Exception as e:
+                    # No se escriben filas con un ID que podría estar en uso
+                    print(f"❌ Error obteniendo siguiente ID, registros no agregados: {e}")
+                    return False
+                for record in sin_id:
+                    record['id'] = str(next_id)
+                    print(f"🆔 ID generado automáticamente: {next_id}")
+                    next_id += 1
+            
+            rows = [self._record_a_fila(record) for record in records]
             
-            print(f"📋 Datos de fila a insertar: {row_data}")
-            print(f"📊 Número de columnas: {len(row_data)}")
+            print(f"📋 Filas a insertar: {len(rows)}")
+            print(f"📊 Número de columnas: {len(rows[0])}")
             
             body = {
-                'values': [row_data]
+                'values': rows
             }
             
             # Usar el nombre de la hoja especificado o el por defecto
@@ -380,11 +479,12 @@ class GoogleSheetsClient:
                 body=body
             ).execute()
             
-            print(f"✅ Registro agregado: {record.get('imagen', 'N/A')}")
+            for record in records:
+                print(f"✅ Registro agregado: {record.get('imagen', 'N/A')}")
             return True
             
         except HttpError as e:
-            print(f"❌ Error agregando registro: {e}")
+            print(f"❌ Error agregando registros: {e}")
             return False
     
     def get_sheet_data(self, sheet_name: str) -> List[List[str]]:
@@ -521,6 +621,49 @@ class GoogleSheetsClient:
             print(f"❌ Error obteniendo registros: {e}")
             return []
     
+    def leer_filas(self, spreadsheet_id: str, sheet_name: str, fila_inicial: int) -> List[List[str]]:
+        """
+        Lee las filas (columnas A:S) desde `fila_inicial` hasta el final de la hoja.
+        Lo usa el espejo local para traer solo las filas agregadas desde la última sincronización.
+        
+        Args:
+            spreadsheet_id: ID de la hoja de cálculo
+            sheet_name: Nombre de la hoja
+            fila_inicial: Número de fila (1 = encabezados)
+            
+        Returns:
+            List[List[str]]: Filas leídas (las filas vacías intermedias vienen como listas vacías)
+        """
+        if self.service is None and not self.authenticate():
+            raise RuntimeError("No se pudo autenticar con Google Sheets")
+        
+        range_name = f"'{sheet_name}'!A{fila_inicial}:S" if sheet_name else f'A{fila_inicial}:S'
+        result = self.service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=range_name
+        ).execute()
+        return result.get('values', [])
+    
+    def leer_datos_campo(self, spreadsheet_id: str = None) -> List[List[str]]:
+        """
+        Lee Data-campo!B:I (Empresa ... Lote), incluyendo la fila de encabezados.
+        Es la fuente del índice jerárquico de los dropdowns.
+        
+        Args:
+            spreadsheet_id: ID de la hoja de cálculo (por defecto el configurado)
+            
+        Returns:
+            List[List[str]]: Filas leídas
+        """
+        if self.service is None and not self.authenticate():
+            raise RuntimeError("No se pudo autenticar con Google Sheets")
+        
+        result = self.service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id or self.spreadsheet_id,
+            range='Data-campo!B:I'
+        ).execute()
+        return result.get('values', [])
+    
     def get_spreadsheet_url(self, spreadsheet_id: str) -> str:
         """
         Obtiene la URL de la hoja de cálculo
@@ -4,5 +4,9 @@ Basado en: https://github.com/ozgecinko/image-metadata-extractor
 """
 
 from .gps_extractor import GPSMetadataExtractor
+from .lector_exif import DatosExif, leer_exif
+from .geocodificacion import GeocodificadorInverso, IndiceGeografico, obtener_geocodificador
+from .parcelas import IndiceParcelas, obtener_indice_parcelas
 
-__all__ = ['GPSMetadataExtractor']
+__all__ = ['GPSMetadataExtractor', 'DatosExif', 'leer_exif', 'GeocodificadorInverso', 'IndiceGeografico', 'obtener_geocodificador',
+           'IndiceParcelas', 'obtener_indice_parcelas']
@@ -0,0 +1,220 @@
+"""
+Geocodificación inversa local.
+
+Resuelve coordenadas GPS a empresa/fundo/sector/lote/dirección con un KD-tree construido
+a partir de un gazetteer CSV (centroides de los lotes/sectores del campo), sin llamadas
+de red. Solo si el punto cae fuera de todos los lugares conocidos se consulta el servicio
+remoto (Nominatim), con una caché LRU acotada indexada por coordenadas redondeadas.
+
+Formato del gazetteer (CSV con encabezados): latitud, longitud y, opcionalmente,
+empresa, fundo, sector, lote, direccion.
+
+Configuración por variables de entorno:
+- GEOCODIFICACION_GAZETTEER: ruta del CSV (por defecto gazetteer_campo.csv)
+- GEOCODIFICACION_RADIO_METROS: distancia máxima a un centroide para aceptarlo (por defecto 1500)
+- GEOCODIFICACION_REMOTA: "0" para no consultar nunca el servicio remoto
+- GEOCODIFICACION_CACHE: entradas de la caché LRU del servicio remoto (por defecto 4096)
+"""
+
+import csv
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+RADIO_TIERRA_METROS = 6371008.8
+
+CAMPOS_LUGAR = ['empresa', 'fundo', 'sector', 'lote', 'direccion']
+
+
+def _a_cartesianas(latitudes, longitudes) -> np.ndarray:
+    """Coordenadas en la esfera unitaria: la distancia euclidiana es la cuerda entre puntos"""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def _cuerda_a_metros(cuerda):
+    return 2.0 * RADIO_TIERRA_METROS * np.arcsin(np.clip(cuerda / 2.0, 0.0, 1.0))
+
+
+def _metros_a_cuerda(metros: float) -> float:
+    return 2.0 * np.sin(metros / (2.0 * RADIO_TIERRA_METROS))
+
+
+def describir_lugar(lugar: Dict[str, Any]) -> str:
+    """Dirección del lugar; si el gazetteer no la trae, se arma con la jerarquía del campo"""
+    if lugar.get('direccion'):
+        return lugar['direccion']
+    partes = [
+        f"{etiqueta} {lugar[campo]}"
+        for campo, etiqueta in (('lote', 'Lote'), ('sector', 'Sector'), ('fundo', 'Fundo'), ('empresa', 'Empresa'))
+        if lugar.get(campo)
+    ]
+    return ", ".join(partes)
+
+
+class IndiceGeografico:
+    """KD-tree de lugares conocidos del campo (centroides con su jerarquía)"""
+
+    def __init__(self, lugares: List[Dict[str, Any]]):
+        """
+        Args:
+            lugares: Diccionarios con 'latitud', 'longitud' y los campos de CAMPOS_LUGAR
+        """
+        self.lugares = lugares
+        puntos = _a_cartesianas(
+            [lugar['latitud'] for lugar in lugares], [lugar['longitud'] for lugar in lugares]
+        ) if lugares else np.empty((0, 3))
+        self._arbol = cKDTree(puntos) if lugares else None
+
+    @classmethod
+    def desde_csv(cls, ruta: str) -> 'IndiceGeografico':
+        """Carga el gazetteer; las filas sin coordenadas válidas se ignoran"""
+        lugares = []
+        with open(ruta, 'r', encoding='utf-8-sig', newline='') as f:
+            for fila in csv.DictReader(f):
+                try:
+                    latitud = float(fila['latitud'])
+                    longitud = float(fila['longitud'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                lugar = {'latitud': latitud, 'longitud': longitud}
+                lugar.update({campo: (fila.get(campo) or '').strip() for campo in CAMPOS_LUGAR})
+                lugares.append(lugar)
+        print(f"✅ Gazetteer cargado: {len(lugares)} lugares desde {ruta}")
+        return cls(lugares)
+
+    def __len__(self) -> int:
+        return len(self.lugares)
+
+    def buscar(self, latitud: float, longitud: float, radio_metros: float) -> Optional[Dict[str, Any]]:
+        """
+        Lugar conocido más cercano dentro del radio
+
+        Returns:
+            Dict con los campos del lugar y 'distancia_metros', o None
+        """
+        return self.buscar_lote([latitud], [longitud], radio_metros)[0]
+
+    def buscar_lote(self, latitudes, longitudes, radio_metros: float) -> List[Optional[Dict[str, Any]]]:
+        """Versión vectorizada de `buscar` para muchas coordenadas a la vez"""
+        if self._arbol is None:
+            return [None] * len(latitudes)
+        cuerdas, indices = self._arbol.query(
+            _a_cartesianas(latitudes, longitudes), k=1, distance_upper_bound=_metros_a_cuerda(radio_metros)
+        )
+        distancias = _cuerda_a_metros(cuerdas)
+        resultados = []
+        for indice, distancia in zip(indices.tolist(), distancias.tolist()):
+            if indice >= len(self.lugares):  # Ningún lugar dentro del radio
+                resultados.append(None)
+                continue
+            lugar = dict(self.lugares[indice])
+            lugar['distancia_metros'] = round(distancia, 1)
+            resultados.append(lugar)
+        return resultados
+
+
+class CacheLRU:
+    """Caché LRU acotada y segura entre hilos"""
+
+    def __init__(self, max_entradas: int):
+        self.max_entradas = max_entradas
+        self._datos: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, defecto=None):
+        with self._lock:
+            if clave not in self._datos:
+                return defecto
+            self._datos.move_to_end(clave)
+            return self._datos[clave]
+
+    def guardar(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = valor
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+
+class GeocodificadorInverso:
+    """Índice local primero; servicio remoto con caché LRU solo como respaldo"""
+
+    def __init__(self, indice: Optional[IndiceGeografico] = None,
+                 geocodificar_remoto: Optional[Callable[[float, float], Optional[str]]] = None,
+                 radio_metros: float = None, max_cache: int = None, decimales_cache: int = 4):
+        """
+        Args:
+            indice: Índice de lugares conocidos (None = solo remoto)
+            geocodificar_remoto: Función (lat, lon) -> dirección (None = sin respaldo remoto)
+            radio_metros: Distancia máxima para aceptar un lugar del índice
+            max_cache: Entradas de la caché del servicio remoto
+            decimales_cache: Decimales de redondeo de la clave (4 ≈ 11 m)
+        """
+        self.indice = indice
+        self.geocodificar_remoto = geocodificar_remoto
+        self.radio_metros = radio_metros or float(os.getenv('GEOCODIFICACION_RADIO_METROS', 1500))
+        self.decimales_cache = decimales_cache
+        self._cache = CacheLRU(max_cache or int(os.getenv('GEOCODIFICACION_CACHE', 4096)))
+
+    def resolver(self, latitud: float, longitud: float) -> Optional[Dict[str, Any]]:
+        """
+        Resuelve una coordenada
+
+        Returns:
+            Dict con 'direccion', 'fuente' ('local' o 'remoto') y, si es local, la jerarquía
+            del campo y 'distancia_metros'; None si no se pudo resolver
+        """
+        if self.indice is not None:
+            lugar = self.indice.buscar(latitud, longitud, self.radio_metros)
+            if lugar is not None:
+                lugar['direccion'] = describir_lugar(lugar)
+                lugar['fuente'] = 'local'
+                return lugar
+
+        if self.geocodificar_remoto is None:
+            return None
+
+        clave = (round(latitud, self.decimales_cache), round(longitud, self.decimales_cache))
+        direccion = self._cache.obtener(clave)
+        if direccion is None:
+            direccion = self.geocodificar_remoto(*clave)
+            if direccion is None:
+                return None  # Los fallos no se guardan: se reintenta en la próxima consulta
+            self._cache.guardar(clave, direccion)
+        return {'direccion': direccion, 'fuente': 'remoto'}
+
+
+_geocodificador: Optional[GeocodificadorInverso] = None
+_lock_geocodificador = threading.Lock()
+
+
+def obtener_geocodificador(geocodificar_remoto: Callable[[float, float], Optional[str]] = None
+                           ) -> GeocodificadorInverso:
+    """
+    Geocodificador compartido por el proceso (carga el gazetteer una sola vez)
+
+    Args:
+        geocodificar_remoto: Respaldo remoto; solo se usa al crear el geocodificador
+            y se ignora si GEOCODIFICACION_REMOTA=0
+    """
+    global _geocodificador
+    with _lock_geocodificador:
+        if _geocodificador is None:
+            ruta = os.getenv('GEOCODIFICACION_GAZETTEER', 'gazetteer_campo.csv')
+            indice = None
+            if os.path.exists(ruta):
+                try:
+                    indice = IndiceGeografico.desde_csv(ruta)
+                except (OSError, csv.Error) as e:
+                    print(f"⚠️ No se pudo cargar el gazetteer {ruta}: {e}")
+            if os.getenv('GEOCODIFICACION_REMOTA', '1') == '0':
+                geocodificar_remoto = None
+            _geocodificador = GeocodificadorInverso(indice, geocodificar_remoto)
+        return _geocodificador
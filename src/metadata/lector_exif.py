@@ -0,0 +1,224 @@
+"""
+Lector rápido de EXIF/GPS.
+
+Lee solo la cabecera de la imagen: recorre los segmentos del JPEG hasta el APP1 "Exif"
+(o el chunk eXIf de un PNG) sin decodificar píxeles ni leer el resto del archivo, y
+recorre una sola vez los IFD de TIFF (IFD0, Exif y GPS) para armar los diccionarios
+nombre -> valor. El resultado es un registro compacto (`DatosExif`) con fecha, GPS y
+dispositivo ya convertidos.
+
+Es la única ruta de lectura de GPS: la usan el extractor de metadatos de la API y
+la página de Streamlit.
+"""
+
+import io
+import struct
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, NamedTuple, Optional, Union
+
+from PIL.ExifTags import GPSTAGS, TAGS
+
+# Punteros a sub-IFD dentro de IFD0
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+# Bloques propietarios sin interés y potencialmente grandes
+TAGS_IGNORADOS = {0x927C, 0x02BC, 0x83BB, 0x8773}  # MakerNote, XMP, IPTC, ICC
+# Valores UNDEFINED más largos que esto no se copian
+MAX_BYTES_INDEFINIDO = 256
+
+# tipo TIFF -> (bytes por componente, formato struct)
+TIPOS_TIFF = {
+    1: (1, 'B'), 2: (1, 's'), 3: (2, 'H'), 4: (4, 'L'), 5: (8, 'LL'), 6: (1, 'b'),
+    7: (1, 's'), 8: (2, 'h'), 9: (4, 'l'), 10: (8, 'll'), 11: (4, 'f'), 12: (8, 'd'),
+}
+
+FORMATOS_FECHA = ["%Y:%m:%d %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S"]
+
+CAMPOS_DISPOSITIVO = {
+    'Make': 'fabricante',
+    'Model': 'modelo',
+    'Software': 'software',
+    'ImageWidth': 'ancho',
+    'ImageLength': 'alto'
+}
+
+
+class DatosExif(NamedTuple):
+    """Metadatos de una imagen ya convertidos"""
+    fecha_tomada: Optional[datetime] = None
+    latitud: Optional[float] = None
+    longitud: Optional[float] = None
+    altitud: Optional[float] = None
+    dispositivo: Dict[str, str] = {}
+    tags: Dict[str, Any] = {}   # IFD0 + Exif, por nombre
+    gps: Dict[str, Any] = {}    # IFD GPS, por nombre
+
+    @property
+    def tiene_gps(self) -> bool:
+        return self.latitud is not None and self.longitud is not None
+
+
+def _tiff_de_jpeg(f: BinaryIO) -> Optional[bytes]:
+    """Contenido TIFF del segmento APP1 Exif; se detiene en el inicio de los datos de imagen"""
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        if f.read(1) != b'\xff':
+            return None
+        marcador = f.read(1)
+        while marcador == b'\xff':  # Relleno entre segmentos
+            marcador = f.read(1)
+        if not marcador or marcador in (b'\xda', b'\xd9'):  # SOS / EOI: no hay más cabeceras
+            return None
+        if marcador[0] == 0x01 or 0xD0 <= marcador[0] <= 0xD7:  # Marcadores sin longitud
+            continue
+        largo = f.read(2)
+        if len(largo) < 2:
+            return None
+        largo = struct.unpack('>H', largo)[0] - 2
+        if marcador == b'\xe1':
+            datos = f.read(largo)
+            if datos.startswith(b'Exif\x00\x00'):
+                return datos[6:]
+        else:
+            f.seek(largo, io.SEEK_CUR)
+
+
+def _tiff_de_png(f: BinaryIO) -> Optional[bytes]:
+    """Contenido del chunk eXIf de un PNG; se detiene en el primer IDAT"""
+    if f.read(8) != b'\x89PNG\r\n\x1a\n':
+        return None
+    while True:
+        cabecera = f.read(8)
+        if len(cabecera) < 8:
+            return None
+        largo, tipo = struct.unpack('>I4s', cabecera)
+        if tipo == b'eXIf':
+            return f.read(largo)
+        if tipo in (b'IDAT', b'IEND'):
+            return None
+        f.seek(largo + 4, io.SEEK_CUR)  # Datos + CRC
+
+
+def _leer_ifd(tiff: bytes, orden: str, offset: int, nombres: Dict[int, str],
+              punteros: Dict[int, int] = None) -> Dict[str, Any]:
+    """
+    Entradas de un IFD como {nombre: valor}
+
+    Args:
+        punteros: Si se pasa, recibe los offsets de los sub-IFD Exif y GPS
+    """
+    valores: Dict[str, Any] = {}
+    (cantidad,) = struct.unpack_from(orden + 'H', tiff, offset)
+    for i in range(cantidad):
+        tag, tipo, componentes, valor = struct.unpack_from(orden + 'HHI4s', tiff, offset + 2 + 12 * i)
+        if tag in (TAG_EXIF_IFD, TAG_GPS_IFD) and punteros is not None:
+            punteros[tag] = struct.unpack(orden + 'I', valor)[0]
+            continue
+        if tag in TAGS_IGNORADOS or tipo not in TIPOS_TIFF:
+            continue
+        tamano, formato = TIPOS_TIFF[tipo]
+        total = tamano * componentes
+        if tipo == 7 and total > MAX_BYTES_INDEFINIDO:
+            continue
+        if total <= 4:
+            datos = valor[:total]
+        else:
+            inicio = struct.unpack(orden + 'I', valor)[0]
+            datos = tiff[inicio:inicio + total]
+            if len(datos) < total:
+                continue  # Offset fuera del bloque: entrada corrupta
+
+        if tipo == 2:
+            dato = datos.split(b'\x00', 1)[0].decode('utf-8', errors='replace').strip()
+        elif tipo == 7:
+            dato = datos
+        else:
+            numeros = struct.unpack(orden + formato * componentes, datos)
+            if tipo in (5, 10):  # Racionales: pares numerador/denominador
+                numeros = tuple(
+                    numeros[j] / numeros[j + 1] if numeros[j + 1] else 0.0 for j in range(0, len(numeros), 2)
+                )
+            dato = numeros[0] if len(numeros) == 1 else numeros
+        valores[nombres.get(tag, tag)] = dato
+    return valores
+
+
+def _grados(dms, referencia) -> Optional[float]:
+    """(grados, minutos, segundos) + referencia N/S/E/W -> grados decimales"""
+    if not isinstance(dms, tuple) or len(dms) != 3:
+        return None
+    decimal = dms[0] + dms[1] / 60.0 + dms[2] / 3600.0
+    return -decimal if referencia in ('S', 'W') else decimal
+
+
+def _fecha(tags: Dict[str, Any]) -> Optional[datetime]:
+    for nombre in ('DateTimeOriginal', 'DateTime', 'DateTimeDigitized'):
+        texto = tags.get(nombre)
+        if not texto:
+            continue
+        for formato in FORMATOS_FECHA:
+            try:
+                return datetime.strptime(texto, formato)
+            except ValueError:
+                continue
+    return None
+
+
+def leer_exif(origen: Union[bytes, bytearray, memoryview, str, BinaryIO]) -> DatosExif:
+    """
+    Lee los metadatos EXIF de la cabecera de una imagen JPEG o PNG
+
+    Args:
+        origen: Bytes de la imagen, ruta del archivo o archivo abierto en modo binario
+            (de un archivo solo se leen los segmentos anteriores a los datos de imagen)
+
+    Returns:
+        DatosExif: Registro vacío si la imagen no tiene EXIF o está dañado
+    """
+    if isinstance(origen, str):
+        with open(origen, 'rb') as f:
+            return leer_exif(f)
+    f = io.BytesIO(origen) if isinstance(origen, (bytes, bytearray, memoryview)) else origen
+
+    inicio = f.tell()
+    tiff = _tiff_de_jpeg(f)
+    if tiff is None:
+        f.seek(inicio)
+        tiff = _tiff_de_png(f)
+    if not tiff or tiff[:2] not in (b'II', b'MM'):
+        return DatosExif(dispositivo={}, tags={}, gps={})
+
+    orden = '<' if tiff[:2] == b'II' else '>'
+    tags: Dict[str, Any] = {}
+    gps: Dict[str, Any] = {}
+    try:
+        punteros: Dict[int, int] = {}
+        tags = _leer_ifd(tiff, orden, struct.unpack_from(orden + 'I', tiff, 4)[0], TAGS, punteros)
+        if TAG_EXIF_IFD in punteros:
+            tags.update(_leer_ifd(tiff, orden, punteros[TAG_EXIF_IFD], TAGS))
+        if TAG_GPS_IFD in punteros:
+            gps = _leer_ifd(tiff, orden, punteros[TAG_GPS_IFD], GPSTAGS)
+    except struct.error as e:
+        # EXIF truncado: se conserva lo que se alcanzó a leer
+        print(f"⚠️ EXIF incompleto: {e}")
+
+    altitud = gps.get('GPSAltitude')
+    if isinstance(altitud, float) and gps.get('GPSAltitudeRef') in (1, b'\x01'):  # Bajo el nivel del mar
+        altitud = -altitud
+
+    dispositivo = {clave: str(tags[tag]) for tag, clave in CAMPOS_DISPOSITIVO.items() if tag in tags}
+    if 'ancho' not in dispositivo and 'ExifImageWidth' in tags:
+        dispositivo['ancho'] = str(tags['ExifImageWidth'])
+    if 'alto' not in dispositivo and 'ExifImageHeight' in tags:
+        dispositivo['alto'] = str(tags['ExifImageHeight'])
+
+    return DatosExif(
+        fecha_tomada=_fecha(tags),
+        latitud=_grados(gps.get('GPSLatitude'), gps.get('GPSLatitudeRef')),
+        longitud=_grados(gps.get('GPSLongitude'), gps.get('GPSLongitudeRef')),
+        altitud=altitud if isinstance(altitud, float) else None,
+        dispositivo=dispositivo,
+        tags=tags,
+        gps=gps
+    )
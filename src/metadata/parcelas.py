@@ -0,0 +1,239 @@
+"""
+Asignación de fotos a lote/hilera por sus coordenadas GPS.
+
+Los polígonos de lotes e hileras se cargan desde un archivo GeoJSON local
+(FeatureCollection de Polygon/MultiPolygon; coordenadas [longitud, latitud]) con las
+propiedades empresa, fundo, sector, lote y, opcionalmente, hilera. Se indexan en una
+grilla uniforme (celda -> polígonos cuyo rectángulo la toca) y la prueba punto-en-polígono
+se evalúa vectorizada con NumPy sobre todos los puntos candidatos de cada polígono, así
+que asignar miles de fotos de un vuelo es una sola llamada.
+
+Si un punto cae en varios polígonos (una hilera dentro de su lote) gana el más específico,
+el de menor rectángulo envolvente.
+
+Configuración por variables de entorno:
+- PARCELAS_ARCHIVO: ruta del GeoJSON (por defecto parcelas_campo.geojson)
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+CAMPOS_PARCELA = ['empresa', 'fundo', 'sector', 'lote', 'hilera']
+
+# Pares (punto, arista) evaluados a la vez en la prueba punto-en-polígono
+MAX_PARES_BLOQUE = 2_000_000
+
+
+def _anillos(geometria: Dict[str, Any]) -> List[np.ndarray]:
+    """Anillos (exteriores y huecos) de un Polygon o MultiPolygon como arreglos (n, 2)"""
+    tipo = geometria.get('type')
+    if tipo == 'Polygon':
+        poligonos = [geometria['coordinates']]
+    elif tipo == 'MultiPolygon':
+        poligonos = geometria['coordinates']
+    else:
+        return []
+    return [
+        np.asarray(anillo, dtype=np.float64)[:, :2]
+        for poligono in poligonos for anillo in poligono if len(anillo) >= 3
+    ]
+
+
+def puntos_en_poligono(xs: np.ndarray, ys: np.ndarray, aristas: np.ndarray) -> np.ndarray:
+    """
+    Prueba punto-en-polígono (regla par-impar) vectorizada
+
+    Args:
+        xs, ys: Coordenadas de los puntos
+        aristas: Arreglo (m, 4) con x1, y1, x2, y2 de todas las aristas del polígono;
+            con la regla par-impar los huecos y las partes de un MultiPolygon salen solos
+
+    Returns:
+        np.ndarray: Máscara booleana, True si el punto está dentro
+    """
+    x1, y1, x2, y2 = (aristas[:, i] for i in range(4))
+    dentro = np.zeros(len(xs), dtype=bool)
+    paso = max(1, MAX_PARES_BLOQUE // max(len(aristas), 1))
+    for inicio in range(0, len(xs), paso):
+        px = xs[inicio:inicio + paso, None]
+        py = ys[inicio:inicio + paso, None]
+        cruza = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_corte = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        cruces = np.count_nonzero(cruza & (px < x_corte), axis=1)
+        dentro[inicio:inicio + paso] = (cruces & 1).astype(bool)
+    return dentro
+
+
+class IndiceParcelas:
+    """Polígonos de lotes/hileras indexados en una grilla uniforme"""
+
+    def __init__(self, parcelas: List[Dict[str, Any]], anillos: List[List[np.ndarray]],
+                 tamano_celda: float = None):
+        """
+        Args:
+            parcelas: Propiedades de cada polígono (campos de CAMPOS_PARCELA)
+            anillos: Anillos de cada polígono, en el mismo orden que `parcelas`
+            tamano_celda: Lado de la celda en grados (por defecto, la mediana del
+                tamaño de los polígonos)
+        """
+        self.parcelas = parcelas
+        self._aristas = [
+            np.vstack([np.hstack((anillo, np.roll(anillo, -1, axis=0))) for anillo in partes])
+            for partes in anillos
+        ]
+        cajas = np.array([
+            [a[:, 0].min(), a[:, 1].min(), a[:, 0].max(), a[:, 1].max()]
+            for a in (np.vstack(partes) for partes in anillos)
+        ]).reshape(-1, 4)
+        # Un polígono contenido en otro tiene también un rectángulo envolvente menor
+        self._areas = (cajas[:, 2] - cajas[:, 0]) * (cajas[:, 3] - cajas[:, 1])
+
+        if tamano_celda is None:
+            lados = np.maximum(cajas[:, 2] - cajas[:, 0], cajas[:, 3] - cajas[:, 1]) if len(cajas) else []
+            tamano_celda = float(np.median(lados)) if len(lados) else 1.0
+        self.tamano_celda = tamano_celda or 1e-4
+
+        self._celdas: Dict[tuple, List[int]] = {}
+        for indice, (xmin, ymin, xmax, ymax) in enumerate(cajas):
+            for cx in range(int(np.floor(xmin / self.tamano_celda)), int(np.floor(xmax / self.tamano_celda)) + 1):
+                for cy in range(int(np.floor(ymin / self.tamano_celda)), int(np.floor(ymax / self.tamano_celda)) + 1):
+                    self._celdas.setdefault((cx, cy), []).append(indice)
+
+    @classmethod
+    def desde_geojson(cls, ruta: str) -> 'IndiceParcelas':
+        """Carga los polígonos de un GeoJSON; las geometrías que no son polígonos se ignoran"""
+        with open(ruta, 'r', encoding='utf-8') as f:
+            coleccion = json.load(f)
+
+        parcelas, anillos = [], []
+        for feature in coleccion.get('features', []):
+            partes = _anillos(feature.get('geometry') or {})
+            if not partes:
+                continue
+            propiedades = feature.get('properties') or {}
+            parcelas.append({
+                campo: str(propiedades.get(campo) or '').strip() for campo in CAMPOS_PARCELA
+            })
+            anillos.append(partes)
+
+        print(f"✅ Parcelas cargadas: {len(parcelas)} polígonos desde {ruta}")
+        return cls(parcelas, anillos)
+
+    def __len__(self) -> int:
+        return len(self.parcelas)
+
+    def asignar(self, latitudes: Sequence[float], longitudes: Sequence[float]) -> List[Optional[Dict[str, str]]]:
+        """
+        Parcela de cada coordenada
+
+        Args:
+            latitudes, longitudes: Coordenadas de las fotos (None/NaN si no tienen GPS)
+
+        Returns:
+            List: Propiedades de la parcela más específica que contiene cada punto, o None
+        """
+        ys = np.asarray(latitudes, dtype=np.float64).reshape(-1)
+        xs = np.asarray(longitudes, dtype=np.float64).reshape(-1)
+        mejor = np.full(len(xs), -1, dtype=np.int64)
+        if not self.parcelas or len(xs) == 0:
+            return [None] * len(xs)
+
+        validos = np.flatnonzero(np.isfinite(xs) & np.isfinite(ys))
+        celdas_x = np.floor(xs[validos] / self.tamano_celda).astype(np.int64)
+        celdas_y = np.floor(ys[validos] / self.tamano_celda).astype(np.int64)
+
+        # Pares (punto, polígono candidato) agrupados por polígono
+        candidatos: Dict[int, List[np.ndarray]] = {}
+        celdas, inverso = np.unique(np.column_stack((celdas_x, celdas_y)), axis=0, return_inverse=True)
+        inverso = inverso.reshape(-1)
+        orden = np.argsort(inverso, kind='stable')
+        limites = np.searchsorted(inverso[orden], np.arange(len(celdas) + 1))
+        for k, (cx, cy) in enumerate(celdas.tolist()):
+            poligonos = self._celdas.get((cx, cy))
+            if not poligonos:
+                continue
+            puntos = validos[orden[limites[k]:limites[k + 1]]]
+            for poligono in poligonos:
+                candidatos.setdefault(poligono, []).append(puntos)
+
+        # Se recorren los polígonos de mayor a menor tamaño: el último que contiene el punto gana
+        for poligono in sorted(candidatos, key=lambda p: -self._areas[p]):
+            puntos = np.concatenate(candidatos[poligono])
+            dentro = puntos_en_poligono(xs[puntos], ys[puntos], self._aristas[poligono])
+            mejor[puntos[dentro]] = poligono
+
+        return [dict(self.parcelas[p]) if p >= 0 else None for p in mejor.tolist()]
+
+    def asignar_uno(self, latitud: float, longitud: float) -> Optional[Dict[str, str]]:
+        """Parcela de una sola coordenada"""
+        return self.asignar([latitud], [longitud])[0]
+
+
+_indice: Optional[IndiceParcelas] = None
+_lock_indice = threading.Lock()
+
+
+def obtener_indice_parcelas() -> Optional[IndiceParcelas]:
+    """
+    Índice de parcelas compartido por el proceso
+
+    Returns:
+        IndiceParcelas, o None si no hay archivo de polígonos (o no se pudo leer)
+    """
+    global _indice
+    with _lock_indice:
+        if _indice is None:
+            ruta = os.getenv('PARCELAS_ARCHIVO', 'parcelas_campo.geojson')
+            if not os.path.exists(ruta):
+                return None
+            try:
+                _indice = IndiceParcelas.desde_geojson(ruta)
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                print(f"⚠️ No se pudo cargar el archivo de parcelas {ruta}: {e}")
+                return None
+        return _indice
+
+
+def _normalizar_campo(valor: Any) -> str:
+    return str(valor).strip().casefold() if valor is not None else ''
+
+
+def conflictos_ubicacion(registro: Dict[str, Any], parcela: Dict[str, str]) -> List[str]:
+    """
+    Campos de ubicación en que el registro y la parcela tienen valores distintos (no vacíos)
+
+    Returns:
+        List[str]: Campos en conflicto, en el orden de CAMPOS_PARCELA
+    """
+    return [
+        campo for campo in CAMPOS_PARCELA
+        if _normalizar_campo(registro.get(campo)) and _normalizar_campo(parcela.get(campo))
+        and _normalizar_campo(registro.get(campo)) != _normalizar_campo(parcela.get(campo))
+    ]
+
+
+def completar_ubicacion(registro: Dict[str, Any], parcela: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    Completa los campos de ubicación vacíos de un registro con los de su parcela
+
+    Los valores ingresados por el usuario tienen prioridad: solo se llenan los vacíos, y
+    solo si todos los ingresados coinciden con la parcela. Si alguno difiere (ej. otro
+    lote), el GPS no corresponde a la ubicación indicada y el registro no se modifica,
+    para no mezclar niveles de parcelas distintas.
+    """
+    if not parcela:
+        return registro
+    conflictos = conflictos_ubicacion(registro, parcela)
+    if conflictos:
+        detalle = ", ".join(f"{campo}={registro.get(campo)!r} vs {parcela.get(campo)!r}" for campo in conflictos)
+        print(f"⚠️ La ubicación ingresada no coincide con la parcela por GPS ({detalle}); no se completa")
+        return registro
+    for campo in CAMPOS_PARCELA:
+        if not registro.get(campo) and parcela.get(campo):
+            registro[campo] = parcela[campo]
+    return registro
@@ -0,0 +1,58 @@
+from statistics import NormalDist
+
+import numpy as np
+
+# Nivel de confianza por defecto de los intervalos de los porcentajes
+CONFIANZA = 0.95
+
+def valor_z(confianza=CONFIANZA):
+    """
+    Cuantil de la normal estándar para un intervalo bilateral (1.96 con 95%).
+    """
+    return NormalDist().inv_cdf(0.5 + confianza / 2)
+
+def intervalo_wilson(exitos, n, confianza=CONFIANZA, poblacion=None):
+    """
+    Intervalo de Wilson para una proporción estimada con `exitos` de `n` muestras.
+    Si se indica el tamaño de la población (ej. píxeles de suelo de la imagen), aplica la
+    corrección por población finita: con n = poblacion el intervalo se cierra en el valor exacto.
+    Retorna (inferior, superior) como proporciones en [0, 1]; (0, 1) si no hay muestras.
+    """
+    if n <= 0:
+        return 0.0, 1.0
+    p = exitos / n
+    z = valor_z(confianza)
+    if poblacion is not None and poblacion > 1:
+        z *= np.sqrt(max(poblacion - n, 0) / (poblacion - 1))
+    z2 = z * z
+    centro = (p + z2 / (2 * n)) / (1 + z2 / n)
+    radio = z * np.sqrt(p * (1 - p) / n + z2 / (4 * n * n)) / (1 + z2 / n)
+    return float(max(0.0, centro - radio)), float(min(1.0, centro + radio))
+
+def margen_estratificado(p_estrato, n_estrato, peso_estrato, confianza=CONFIANZA, poblacion_estrato=None):
+    """
+    Semiancho del intervalo (aproximación normal) de una proporción global cuando solo una
+    parte de la población, de peso `peso_estrato`, se estimó por muestreo; el resto se
+    contó exactamente y no aporta varianza.
+    """
+    if n_estrato <= 0 or peso_estrato <= 0:
+        return 0.0
+    varianza = p_estrato * (1 - p_estrato) / n_estrato
+    if poblacion_estrato is not None and poblacion_estrato > 1:
+        varianza *= max(poblacion_estrato - n_estrato, 0) / (poblacion_estrato - 1)
+    return float(valor_z(confianza) * peso_estrato * np.sqrt(varianza))
+
+def muestras_estratificadas(alto, ancho, n, rng):
+    """
+    Posiciones de ~n píxeles con muestreo estratificado (grilla con jitter): la imagen se
+    divide en celdas de igual área, de forma parecida a la de la imagen, y se toma un
+    punto al azar dentro de cada una. Las muestras quedan repartidas como ruido azul
+    (sin huecos ni agrupamientos) y cada una representa la misma fracción de la imagen.
+    Retorna (filas, columnas) como arreglos de índices.
+    """
+    n_filas = int(min(alto, max(1, round(np.sqrt(n * alto / ancho)))))
+    n_columnas = int(min(ancho, max(1, int(np.ceil(n / n_filas)))))
+    forma = (n_filas, n_columnas)
+    filas = ((np.arange(n_filas)[:, None] + rng.random(forma)) * (alto / n_filas)).astype(np.intp)
+    columnas = ((np.arange(n_columnas)[None, :] + rng.random(forma)) * (ancho / n_columnas)).astype(np.intp)
+    return np.minimum(filas, alto - 1).ravel(), np.minimum(columnas, ancho - 1).ravel()
@@ -22,14 +22,17 @@ def calcular_porcentaje_suelo(etiquetas):
     Calcula porcentaje de LUZ y SOMBRA sobre el suelo evaluado, excluyendo IGNORADOS.
     """
     etiquetas = np.array(etiquetas)
-    clases_suelo = ["LUZ", "SOMBRA"]
-    mask_suelo = np.isin(etiquetas, clases_suelo)
+    conteo = {clase: int(np.sum(etiquetas == clase)) for clase in ["LUZ", "SOMBRA"]}
+    return calcular_porcentaje_suelo_conteo(conteo)
 
-    etiquetas_suelo = etiquetas[mask_suelo]
-    total_suelo = len(etiquetas_suelo)
-
-    cuenta_luz = np.sum(etiquetas_suelo == "LUZ")
-    cuenta_sombra = np.sum(etiquetas_suelo == "SOMBRA")
+def calcular_porcentaje_suelo_conteo(conteo):
+    """
+    Igual que calcular_porcentaje_suelo, pero a partir de un conteo de píxeles por clase
+    (ej. obtenido con np.bincount sobre ids de clase), sin recorrer etiquetas string.
+    """
+    cuenta_luz = int(conteo.get("LUZ", 0))
+    cuenta_sombra = int(conteo.get("SOMBRA", 0))
+    total_suelo = cuenta_luz + cuenta_sombra
 
     porc_luz = round((cuenta_luz / total_suelo) * 100, 2) if total_suelo > 0 else 0.0
     porc_sombra = round((cuenta_sombra / total_suelo) * 100, 2) if total_suelo > 0 else 0.0
@@ -0,0 +1,86 @@
+import os
+import numpy as np
+
+# Bits por canal de la tabla completa (2^24 entradas, una por color BGR de 8 bits)
+BITS_COMPLETOS = 8
+
+def ruta_tabla_colores(modelo_path):
+    """
+    Ruta del archivo de tabla de colores asociado a un modelo (junto al .pkl).
+    """
+    return os.path.splitext(modelo_path)[0] + ".lut.npz"
+
+def indices_color(pixeles, bits=BITS_COMPLETOS):
+    """
+    Empaqueta píxeles (N x 3, uint8) en índices de tabla de 3*bits bits.
+    Con bits=8 el índice es la clave de 24 bits del color exacto.
+    """
+    desplazamiento = 8 - bits
+    c0 = pixeles[:, 0].astype(np.uint32) >> desplazamiento
+    c1 = pixeles[:, 1].astype(np.uint32) >> desplazamiento
+    c2 = pixeles[:, 2].astype(np.uint32) >> desplazamiento
+    return (c0 << (2 * bits)) | (c1 << bits) | c2
+
+def pixeles_desde_indices(indices, bits=BITS_COMPLETOS):
+    """
+    Operación inversa de indices_color: devuelve el color representativo (centro del
+    intervalo cuantizado) de cada índice, como píxeles N x 3 uint8.
+    """
+    desplazamiento = 8 - bits
+    mascara = (1 << bits) - 1
+    centro = (1 << desplazamiento) >> 1
+
+    indices = np.asarray(indices, dtype=np.uint32)
+    pixeles = np.empty((len(indices), 3), dtype=np.uint8)
+    pixeles[:, 0] = ((indices >> (2 * bits)) & mascara) << desplazamiento | centro
+    pixeles[:, 1] = ((indices >> bits) & mascara) << desplazamiento | centro
+    pixeles[:, 2] = (indices & mascara) << desplazamiento | centro
+    return pixeles
+
+def guardar_tabla_colores(ruta, tabla, bits, huella_modelo, clases, dtype='float64'):
+    """
+    Guarda la tabla (uint8, una entrada por color) con los datos necesarios para validarla
+    (incluido el tipo de las características con que se evaluó el modelo).
+    """
+    np.savez_compressed(
+        ruta,
+        tabla=tabla,
+        bits=np.array(bits),
+        huella_modelo=np.array(huella_modelo),
+        clases=np.asarray(clases, dtype=str),
+        dtype=np.array(np.dtype(dtype).name)
+    )
+    print(f"💾 Tabla de colores guardada: {ruta} ({tabla.size} entradas, {bits} bits por canal)")
+
+def cargar_tabla_colores(ruta, huella_modelo, clases, bits=None, dtype='float64'):
+    """
+    Carga una tabla de colores si existe y corresponde al modelo (huella, clases y tipo de
+    las características; las tablas sin tipo guardado se construyeron con float64).
+    Retorna (tabla, bits) o (None, None) si no es válida.
+    """
+    if not os.path.exists(ruta):
+        return None, None
+
+    try:
+        with np.load(ruta) as datos:
+            bits_tabla = int(datos['bits'])
+            if str(datos['huella_modelo']) != huella_modelo:
+                print(f"⚠️ Tabla de colores desactualizada (modelo distinto): {ruta}")
+                return None, None
+            if list(datos['clases']) != list(clases):
+                print(f"⚠️ Tabla de colores con clases distintas: {ruta}")
+                return None, None
+            dtype_tabla = str(datos['dtype']) if 'dtype' in datos.files else 'float64'
+            if dtype_tabla != np.dtype(dtype).name:
+                print(f"⚠️ Tabla de colores construida con características {dtype_tabla}: {ruta}")
+                return None, None
+            if bits is not None and bits_tabla != bits:
+                print(f"⚠️ Tabla de colores con {bits_tabla} bits por canal, se pidieron {bits}: {ruta}")
+                return None, None
+            tabla = datos['tabla']
+    except Exception as e:
+        print(f"⚠️ Error cargando tabla de colores {ruta}: {e}")
+        return None, None
+
+    print(f"✅ Tabla de colores cargada: {ruta} ({bits_tabla} bits por canal)")
+    return tabla, bits_tabla
@@ -0,0 +1,348 @@
+"""
+Predictor de árboles compilado a arreglos NumPy.
+
+Aplana los árboles de un HistGradientBoostingClassifier o de un RandomForestClassifier
+entrenado en arreglos contiguos (característica, umbral, hijo izquierdo, valor de hoja,
+dirección de los faltantes) y los evalúa por niveles: en cada paso todos los pares
+(árbol, píxel) de un bloque bajan un nivel con unas pocas operaciones vectorizadas, sin
+la validación ni el reparto en hilos de `predict` en cada llamada.
+
+Los nodos de cada árbol se numeran en anchura, con los dos hijos contiguos (derecho =
+izquierdo + 1), así bajar un nivel es `hijo[nodo] + (x > umbral)`. Las hojas apuntan a
+sí mismas con umbral +inf, de modo que todos los árboles se recorren el mismo número de
+niveles (la profundidad máxima). Los valores de las hojas se suman árbol por árbol en el
+orden de scikit-learn, así que las decisiones son idénticas a las del modelo.
+
+El artefacto (.arboles.npz, junto al .pkl) solo necesita NumPy para evaluarse.
+
+Uso como script (compila, guarda el artefacto y compara con scikit-learn):
+    python -m src.services.arboles_compilados modelo_perfeccionado.pkl
+"""
+
+import os
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# Pares (árbol, píxel) evaluados a la vez: bloques chicos para que los índices de nodo
+# y los valores leídos quepan en caché
+MAX_PARES_BLOQUE = 1 << 16
+
+TIPO_HGB = "hgb"
+TIPO_RF = "rf"
+
+
+def ruta_arboles_compilados(modelo_path: str) -> str:
+    """Ruta del artefacto compilado asociado a un modelo (junto al .pkl)"""
+    return os.path.splitext(modelo_path)[0] + ".arboles.npz"
+
+
+def _ordenar_en_anchura(izquierdo: np.ndarray, derecho: np.ndarray, es_hoja: np.ndarray) -> np.ndarray:
+    """
+    Orden en anchura de los nodos de un árbol con los hermanos contiguos
+
+    Returns:
+        np.ndarray: Nodo original de cada posición nueva
+    """
+    orden = [0]
+    for nodo in orden:  # La lista crece mientras se recorre
+        if not es_hoja[nodo]:
+            orden.extend((int(izquierdo[nodo]), int(derecho[nodo])))
+    return np.asarray(orden, dtype=np.int64)
+
+
+class ArbolesCompilados:
+    """Conjunto de árboles aplanado en arreglos contiguos, evaluado por niveles"""
+
+    def __init__(self, tipo: str, clases: np.ndarray, raices: np.ndarray, caracteristica: np.ndarray,
+                 umbral: np.ndarray, hijo: np.ndarray, faltante_izquierda: np.ndarray,
+                 valor: np.ndarray, base: np.ndarray, profundidad: int):
+        """
+        Args:
+            tipo: TIPO_HGB (suma de valores crudos) o TIPO_RF (promedio de probabilidades)
+            clases: Clases del modelo (los ids devueltos son índices en este arreglo)
+            raices: Nodo raíz de cada árbol
+            caracteristica, umbral, hijo, faltante_izquierda: Un elemento por nodo
+            valor: Valor de cada nodo por columna de salida (cero fuera de las hojas)
+            base: Valor inicial de cada columna de salida
+            profundidad: Niveles a recorrer (profundidad máxima de los árboles)
+        """
+        self.tipo = tipo
+        self.clases = np.asarray(clases)
+        self.raices = np.ascontiguousarray(raices, dtype=np.int32)
+        self.caracteristica = np.ascontiguousarray(caracteristica, dtype=np.int32)
+        self.umbral = np.ascontiguousarray(umbral, dtype=np.float64)
+        self.hijo = np.ascontiguousarray(hijo, dtype=np.int32)
+        self.faltante_izquierda = np.ascontiguousarray(faltante_izquierda, dtype=bool)
+        self.valor = np.ascontiguousarray(valor, dtype=np.float64)
+        self.base = np.ascontiguousarray(base, dtype=np.float64)
+        self.profundidad = int(profundidad)
+
+    @property
+    def n_arboles(self) -> int:
+        return len(self.raices)
+
+    @property
+    def n_nodos(self) -> int:
+        return len(self.umbral)
+
+    # ------------------------------------------------------------------
+    # Exportación desde scikit-learn
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def desde_modelo(cls, modelo: Any) -> 'ArbolesCompilados':
+        """
+        Compila un HistGradientBoostingClassifier o un RandomForestClassifier entrenado
+
+        Raises:
+            ValueError: Si el modelo no es de un tipo soportado (o usa divisiones categóricas)
+        """
+        if hasattr(modelo, '_predictors') and hasattr(modelo, '_baseline_prediction'):
+            return cls._desde_hgb(modelo)
+        if hasattr(modelo, 'estimators_') and all(hasattr(e, 'tree_') for e in modelo.estimators_):
+            return cls._desde_bosque(modelo)
+        raise ValueError(f"No se puede compilar un modelo {type(modelo).__name__}")
+
+    @classmethod
+    def _desde_hgb(cls, modelo: Any) -> 'ArbolesCompilados':
+        n_salidas = modelo.n_trees_per_iteration_
+        arboles = []
+        for predictores in modelo._predictors:
+            for k, predictor in enumerate(predictores):
+                nodos = predictor.nodes
+                if nodos['is_categorical'].any():
+                    raise ValueError("Los árboles con divisiones categóricas no se pueden compilar")
+                valor = np.zeros((len(nodos), n_salidas))
+                valor[:, k] = np.where(nodos['is_leaf'], nodos['value'], 0.0)
+                arboles.append((
+                    nodos['feature_idx'], nodos['num_threshold'], nodos['left'], nodos['right'],
+                    nodos['is_leaf'].astype(bool), nodos['missing_go_to_left'].astype(bool), valor
+                ))
+        base = np.asarray(modelo._baseline_prediction, dtype=np.float64).reshape(-1)
+        return cls._ensamblar(TIPO_HGB, modelo.classes_, arboles, base)
+
+    @classmethod
+    def _desde_bosque(cls, modelo: Any) -> 'ArbolesCompilados':
+        if getattr(modelo, 'n_outputs_', 1) != 1:
+            raise ValueError("Los bosques con varias salidas no se pueden compilar")
+        arboles = []
+        for estimador in modelo.estimators_:
+            arbol = estimador.tree_
+            es_hoja = arbol.children_left == -1
+            # Mismas operaciones que predict_proba de un árbol: valor / suma por hoja
+            valor = arbol.value[:, 0, :modelo.n_classes_].astype(np.float64)
+            normalizador = valor.sum(axis=1)[:, None]
+            normalizador[normalizador == 0.0] = 1.0
+            valor = np.where(es_hoja[:, None], valor / normalizador, 0.0)
+            faltante_izquierda = (
+                arbol.missing_go_to_left.astype(bool) if hasattr(arbol, 'missing_go_to_left')
+                else np.zeros(len(es_hoja), dtype=bool)
+            )
+            arboles.append((
+                arbol.feature, arbol.threshold, arbol.children_left, arbol.children_right,
+                es_hoja, faltante_izquierda, valor
+            ))
+        base = np.zeros(modelo.n_classes_)
+        return cls._ensamblar(TIPO_RF, modelo.classes_, arboles, base)
+
+    @classmethod
+    def _ensamblar(cls, tipo: str, clases: np.ndarray, arboles: List[Tuple], base: np.ndarray
+                   ) -> 'ArbolesCompilados':
+        """Concatena los árboles (ya en arreglos por nodo) renumerados en anchura"""
+        raices, partes = [], []
+        profundidad = 0
+        inicio = 0
+        for caracteristica, umbral, izquierdo, derecho, es_hoja, faltante_izquierda, valor in arboles:
+            orden = _ordenar_en_anchura(izquierdo, derecho, es_hoja)
+            posicion = np.empty(len(es_hoja), dtype=np.int64)
+            posicion[orden] = np.arange(len(orden))
+
+            hoja = es_hoja[orden]
+            hijo = np.where(hoja, np.arange(len(orden)), posicion[np.where(es_hoja, 0, izquierdo)[orden]])
+            partes.append((
+                np.where(hoja, 0, caracteristica[orden]),
+                np.where(hoja, np.inf, umbral[orden]),
+                hijo + inicio,
+                hoja | faltante_izquierda[orden],
+                valor[orden]
+            ))
+
+            # Profundidad: niveles del recorrido en anchura
+            nivel = np.zeros(len(orden), dtype=np.int64)
+            for i in np.flatnonzero(~hoja):
+                nivel[hijo[i]] = nivel[hijo[i] + 1] = nivel[i] + 1
+            profundidad = max(profundidad, int(nivel.max()))
+
+            raices.append(inicio)
+            inicio += len(orden)
+
+        return cls(
+            tipo, clases, np.asarray(raices),
+            *(np.concatenate([parte[i] for parte in partes]) for i in range(5)),
+            base=base, profundidad=profundidad
+        )
+
+    # ------------------------------------------------------------------
+    # Evaluación
+    # ------------------------------------------------------------------
+
+    def decision(self, X: np.ndarray) -> np.ndarray:
+        """
+        Salida del conjunto para cada fila de X
+
+        Args:
+            X: Características (N x n_caracteristicas), en cualquier orden de memoria
+
+        Returns:
+            np.ndarray: N x n_salidas; valores crudos (HGB, como `_raw_predict`) o
+            probabilidades (RF, como `predict_proba`)
+        """
+        filas = np.asarray(X).T
+        if self.tipo == TIPO_RF:
+            filas = filas.astype(np.float32)  # Los árboles de scikit-learn comparan en float32
+        n = filas.shape[1]
+        salida = np.empty((n, len(self.base)))
+        paso = max(1, MAX_PARES_BLOQUE // self.n_arboles)
+        for inicio in range(0, n, paso):
+            salida[inicio:inicio + paso] = self._decision_bloque(filas[:, inicio:inicio + paso])
+        return salida
+
+    def _decision_bloque(self, filas: np.ndarray) -> np.ndarray:
+        """Recorre todos los árboles a la vez sobre un bloque (n_caracteristicas x n)"""
+        filas = np.ascontiguousarray(filas)
+        n = filas.shape[1]
+        planas = filas.ravel()
+        desplazamiento = self.caracteristica * n  # Inicio de la fila de cada característica
+        columnas = np.arange(n, dtype=np.int32)
+        con_faltantes = bool(np.isnan(planas).any())
+
+        nodos = np.repeat(self.raices[:, None], n, axis=1)
+        for _ in range(self.profundidad):
+            x = planas.take(desplazamiento.take(nodos) + columnas)
+            derecha = x > self.umbral.take(nodos)
+            if con_faltantes:
+                derecha |= np.isnan(x) & ~self.faltante_izquierda.take(nodos)
+            nodos = self.hijo.take(nodos)
+            nodos += derecha
+
+        # Suma árbol por árbol, en el mismo orden que scikit-learn
+        acumulado = np.zeros((n, len(self.base)))
+        acumulado += self.base
+        for nodos_arbol in nodos:
+            acumulado += self.valor.take(nodos_arbol, axis=0)
+        if self.tipo == TIPO_RF:
+            acumulado /= self.n_arboles
+        return acumulado
+
+    def predecir_ids(self, X: np.ndarray) -> np.ndarray:
+        """
+        Índice de clase (uint8) de cada fila, con la misma regla de decisión que `predict`
+        """
+        decision = self.decision(X)
+        if decision.shape[1] == 1:
+            # HGB binario: "> 0", no ">= 0"
+            return (decision[:, 0] > 0).astype(np.uint8)
+        return np.argmax(decision, axis=1).astype(np.uint8)
+
+    def predecir(self, X: np.ndarray) -> np.ndarray:
+        """Clase de cada fila (como `predict`)"""
+        return self.clases[self.predecir_ids(X)]
+
+    # ------------------------------------------------------------------
+    # Artefacto
+    # ------------------------------------------------------------------
+
+    def guardar(self, ruta: str, huella_modelo: str = ""):
+        """Guarda el artefacto .npz (solo arreglos NumPy)"""
+        np.savez_compressed(
+            ruta,
+            tipo=np.array(self.tipo),
+            clases=self.clases.astype(str),
+            raices=self.raices,
+            caracteristica=self.caracteristica,
+            umbral=self.umbral,
+            hijo=self.hijo,
+            faltante_izquierda=self.faltante_izquierda,
+            valor=self.valor,
+            base=self.base,
+            profundidad=np.array(self.profundidad),
+            huella_modelo=np.array(huella_modelo)
+        )
+        print(f"💾 Árboles compilados guardados: {ruta} ({self.n_arboles} árboles, {self.n_nodos} nodos)")
+
+    @classmethod
+    def cargar(cls, ruta: str, huella_modelo: str = None) -> 'ArbolesCompilados':
+        """
+        Carga un artefacto .npz
+
+        Args:
+            huella_modelo: Si se pasa, el artefacto debe haberse compilado de ese modelo
+
+        Raises:
+            ValueError: Si la huella no corresponde
+        """
+        with np.load(ruta) as datos:
+            if huella_modelo is not None and str(datos['huella_modelo']) != huella_modelo:
+                raise ValueError(f"{ruta} no corresponde al modelo actual")
+            return cls(
+                str(datos['tipo']), datos['clases'], datos['raices'], datos['caracteristica'],
+                datos['umbral'], datos['hijo'], datos['faltante_izquierda'], datos['valor'],
+                datos['base'], int(datos['profundidad'])
+            )
+
+
+def comparar_con_modelo(modelo: Any, compilado: ArbolesCompilados, X: np.ndarray,
+                        repeticiones: int = 3) -> Dict[str, Any]:
+    """
+    Compara el predictor compilado con `predict` de scikit-learn
+
+    Returns:
+        Dict con 'iguales', 'diferencias' (filas con distinta clase) y los tiempos
+        (mejor de `repeticiones`, en segundos) de cada uno
+    """
+    def medir(funcion):
+        mejor, resultado = float('inf'), None
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            resultado = funcion()
+            mejor = min(mejor, time.perf_counter() - inicio)
+        return resultado, mejor
+
+    esperado, tiempo_sklearn = medir(lambda: modelo.predict(X))
+    obtenido, tiempo_compilado = medir(lambda: compilado.predecir(X))
+    diferencias = int(np.count_nonzero(np.asarray(esperado) != obtenido))
+    return {
+        "iguales": diferencias == 0,
+        "diferencias": diferencias,
+        "filas": len(X),
+        "tiempo_sklearn": tiempo_sklearn,
+        "tiempo_compilado": tiempo_compilado,
+    }
+
+
+def main(argumentos: List[str]):
+    from src.services.procesamiento_service_v2 import ProcesamientoServiceV2
+    from src.services.registro_modelos import obtener_huella_modelo
+
+    modelo_path = argumentos[0] if argumentos else "modelo_perfeccionado.pkl"
+    n_pixeles = int(argumentos[1]) if len(argumentos) > 1 else 262144
+
+    servicio = ProcesamientoServiceV2(modelo_path)
+    compilado = ArbolesCompilados.desde_modelo(servicio.modelo)
+    compilado.guardar(ruta_arboles_compilados(modelo_path), obtener_huella_modelo(modelo_path))
+
+    pixeles = np.random.default_rng(0).integers(0, 256, (n_pixeles, 3), dtype=np.uint8)
+    X = np.array(servicio.extraer_caracteristicas_escaladas(pixeles))
+    resultado = comparar_con_modelo(servicio.modelo, compilado, X)
+    print(
+        f"{'✅' if resultado['iguales'] else '❌'} {resultado['filas']} píxeles, "
+        f"{resultado['diferencias']} diferencias | scikit-learn {resultado['tiempo_sklearn'] * 1000:.1f} ms, "
+        f"compilado {resultado['tiempo_compilado'] * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
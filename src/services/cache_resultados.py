@@ -0,0 +1,179 @@
+"""
+Caché persistente de resultados de clasificación.
+
+La clave combina el SHA-256 de la imagen, la huella del modelo y los parámetros de
+preprocesamiento (decodificación, redimensionado, modo LUT), así que un mismo archivo
+analizado otra vez (Probar Modelo, re-subidas, reintentos) no vuelve a pasar por el
+modelo. Se guardan los porcentajes, el conteo por clase y, si se tiene, la máscara de
+ids de clase comprimida con zlib.
+
+Vive en SQLite (una conexión por operación), así que la comparten los workers de la API
+y Streamlit. El tamaño total está acotado: al superar el máximo se eliminan las
+entradas usadas hace más tiempo (LRU).
+
+Configuración por variables de entorno:
+- RESULTADOS_CACHE: "0" para desactivar la caché
+- RESULTADOS_CACHE_DB: ruta de la base SQLite (por defecto resultados_cache.sqlite3)
+- RESULTADOS_CACHE_MAX_MB: tamaño máximo de la caché (por defecto 512)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+def clave_resultado(imagen_bytes: bytes, huella_modelo: str, parametros: Dict[str, Any]) -> str:
+    """
+    Clave de caché de una imagen
+
+    Args:
+        imagen_bytes: Contenido del archivo de imagen
+        huella_modelo: Huella del modelo (ver `obtener_huella_modelo`)
+        parametros: Parámetros de preprocesamiento que afectan al resultado
+
+    Returns:
+        str: Hash hexadecimal
+    """
+    huella_imagen = hashlib.sha256(imagen_bytes).hexdigest()
+    parametros_texto = json.dumps(parametros, sort_keys=True, default=str)
+    return hashlib.sha256(f"{huella_imagen}|{huella_modelo}|{parametros_texto}".encode('utf-8')).hexdigest()
+
+
+class CacheResultados:
+    """Resultados de clasificación por clave, con desalojo LRU por tamaño total"""
+
+    def __init__(self, ruta_db: str = None, max_bytes: int = None):
+        self.ruta_db = ruta_db or os.getenv('RESULTADOS_CACHE_DB', 'resultados_cache.sqlite3')
+        self.max_bytes = max_bytes or int(float(os.getenv('RESULTADOS_CACHE_MAX_MB', 512)) * 1024 * 1024)
+        with closing(self._conectar()) as conexion:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                """
+                CREATE TABLE IF NOT EXISTS resultados (
+                    clave TEXT PRIMARY KEY,
+                    resultado TEXT NOT NULL,
+                    alto INTEGER,
+                    ancho INTEGER,
+                    ids BLOB,
+                    tamano INTEGER NOT NULL,
+                    ultimo_uso REAL NOT NULL
+                )
+                """
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS idx_resultados_uso ON resultados (ultimo_uso)")
+
+    def _conectar(self) -> sqlite3.Connection:
+        # Una conexión por operación: válida desde cualquier hilo y sin estado compartido
+        return sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+
+    def obtener(self, clave: str, con_ids: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Resultado guardado para `clave`
+
+        Args:
+            clave: Clave calculada con `clave_resultado`
+            con_ids: Si es True, solo cuenta como acierto una entrada que tenga la máscara de ids
+
+        Returns:
+            Dict con el resultado (y 'ids' alto x ancho uint8 si se pidió), o None
+        """
+        with closing(self._conectar()) as conexion:
+            fila = conexion.execute(
+                f"SELECT resultado, alto, ancho, {'ids' if con_ids else 'NULL'}, ids IS NOT NULL "
+                "FROM resultados WHERE clave = ?",
+                (clave,)
+            ).fetchone()
+            if fila is None or (con_ids and not fila[4]):
+                return None
+            conexion.execute("UPDATE resultados SET ultimo_uso = ? WHERE clave = ?", (time.time(), clave))
+
+        resultado = json.loads(fila[0])
+        if con_ids:
+            resultado['ids'] = np.frombuffer(zlib.decompress(fila[3]), dtype=np.uint8).reshape(fila[1], fila[2])
+        return resultado
+
+    def guardar(self, clave: str, resultado: Dict[str, Any], ids: np.ndarray = None):
+        """
+        Guarda un resultado (reemplaza el anterior) y desaloja entradas si se supera el tamaño máximo
+
+        Args:
+            clave: Clave calculada con `clave_resultado`
+            resultado: Valores serializables en JSON (porcentajes, conteo, dimensiones)
+            ids: Máscara de ids de clase (alto x ancho, uint8), opcional
+        """
+        texto = json.dumps(resultado)
+        alto = ancho = comprimido = None
+        if ids is not None:
+            alto, ancho = ids.shape[:2]
+            comprimido = zlib.compress(np.ascontiguousarray(ids, dtype=np.uint8).tobytes(), 1)
+        tamano = len(texto) + (len(comprimido) if comprimido is not None else 0)
+        if tamano > self.max_bytes:
+            return
+
+        conexion = self._conectar()
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            conexion.execute(
+                "INSERT OR REPLACE INTO resultados (clave, resultado, alto, ancho, ids, tamano, ultimo_uso) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (clave, texto, alto, ancho, comprimido, tamano, time.time())
+            )
+            total = conexion.execute("SELECT COALESCE(SUM(tamano), 0) FROM resultados").fetchone()[0]
+            if total > self.max_bytes:
+                self._desalojar(conexion, total - self.max_bytes)
+            conexion.execute("COMMIT")
+        except BaseException:
+            if conexion.in_transaction:
+                conexion.execute("ROLLBACK")
+            raise
+        finally:
+            conexion.close()
+
+    def _desalojar(self, conexion: sqlite3.Connection, exceso: int):
+        """Elimina las entradas menos usadas hasta liberar `exceso` bytes"""
+        liberado = 0
+        claves = []
+        for clave, tamano in conexion.execute("SELECT clave, tamano FROM resultados ORDER BY ultimo_uso"):
+            claves.append((clave,))
+            liberado += tamano
+            if liberado >= exceso:
+                break
+        conexion.executemany("DELETE FROM resultados WHERE clave = ?", claves)
+        print(f"🧹 Caché de resultados: {len(claves)} entradas desalojadas ({liberado / 1024 / 1024:.1f} MB)")
+
+    def limpiar(self):
+        """Elimina todas las entradas"""
+        with closing(self._conectar()) as conexion:
+            conexion.execute("DELETE FROM resultados")
+
+
+_cache: Optional[CacheResultados] = None
+_lock_cache = threading.Lock()
+
+
+def obtener_cache_resultados() -> Optional[CacheResultados]:
+    """
+    Caché compartida por el proceso
+
+    Returns:
+        CacheResultados, o None si está desactivada (RESULTADOS_CACHE=0) o no se pudo abrir
+    """
+    global _cache
+    if os.getenv('RESULTADOS_CACHE', '1') == '0':
+        return None
+    with _lock_cache:
+        if _cache is None:
+            try:
+                _cache = CacheResultados()
+            except sqlite3.Error as e:
+                print(f"⚠️ Caché de resultados desactivada: {e}")
+                return None
+        return _cache
@@ -0,0 +1,260 @@
+"""
+Ejecutor de inferencia para la API.
+
+Saca el trabajo pesado del event loop de FastAPI:
+- un pool de procesos para el trabajo de CPU (decodificación, modelo, visualización)
+- un pool de hilos para E/S bloqueante (EXIF/geocodificación, Google Sheets)
+
+La cola de CPU está acotada: si hay demasiadas tareas pendientes, `ejecutar_cpu`
+lanza ColaLlenaError para que la API responda 503 en lugar de acumular peticiones.
+
+Configuración por variables de entorno:
+- INFERENCIA_WORKERS: procesos de inferencia (por defecto, número de CPUs)
+- INFERENCIA_COLA_MAX: tareas de CPU pendientes admitidas (por defecto, 2 x workers)
+- INFERENCIA_PROCESOS: "0" para usar hilos en lugar de procesos (ej. entornos serverless)
+- IO_WORKERS: hilos para E/S (por defecto 8)
+"""
+
+import asyncio
+import base64
+import functools
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from src.services.procesamiento_service_v2 import obtener_servicio
+
+
+class ColaLlenaError(Exception):
+    """La cola de inferencia está llena; el cliente debe reintentar más tarde"""
+
+
+class EjecutorInferencia:
+    """Pools de procesos (CPU) e hilos (E/S) con cola de CPU acotada"""
+
+    def __init__(self, workers_cpu: int = None, workers_io: int = None, max_pendientes: int = None,
+                 usar_procesos: bool = None):
+        self.workers_cpu = workers_cpu or int(os.getenv('INFERENCIA_WORKERS', os.cpu_count() or 1))
+        self.workers_io = workers_io or int(os.getenv('IO_WORKERS', 8))
+        self.max_pendientes = max_pendientes or int(os.getenv('INFERENCIA_COLA_MAX', 2 * self.workers_cpu))
+        if usar_procesos is None:
+            usar_procesos = os.getenv('INFERENCIA_PROCESOS', '1') != '0'
+        self.usar_procesos = usar_procesos
+
+        self._pool_cpu: Optional[Executor] = None
+        self._pool_io: Optional[Executor] = None
+        self._pendientes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pendientes(self) -> int:
+        """Tareas de CPU en cola o en ejecución"""
+        return self._pendientes
+
+    def _obtener_pool_cpu(self) -> Executor:
+        """Crea el pool de CPU de forma perezosa (procesos, o hilos si no es posible)"""
+        with self._lock:
+            if self._pool_cpu is None:
+                if self.usar_procesos:
+                    try:
+                        self._pool_cpu = ProcessPoolExecutor(
+                            max_workers=self.workers_cpu,
+                            initializer=_inicializar_worker
+                        )
+                        print(f"⚙️ Pool de inferencia: {self.workers_cpu} procesos, cola máx. {self.max_pendientes}")
+                    except (OSError, NotImplementedError, ImportError) as e:
+                        print(f"⚠️ No se pudo crear el pool de procesos, usando hilos: {e}")
+                if self._pool_cpu is None:
+                    self._pool_cpu = ThreadPoolExecutor(
+                        max_workers=self.workers_cpu,
+                        thread_name_prefix="inferencia"
+                    )
+                    print(f"⚙️ Pool de inferencia: {self.workers_cpu} hilos, cola máx. {self.max_pendientes}")
+            return self._pool_cpu
+
+    def _obtener_pool_io(self) -> Executor:
+        """Crea el pool de E/S de forma perezosa"""
+        with self._lock:
+            if self._pool_io is None:
+                self._pool_io = ThreadPoolExecutor(max_workers=self.workers_io, thread_name_prefix="io")
+            return self._pool_io
+
+    def _reservar(self):
+        with self._lock:
+            if self._pendientes >= self.max_pendientes:
+                raise ColaLlenaError(
+                    f"Cola de inferencia llena ({self._pendientes}/{self.max_pendientes} tareas pendientes)"
+                )
+            self._pendientes += 1
+
+    def _liberar(self):
+        with self._lock:
+            self._pendientes -= 1
+
+    async def ejecutar_cpu(self, funcion: Callable, *args, **kwargs) -> Any:
+        """
+        Ejecuta `funcion` en el pool de CPU sin bloquear el event loop.
+        La función y sus argumentos deben ser serializables (funciones de nivel de módulo).
+
+        Raises:
+            ColaLlenaError: si ya hay `max_pendientes` tareas en cola o en ejecución
+        """
+        self._reservar()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._obtener_pool_cpu(), functools.partial(funcion, *args, **kwargs)
+            )
+        finally:
+            self._liberar()
+
+    async def ejecutar_io(self, funcion: Callable, *args, **kwargs) -> Any:
+        """Ejecuta una función de E/S bloqueante en el pool de hilos"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._obtener_pool_io(), functools.partial(funcion, *args, **kwargs)
+        )
+
+    def cerrar(self):
+        """Cierra ambos pools (al apagar la aplicación)"""
+        with self._lock:
+            for pool in (self._pool_cpu, self._pool_io):
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            self._pool_cpu = None
+            self._pool_io = None
+
+
+def _inicializar_worker():
+    """Carga el modelo al arrancar cada proceso, antes de la primera petición"""
+    try:
+        obtener_servicio()
+    except Exception as e:
+        print(f"⚠️ Worker sin modelo precargado: {e}")
+
+
+# --- Tareas de CPU (nivel de módulo para poder enviarlas a otros procesos) ---
+
+def _decodificar(imagen_bytes: bytes) -> Optional[np.ndarray]:
+    return cv2.imdecode(np.frombuffer(imagen_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+
+def analizar_luminancia(imagen_bytes: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Análisis simple por luminancia (umbral 128). Retorna None si la imagen no se puede leer.
+    """
+    img = _decodificar(imagen_bytes)
+    if img is None:
+        return None
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    total_pixels = img.shape[0] * img.shape[1]
+    light_pixels = int(np.count_nonzero(gray > 128))
+
+    light_percentage = (light_pixels / total_pixels) * 100
+    shadow_percentage = ((total_pixels - light_pixels) / total_pixels) * 100
+    return {
+        "porcentaje_luz": light_percentage,
+        "porcentaje_sombra": shadow_percentage,
+        "dimensiones": img.shape
+    }
+
+
+def estimar_porcentajes_muestreo(imagen_bytes: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Porcentajes de luz/sombra del modelo estimados con una muestra adaptativa de píxeles
+    (tiempo casi constante). Retorna None si la imagen no se puede leer.
+    """
+    img = _decodificar(imagen_bytes)
+    if img is None:
+        return None
+    return obtener_servicio().estimar_porcentajes_muestreo(img)
+
+
+def procesar_imagen_visual_bytes(imagen_bytes: bytes, preview: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Clasifica la imagen y genera la visualización de luz/sombra con leyenda (JPEG en base64).
+    Con preview=True clasifica solo una muestra de píxeles y agrega 'estimacion' (intervalo
+    de confianza y margen de error de los porcentajes).
+    Retorna None si la imagen no se puede leer.
+    """
+    servicio = obtener_servicio()
+    if preview:
+        img = _decodificar(imagen_bytes)
+        analisis = servicio.analizar_imagen_preview(img) if img is not None else None
+    else:
+        # Clasificación (o resultado de la caché, sin decodificar la imagen)
+        analisis = servicio.analizar_imagen_bytes(imagen_bytes)
+    if analisis is None:
+        return None
+
+    light_percentage = analisis["porcentaje_luz"]
+    shadow_percentage = analisis["porcentaje_sombra"]
+    light_mask = analisis["mascara_luz"]
+
+    # Crear imagen de análisis como las de la carpeta "resultados"
+    height, width = light_mask.shape[:2]
+    print(f"📏 Dimensiones de la imagen: {width}x{height}")
+    result_img = np.zeros((height, width, 3), dtype=np.uint8)
+
+    # Aplicar colores exactamente como en el código original (BGR format)
+    result_img[light_mask == 255] = [0, 255, 255]      # Amarillo para luz (BGR)
+    result_img[light_mask == 128] = [50, 50, 50]       # Gris para sombra
+
+    # Agregar leyenda visual en la esquina superior izquierda
+    cv2.rectangle(result_img, (20, 20), (300, 120), (255, 255, 255), -1)
+    cv2.rectangle(result_img, (20, 20), (300, 120), (0, 0, 0), 2)
+
+    # Texto de la leyenda
+    cv2.putText(result_img, "ANALISIS LUZ-SOMBRA", (30, 45), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
+    cv2.putText(result_img, f"Luz: {light_percentage:.1f}%", (30, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
+    cv2.putText(result_img, f"Sombra: {shadow_percentage:.1f}%", (30, 95), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
+
+    # Agregar indicadores de color
+    cv2.rectangle(result_img, (200, 50), (220, 70), (0, 255, 255), -1)  # Cuadrado amarillo para luz
+    cv2.putText(result_img, "Luz", (225, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+
+    cv2.rectangle(result_img, (200, 75), (220, 95), (50, 50, 50), -1)  # Cuadrado gris para sombra
+    cv2.putText(result_img, "Sombra", (225, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+
+    # Convertir a base64 para enviar al frontend
+    _, buffer = cv2.imencode('.jpg', result_img)
+    img_base64 = base64.b64encode(buffer).decode('utf-8')
+
+    return {
+        "porcentaje_luz": light_percentage,
+        "porcentaje_sombra": shadow_percentage,
+        "imagen_visual": f"data:image/jpeg;base64,{img_base64}",
+        "estimacion": analisis.get("estimacion")
+    }
+
+
+def procesar_imagen_bytes(imagen_bytes: bytes, anotaciones_json: str, lugar: str,
+                          nombre_imagen: str, nombre_json: str) -> Dict[str, Any]:
+    """Procesamiento completo con el servicio compartido del proceso"""
+    return obtener_servicio().procesar_imagen_bytes(
+        imagen_bytes=imagen_bytes,
+        anotaciones_json=anotaciones_json,
+        lugar=lugar,
+        nombre_imagen=nombre_imagen,
+        nombre_json=nombre_json
+    )
+
+
+def histogramar_lote(imagenes_bytes: List[bytes]) -> Tuple[List[Dict[str, Any]], List, List, np.ndarray]:
+    """
+    Primer paso de un lote repartido: histogramas de colores de una parte de las imágenes
+    (ver ProcesamientoServiceV2.histogramar_lote), más las clases del modelo
+    """
+    servicio = obtener_servicio()
+    resultados, histogramas, claves = servicio.histogramar_lote(imagenes_bytes)
+    return resultados, histogramas, claves, servicio.clases
+
+
+def clasificar_colores(colores: np.ndarray) -> np.ndarray:
+    """Segundo paso de un lote repartido: ids de clase de una parte de la unión de colores"""
+    return obtener_servicio().clasificar_colores(colores)
@@ -2,83 +2,730 @@ import os
 import json
 import cv2
 import numpy as np
-import pickle
-import joblib
+from sklearn.preprocessing import StandardScaler
 from datetime import datetime
-from typing import Dict, Any, Tuple
-import tempfile
+from typing import Dict, Any, Callable, Iterable, List, Optional, Tuple, Union
 
-from src.procesamiento.postprocesamiento import calcular_porcentaje_suelo
+from src.procesamiento.postprocesamiento import calcular_porcentaje_suelo_conteo
+from src.procesamiento.estimacion import (
+    CONFIANZA, intervalo_wilson, margen_estratificado, muestras_estratificadas
+)
+from src.procesamiento.tabla_colores import (
+    BITS_COMPLETOS, ruta_tabla_colores, indices_color, pixeles_desde_indices,
+    guardar_tabla_colores, cargar_tabla_colores
+)
+from src.services.arboles_compilados import ArbolesCompilados, ruta_arboles_compilados
+from src.services.registro_modelos import obtener_modelo, obtener_huella_modelo, registro_modelos
+from src.services.cache_resultados import clave_resultado, obtener_cache_resultados
+
+# Colores (BGR) de la imagen resultado por clase
+COLORES_CLASES_BGR = {
+    "LUZ": (0, 255, 255),      # Amarillo
+    "SOMBRA": (50, 50, 50),    # Gris
+    "TRONCO": (0, 0, 255),     # Rojo
+    "IGNORADO": (0, 0, 255),   # Rojo
+}
+
+# Valores de la máscara combinada de luz (luz = 255, sombra = 128, resto = 0)
+VALORES_MASCARA_LUZ = {
+    "LUZ": 255,
+    "SOMBRA": 128,
+}
+
+# Decodificación por defecto de las entradas en bytes (parámetro de la clave de caché)
+DECODIFICACION_BGR = {"decodificacion": "cv2.imdecode", "canales": "BGR"}
+
+# Tamaño de bloque (en píxeles) para la inferencia por bandas de filas.
+# Acota la memoria pico: las características de un bloque ocupan 80 bytes por píxel (40 en float32).
+PIXELES_POR_BLOQUE = 512 * 512
+
+# Paso de muestreo del modo vista previa: se clasifica 1 de cada paso x paso píxeles
+# (con 8, ~1/64 de los píxeles y un margen de error típico de 0.2-0.5 puntos)
+PASO_PREVIEW = 8
+
+# Estimación por muestreo adaptativo: ancho del intervalo buscado (puntos porcentuales,
+# ±0.5) y tamaños de muestra inicial y máximo
+ANCHO_INTERVALO_OBJETIVO = 1.0
+MUESTRAS_INICIALES = 1024
+MAX_MUESTRAS = 1 << 16
+
+# Tipo de las características. float64 reproduce bit a bit el cálculo con el que se
+# entrenó el modelo: algunos umbrales de los árboles coinciden exactamente con valores
+# de características, así que con float32 cambia la clase de ~0.3% de los colores.
+DTYPE_CARACTERISTICAS = np.float64
 
 class ProcesamientoServiceV2:
     """
     Servicio actualizado para procesar imágenes con modelo perfeccionado
     """
     
-    def __init__(self, modelo_path: str = "modelo_perfeccionado.pkl"):
+    def __init__(
+        self,
+        modelo_path: str = "modelo_perfeccionado.pkl",
+        pixeles_por_bloque: int = PIXELES_POR_BLOQUE,
+        usar_lut: bool = False,
+        bits_lut: int = BITS_COMPLETOS,
+        deduplicar_colores: bool = True,
+        dtype_caracteristicas=DTYPE_CARACTERISTICAS,
+        usar_arboles_compilados: bool = None
+    ):
         self.modelo_path = modelo_path
+        self.pixeles_por_bloque = pixeles_por_bloque
+        self.deduplicar_colores = deduplicar_colores
+        self.dtype_caracteristicas = dtype_caracteristicas
         self.modelo = None
         self.scaler = None
         self.encoder = None
+        self.clases = np.array([], dtype=str)
+        self.tabla_colores = None
+        self.bits_lut = bits_lut
+        self._media_scaler = None
+        self._escala_scaler = None
+        self._scaler_en_sitio = False
+        self.arboles_compilados = None
         self._cargar_modelo()
+        self._preparar_clases()
+        self._preparar_scaler()
+        
+        if usar_arboles_compilados is None:
+            usar_arboles_compilados = os.getenv('MODELO_ARBOLES_COMPILADOS', '').lower() in ('1', 'true', 'si', 'sí')
+        if usar_arboles_compilados and self.modelo is not None:
+            self.activar_arboles_compilados()
+        
+        if usar_lut and self.modelo is not None and self.scaler is not None:
+            self.activar_modo_lut(bits_lut)
     
     def _cargar_modelo(self):
-        """Carga el modelo perfeccionado"""
+        """Carga el modelo perfeccionado (compartido vía el registro de modelos del proceso)"""
         try:
-            # Intentar cargar con joblib primero (más robusto)
-            try:
-                with open(self.modelo_path, 'rb') as f:
-                    data = joblib.load(f)
-                    if isinstance(data, tuple) and len(data) >= 2:
-                        self.modelo, self.scaler = data[0], data[1]
-                        if len(data) == 3:
-                            self.encoder = data[2]
-                    else:
-                        self.modelo = data
-                print(f"✅ Modelo cargado con joblib desde: {self.modelo_path}")
-            except Exception as joblib_error:
-                print(f"⚠️ Joblib falló, intentando con pickle: {joblib_error}")
-                # Fallback a pickle si joblib falla
-                with open(self.modelo_path, 'rb') as f:
-                    self.modelo, self.scaler = pickle.load(f)
-                # El modelo también incluye el encoder
-                try:
-                    with open(self.modelo_path, 'rb') as f:
-                        data = pickle.load(f)
-                        if len(data) == 3:
-                            self.modelo, self.scaler, self.encoder = data
-                except:
-                    pass
-                print(f"✅ Modelo cargado con pickle desde: {self.modelo_path}")
+            data = obtener_modelo(self.modelo_path)
+            if isinstance(data, tuple) and len(data) >= 2:
+                self.modelo, self.scaler = data[0], data[1]
+                if len(data) == 3:
+                    self.encoder = data[2]
+            else:
+                self.modelo = data
         except Exception as e:
             print(f"❌ Error cargando modelo: {e}")
             raise
     
-    def extraer_caracteristicas_optimizadas(self, pixeles):
+    def _preparar_clases(self):
+        """
+        Precalcula los nombres de clase por id y las tablas de consulta (máscara y colores).
+        El encoder se aplica una sola vez sobre la lista de clases, no sobre cada píxel.
+        """
+        clases = getattr(self.modelo, 'classes_', None)
+        if clases is None:
+            return
+        
+        if self.encoder is not None:
+            clases = self.encoder.inverse_transform(clases)
+        self.clases = np.asarray(clases).astype(str)
+        
+        n_clases = len(self.clases)
+        if n_clases > 256:
+            raise ValueError(f"El modelo tiene {n_clases} clases; los ids uint8 admiten como máximo 256")
+        
+        self._lut_mascara = np.zeros(n_clases, dtype=np.uint8)
+        self._lut_colores = np.zeros((n_clases, 3), dtype=np.uint8)
+        for id_clase, clase in enumerate(self.clases):
+            self._lut_mascara[id_clase] = VALORES_MASCARA_LUZ.get(clase, 0)
+            self._lut_colores[id_clase] = COLORES_CLASES_BGR.get(clase, (0, 0, 0))
+    
+    def _preparar_scaler(self):
+        """
+        Precalcula media y escala del StandardScaler para aplicarlas en el mismo buffer
+        de las características, sin la copia N x 10 que crea `transform`.
+        Otros escaladores se siguen aplicando con `transform`.
+        """
+        if not isinstance(self.scaler, StandardScaler):
+            return
+        if self.scaler.with_mean:
+            self._media_scaler = np.asarray(self.scaler.mean_, dtype=np.float64)[:, None]
+        if self.scaler.with_std:
+            self._escala_scaler = np.asarray(self.scaler.scale_, dtype=np.float64)[:, None]
+        self._scaler_en_sitio = True
+    
+    def _predecir_ids(self, caracteristicas_scaled: np.ndarray) -> np.ndarray:
+        """
+        Clasifica y devuelve ids de clase uint8 (índices en self.clases) en lugar de etiquetas string.
+        Reproduce exactamente la regla de decisión de `predict` del modelo.
+        """
+        if self.arboles_compilados is not None:
+            return self.arboles_compilados.predecir_ids(caracteristicas_scaled)
+        if hasattr(self.modelo, 'decision_function'):
+            decision = self.modelo.decision_function(caracteristicas_scaled)
+            if decision.ndim == 1:
+                # Mismo criterio que predict en clasificación binaria ("> 0", no ">= 0")
+                ids = decision > 0
+            else:
+                ids = np.argmax(decision, axis=1)
+        elif hasattr(self.modelo, 'predict_proba'):
+            ids = np.argmax(self.modelo.predict_proba(caracteristicas_scaled), axis=1)
+        else:
+            ids = np.searchsorted(self.modelo.classes_, self.modelo.predict(caracteristicas_scaled))
+        return ids.astype(np.uint8)
+    
+    def _clasificar_pixeles(self, pixeles: np.ndarray, buffer: np.ndarray = None) -> np.ndarray:
+        """
+        Clasifica un bloque de píxeles BGR (N x 3 o banda alto x ancho x 3) y devuelve
+        sus ids de clase (uint8, uno por píxel)
+        """
+        if self.tabla_colores is not None:
+            # Modo LUT: una sola consulta por píxel en la tabla color -> clase
+            return self.tabla_colores[indices_color(pixeles.reshape(-1, 3), self.bits_lut)]
+        if self.deduplicar_colores:
+            return self._clasificar_colores_unicos(pixeles.reshape(-1, 3), buffer)
+        return self._clasificar_pixeles_modelo(pixeles, buffer)
+    
+    def _clasificar_colores_unicos(self, pixeles: np.ndarray, buffer: np.ndarray = None) -> np.ndarray:
+        """
+        Clasifica solo los colores distintos del bloque (claves BGR de 24 bits) y
+        reparte el resultado a cada píxel. Equivalente exacto a clasificar todos los
+        píxeles, pero el costo depende de la diversidad de colores y no de la resolución.
+        """
+        claves = indices_color(pixeles)
+        claves_unicas, inverso = np.unique(claves, return_inverse=True)
+        ids_unicos = self._clasificar_pixeles_modelo(pixeles_desde_indices(claves_unicas), buffer)
+        return ids_unicos[inverso.ravel()]
+    
+    def _clasificar_pixeles_modelo(self, pixeles: np.ndarray, buffer: np.ndarray = None) -> np.ndarray:
+        """
+        Clasifica píxeles evaluando características, scaler y modelo
+        """
+        return self._predecir_ids(self.extraer_caracteristicas_escaladas(pixeles, out=buffer))
+    
+    def clasificar_imagen_ids(self, imagen: np.ndarray, pixeles_por_bloque: int = None) -> np.ndarray:
+        """
+        Clasifica la imagen completa por bandas de filas y escribe los ids de clase en un
+        buffer preasignado (alto * ancho, uint8). El resultado es idéntico a clasificar
+        todos los píxeles de una vez, pero la memoria pico depende solo del tamaño de bloque.
+        """
+        height, width = imagen.shape[:2]
+        pixeles_por_bloque = pixeles_por_bloque or self.pixeles_por_bloque
+        filas_por_bloque = max(1, pixeles_por_bloque // width)
+        
+        ids = np.empty(height * width, dtype=np.uint8)
+        # Un solo buffer de características para todas las bandas de esta imagen
+        buffer = None
+        if self.tabla_colores is None:
+            buffer = np.empty((10, min(filas_por_bloque, height) * width), dtype=self.dtype_caracteristicas)
+        for y0 in range(0, height, filas_por_bloque):
+            y1 = min(y0 + filas_por_bloque, height)
+            ids[y0 * width:y1 * width] = self._clasificar_pixeles(imagen[y0:y1], buffer)
+        
+        return ids
+    
+    def construir_tabla_colores(self, bits: int = BITS_COMPLETOS) -> np.ndarray:
+        """
+        Evalúa el modelo una sola vez sobre todo el cubo de colores (2^(3*bits) entradas).
+        Todas las características dependen solo del color del píxel, así que la tabla
+        reproduce exactamente al modelo con bits=8 (con menos bits, usa el centro de cada celda).
+        """
+        n_colores = 1 << (3 * bits)
+        print(f"🧮 Construyendo tabla de colores: {n_colores} colores ({bits} bits por canal)...")
+        
+        tabla = np.empty(n_colores, dtype=np.uint8)
+        buffer = np.empty((10, min(self.pixeles_por_bloque, n_colores)), dtype=self.dtype_caracteristicas)
+        for inicio in range(0, n_colores, self.pixeles_por_bloque):
+            fin = min(inicio + self.pixeles_por_bloque, n_colores)
+            pixeles = pixeles_desde_indices(np.arange(inicio, fin, dtype=np.uint32), bits)
+            tabla[inicio:fin] = self._clasificar_pixeles_modelo(pixeles, buffer)
+        
+        return tabla
+    
+    def activar_modo_lut(self, bits: int = BITS_COMPLETOS, guardar: bool = True):
+        """
+        Activa el modo LUT: carga la tabla guardada junto al .pkl si corresponde a este
+        modelo, o la construye (y la guarda) si no existe o está desactualizada.
+        """
+        ruta = ruta_tabla_colores(self.modelo_path)
+        huella = obtener_huella_modelo(self.modelo_path)
+        
+        tabla, bits_tabla = cargar_tabla_colores(ruta, huella, self.clases, bits, self.dtype_caracteristicas)
+        if tabla is None:
+            tabla, bits_tabla = self.construir_tabla_colores(bits), bits
+            if guardar:
+                try:
+                    guardar_tabla_colores(ruta, tabla, bits, huella, self.clases, self.dtype_caracteristicas)
+                except OSError as e:
+                    print(f"⚠️ No se pudo guardar la tabla de colores: {e}")
+        
+        self.tabla_colores = tabla
+        self.bits_lut = bits_tabla
+        print(f"⚡ Modo LUT activo ({bits_tabla} bits por canal)")
+    
+    def activar_arboles_compilados(self, guardar: bool = True):
+        """
+        Evalúa el modelo con los árboles compilados a arreglos NumPy en lugar de `predict`.
+        Carga el artefacto guardado junto al .pkl si corresponde a este modelo, o lo
+        compila (y lo guarda). Si el modelo no se puede compilar, sigue con scikit-learn.
+        """
+        ruta = ruta_arboles_compilados(self.modelo_path)
+        huella = obtener_huella_modelo(self.modelo_path)
+        
+        compilado = None
+        if os.path.exists(ruta):
+            try:
+                compilado = ArbolesCompilados.cargar(ruta, huella)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️ Árboles compilados descartados: {e}")
+        if compilado is None:
+            try:
+                compilado = ArbolesCompilados.desde_modelo(self.modelo)
+            except ValueError as e:
+                print(f"⚠️ Se usará predict de scikit-learn: {e}")
+                return
+            if guardar:
+                try:
+                    compilado.guardar(ruta, huella)
+                except OSError as e:
+                    print(f"⚠️ No se pudieron guardar los árboles compilados: {e}")
+        
+        self.arboles_compilados = compilado
+        print(f"⚡ Árboles compilados activos ({compilado.n_arboles} árboles, profundidad {compilado.profundidad})")
+    
+    def ids_a_etiquetas(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Convierte ids de clase a etiquetas string (API de compatibilidad)
+        """
+        return self.clases[ids]
+    
+    def contar_clases_ids(self, ids: np.ndarray) -> Dict[str, int]:
+        """
+        Cuenta píxeles por clase con un único np.bincount sobre los ids
+        """
+        conteo = np.bincount(ids.ravel(), minlength=len(self.clases))
+        return {clase: int(conteo[id_clase]) for id_clase, clase in enumerate(self.clases)}
+    
+    def mascara_luz_desde_ids(self, ids: np.ndarray, height: int, width: int) -> np.ndarray:
+        """
+        Máscara combinada (luz = 255, sombra = 128, resto = 0) mediante tabla de consulta
+        """
+        return self._lut_mascara[ids].reshape((height, width))
+    
+    def clave_cache(self, imagen_bytes: bytes, parametros: Dict[str, Any] = None) -> Optional[str]:
+        """
+        Clave de la caché de resultados: contenido de la imagen + huella del modelo +
+        preprocesamiento (decodificación, modo LUT y tipo de las características, que con
+        float32 cambia la clase de algunos colores). None si no hay modelo.
+        
+        Los demás ajustes (deduplicación de colores, árboles compilados, tamaño de bloque)
+        dan resultados idénticos y no forman parte de la clave.
+        """
+        if self.modelo is None or self.scaler is None:
+            return None
+        parametros = dict(parametros or DECODIFICACION_BGR)
+        parametros["lut_bits"] = self.bits_lut if self.tabla_colores is not None else None
+        parametros["dtype_caracteristicas"] = np.dtype(self.dtype_caracteristicas).name
+        return clave_resultado(imagen_bytes, obtener_huella_modelo(self.modelo_path), parametros)
+    
+    def analizar_imagen_bytes(
+        self,
+        imagen_bytes: bytes,
+        decodificar: Callable[[bytes], Optional[np.ndarray]] = None,
+        parametros: Dict[str, Any] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Clasifica una imagen codificada pasando por la caché persistente de resultados
+        
+        Args:
+            imagen_bytes: Contenido del archivo de imagen
+            decodificar: Convierte los bytes en la imagen a clasificar (por defecto cv2.imdecode, BGR)
+            parametros: Describe `decodificar` (redimensionado, orden de canales...) para la clave de caché
+        
+        Returns:
+            Dict con porcentaje_luz, porcentaje_sombra, total_pixeles_suelo, conteo_clases,
+            dimensiones, ids (alto x ancho uint8) y mascara_luz; None si no se pudo decodificar
+        """
+        cache = obtener_cache_resultados()
+        clave = self.clave_cache(imagen_bytes, parametros) if cache is not None else None
+        if clave is not None:
+            resultado = cache.obtener(clave, con_ids=True)
+            if resultado is not None:
+                print("♻️ Resultado recuperado de la caché")
+                ids = resultado["ids"]
+                resultado["mascara_luz"] = self.mascara_luz_desde_ids(ids, *ids.shape)
+                return resultado
+        
+        if decodificar is None:
+            imagen = cv2.imdecode(np.frombuffer(imagen_bytes, np.uint8), cv2.IMREAD_COLOR)
+        else:
+            imagen = decodificar(imagen_bytes)
+        if imagen is None:
+            return None
+        
+        resultado = self.analizar_imagen(imagen)
+        if clave is not None and resultado["ids"] is not None:
+            try:
+                cache.guardar(
+                    clave,
+                    {k: v for k, v in resultado.items() if k not in ("ids", "mascara_luz")},
+                    resultado["ids"]
+                )
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar en la caché de resultados: {e}")
+        return resultado
+    
+    def analizar_imagen(self, imagen: np.ndarray) -> Dict[str, Any]:
+        """
+        Clasifica una imagen ya decodificada (sin caché)
+        
+        Returns:
+            Dict con el mismo formato que `analizar_imagen_bytes` ('ids' es None sin modelo)
+        """
+        height, width = imagen.shape[:2]
+        
+        if self.modelo is None or self.scaler is None:
+            # Sin modelo: umbral simple, sin ids de clase (no se guarda en caché)
+            porc_luz, porc_sombra, light_mask = self.procesar_imagen_visual(imagen)
+            return {
+                "porcentaje_luz": float(porc_luz),
+                "porcentaje_sombra": float(porc_sombra),
+                "dimensiones": {"ancho": width, "alto": height},
+                "ids": None,
+                "mascara_luz": light_mask
+            }
+        
+        ids = self.clasificar_imagen_ids(imagen).reshape(height, width)
+        conteo = self.contar_clases_ids(ids)
+        porc_luz, porc_sombra, total_suelo = calcular_porcentaje_suelo_conteo(conteo)
+        resultado = {
+            "porcentaje_luz": float(porc_luz),
+            "porcentaje_sombra": float(porc_sombra),
+            "total_pixeles_suelo": int(total_suelo),
+            "conteo_clases": conteo,
+            "dimensiones": {"ancho": width, "alto": height}
+        }
+        resultado["ids"] = ids
+        resultado["mascara_luz"] = self.mascara_luz_desde_ids(ids, height, width)
+        return resultado
+    
+    def _muestrear_bloques(
+        self,
+        imagen: np.ndarray,
+        paso: int,
+        rng: np.random.Generator
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Clasifica un píxel al azar dentro de cada bloque de paso x paso (muestreo estratificado)
+        
+        Returns:
+            Tuple: ids de clase de las muestras (bloques_alto x bloques_ancho) y área de cada bloque
+        """
+        height, width = imagen.shape[:2]
+        alto_bloque = np.minimum(paso, height - np.arange(0, height, paso))
+        ancho_bloque = np.minimum(paso, width - np.arange(0, width, paso))
+        forma = (len(alto_bloque), len(ancho_bloque))
+        filas = np.arange(0, height, paso)[:, None] + (rng.random(forma) * alto_bloque[:, None]).astype(np.intp)
+        columnas = np.arange(0, width, paso)[None, :] + (rng.random(forma) * ancho_bloque[None, :]).astype(np.intp)
+        ids = self.clasificar_imagen_ids(np.ascontiguousarray(imagen[filas, columnas])).reshape(forma)
+        return ids, np.outer(alto_bloque, ancho_bloque)
+    
+    def analizar_imagen_preview(
+        self,
+        imagen: np.ndarray,
+        paso: int = PASO_PREVIEW,
+        refinar: bool = False,
+        confianza: float = CONFIANZA,
+        semilla: int = 0
+    ) -> Dict[str, Any]:
+        """
+        Clasificación aproximada para vistas previas: un píxel al azar de cada bloque de
+        paso x paso (paso 8 = 1/64 de los píxeles) representa a todo su bloque.
+        
+        Con refinar=True, los bloques en un borde entre luz, sombra y el resto (vecindad 3x3
+        de muestras con clases distintas) se clasifican píxel a píxel. Los bloques interiores
+        se estiman con una segunda muestra independiente de la que los eligió: con la misma
+        muestra la estimación quedaría sesgada hacia la clase dominante.
+        
+        Args:
+            paso: Lado del bloque representado por cada muestra
+            refinar: Clasificar a resolución completa los bloques ambiguos
+            confianza: Nivel de confianza del intervalo
+            semilla: Semilla del muestreo (mismo resultado para la misma imagen)
+        
+        Returns:
+            Dict con el mismo formato que `analizar_imagen` (conteos estimados; 'ids' y
+            'mascara_luz' al tamaño completo, con cada muestra extendida a su bloque) y
+            'estimacion': intervalo de confianza del porcentaje de luz, margen de error
+            (puntos porcentuales) y fracción de píxeles clasificados. El intervalo trata
+            las muestras como independientes.
+        """
+        if self.modelo is None or self.scaler is None:
+            resultado = self.analizar_imagen(imagen)
+            resultado["estimacion"] = {"modo": "completo", "margen_error": 0.0}
+            return resultado
+        
+        height, width = imagen.shape[:2]
+        paso = max(1, int(paso))
+        rng = np.random.default_rng(semilla)
+        ids_muestra, areas = self._muestrear_bloques(imagen, paso, rng)
+        ids = np.repeat(np.repeat(ids_muestra, paso, axis=0), paso, axis=1)[:height, :width]
+        
+        # Categoría para el indicador: 1 = luz, 2 = sombra, 0 = resto
+        categorias = np.zeros(len(self.clases), dtype=np.uint8)
+        categorias[self.clases == "LUZ"] = 1
+        categorias[self.clases == "SOMBRA"] = 2
+        
+        refinados = np.zeros(ids_muestra.shape, dtype=bool)
+        if refinar and paso > 1:
+            categoria_muestra = categorias[ids_muestra]
+            nucleo = np.ones((3, 3), dtype=np.uint8)
+            refinados = cv2.dilate(categoria_muestra, nucleo) != cv2.erode(categoria_muestra, nucleo)
+        
+        # Conteo: exacto en los bloques refinados, estimado (muestra x área del bloque) en el resto
+        conteo_ids = np.zeros(len(self.clases))
+        pixeles_refinados = 0
+        if refinados.any():
+            mascara = np.repeat(np.repeat(refinados, paso, axis=0), paso, axis=1)[:height, :width]
+            ids = ids.copy()
+            # Por bandas de filas con un solo buffer, como clasificar_imagen_ids: la máscara
+            # puede cubrir la mayor parte de la imagen
+            filas_por_bloque = max(1, self.pixeles_por_bloque // width)
+            buffer = None
+            if self.tabla_colores is None:
+                buffer = np.empty((10, min(filas_por_bloque, height) * width), dtype=self.dtype_caracteristicas)
+            for y0 in range(0, height, filas_por_bloque):
+                y1 = min(y0 + filas_por_bloque, height)
+                mascara_banda = mascara[y0:y1]
+                if mascara_banda.any():
+                    ids[y0:y1][mascara_banda] = self._clasificar_pixeles(imagen[y0:y1][mascara_banda], buffer)
+            conteo_ids += np.bincount(ids[mascara], minlength=len(self.clases))
+            pixeles_refinados = int(np.count_nonzero(mascara))
+            ids_estimacion, _ = self._muestrear_bloques(imagen, paso, rng)
+        else:
+            ids_estimacion = ids_muestra
+        interiores = ~refinados
+        conteo_ids += np.bincount(
+            ids_estimacion[interiores], weights=areas[interiores], minlength=len(self.clases)
+        )
+        conteo = {clase: int(round(conteo_ids[id_clase])) for id_clase, clase in enumerate(self.clases)}
+        porc_luz, porc_sombra, total_suelo = calcular_porcentaje_suelo_conteo(conteo)
+        
+        # Intervalo del porcentaje de luz sobre suelo: solo la parte estimada aporta error
+        categoria_estimacion = categorias[ids_estimacion[interiores]]
+        luz_muestra = int(np.count_nonzero(categoria_estimacion == 1))
+        suelo_muestra = luz_muestra + int(np.count_nonzero(categoria_estimacion == 2))
+        if pixeles_refinados == 0:
+            inferior, superior = intervalo_wilson(luz_muestra, suelo_muestra, confianza, poblacion=total_suelo)
+        else:
+            suelo_estimado = float(np.sum(areas[interiores] * (categoria_estimacion > 0)))
+            margen = margen_estratificado(
+                luz_muestra / suelo_muestra if suelo_muestra else 0.0,
+                suelo_muestra,
+                suelo_estimado / total_suelo if total_suelo else 0.0,
+                confianza,
+                poblacion_estrato=suelo_estimado
+            )
+            inferior, superior = max(0.0, porc_luz / 100 - margen), min(1.0, porc_luz / 100 + margen)
+        
+        pixeles_clasificados = ids_muestra.size + pixeles_refinados
+        if pixeles_refinados:
+            pixeles_clasificados += ids_estimacion.size
+        return {
+            "porcentaje_luz": float(porc_luz),
+            "porcentaje_sombra": float(porc_sombra),
+            "total_pixeles_suelo": int(total_suelo),
+            "conteo_clases": conteo,
+            "dimensiones": {"ancho": width, "alto": height},
+            "estimacion": {
+                "modo": "preview_refinado" if refinar else "preview",
+                "paso": paso,
+                "confianza": confianza,
+                "intervalo_luz": [round(inferior * 100, 2), round(superior * 100, 2)],
+                "margen_error": round((superior - inferior) * 50, 2),
+                "pixeles_clasificados": int(pixeles_clasificados),
+                "fraccion_clasificada": round(pixeles_clasificados / (height * width), 4),
+                "fraccion_refinada": round(pixeles_refinados / (height * width), 4)
+            },
+            "ids": ids,
+            "mascara_luz": self.mascara_luz_desde_ids(ids, height, width)
+        }
+    
+    def estimar_porcentajes_muestreo(
+        self,
+        imagen: np.ndarray,
+        ancho_objetivo: float = ANCHO_INTERVALO_OBJETIVO,
+        confianza: float = CONFIANZA,
+        muestras_iniciales: int = MUESTRAS_INICIALES,
+        max_muestras: int = MAX_MUESTRAS,
+        semilla: int = 0
+    ) -> Dict[str, Any]:
         """
-        Extrae características optimizadas basadas en análisis de etiquetas
+        Estima los porcentajes de luz y sombra clasificando solo una muestra de píxeles,
+        con tiempo casi constante respecto del tamaño de la imagen.
+        
+        Se toman rondas de muestras estratificadas (ver `muestras_estratificadas`),
+        duplicando el tamaño en cada ronda, hasta que el intervalo de Wilson del porcentaje
+        de luz sobre suelo sea más angosto que `ancho_objetivo` o se llegue a `max_muestras`.
+        Ningún píxel se clasifica dos veces; si la muestra fuera a cubrir toda la imagen,
+        se clasifica completa con `analizar_imagen`.
+        
+        Args:
+            ancho_objetivo: Ancho total del intervalo buscado, en puntos porcentuales
+            confianza: Nivel de confianza del intervalo
+            muestras_iniciales: Píxeles de la primera ronda
+            max_muestras: Tope de píxeles clasificados (aproximado: cada ronda completa su grilla)
+            semilla: Semilla del muestreo (mismo resultado para la misma imagen)
+        
+        Returns:
+            Dict con porcentaje_luz, porcentaje_sombra, total_pixeles_suelo (estimado),
+            conteo_clases (de la muestra), dimensiones y 'estimacion' (intervalo, margen de
+            error, tamaño de muestra, rondas y si se alcanzó el objetivo)
+        """
+        height, width = imagen.shape[:2]
+        total_pixeles = height * width
+        if self.modelo is None or self.scaler is None or muestras_iniciales >= total_pixeles:
+            resultado = self.analizar_imagen(imagen)
+            resultado["estimacion"] = {"modo": "completo", "margen_error": 0.0}
+            return resultado
+        
+        rng = np.random.default_rng(semilla)
+        id_luz = np.flatnonzero(self.clases == "LUZ")
+        id_sombra = np.flatnonzero(self.clases == "SOMBRA")
+        conteo_ids = np.zeros(len(self.clases), dtype=np.int64)
+        # Índices lineales ya clasificados: las rondas no repiten píxeles, así la muestra
+        # acumulada es sin reemplazo y la corrección por población finita es válida
+        vistos = np.empty(0, dtype=np.intp)
+        rondas = 0
+        tamano_ronda = muestras_iniciales
+        while True:
+            filas, columnas = muestras_estratificadas(height, width, tamano_ronda, rng)
+            indices = np.unique(filas * width + columnas)
+            indices = indices[~np.isin(indices, vistos, assume_unique=True)]
+            vistos = np.union1d(vistos, indices)
+            filas, columnas = np.divmod(indices, width)
+            ids = self._clasificar_pixeles(imagen[filas, columnas])
+            conteo_ids += np.bincount(ids, minlength=len(self.clases))
+            rondas += 1
+            
+            muestras = len(vistos)
+            luz = int(conteo_ids[id_luz].sum())
+            suelo = luz + int(conteo_ids[id_sombra].sum())
+            suelo_estimado = suelo / muestras * total_pixeles
+            inferior, superior = intervalo_wilson(luz, suelo, confianza, poblacion=suelo_estimado)
+            alcanzado = (superior - inferior) * 100 <= ancho_objetivo
+            if alcanzado or muestras >= max_muestras:
+                break
+            # Duplicar el total acumulado, sin pasar del tope
+            tamano_ronda = min(muestras, max_muestras - muestras)
+            if muestras + tamano_ronda >= total_pixeles:
+                # La muestra cubriría la imagen: es más barato y exacto clasificarla entera
+                resultado = self.analizar_imagen(imagen)
+                resultado["estimacion"] = {"modo": "completo", "margen_error": 0.0}
+                return resultado
+        
+        conteo = {clase: int(conteo_ids[id_clase]) for id_clase, clase in enumerate(self.clases)}
+        porc_luz, porc_sombra, _ = calcular_porcentaje_suelo_conteo(conteo)
+        print(f"🎯 Muestreo: {muestras} píxeles en {rondas} rondas, luz {inferior * 100:.2f}-{superior * 100:.2f}%")
+        return {
+            "porcentaje_luz": float(porc_luz),
+            "porcentaje_sombra": float(porc_sombra),
+            "total_pixeles_suelo": int(round(suelo_estimado)),
+            "conteo_clases": conteo,
+            "dimensiones": {"ancho": width, "alto": height},
+            "estimacion": {
+                "modo": "muestreo",
+                "confianza": confianza,
+                "intervalo_luz": [round(inferior * 100, 2), round(superior * 100, 2)],
+                "margen_error": round((superior - inferior) * 50, 2),
+                "ancho_objetivo": ancho_objetivo,
+                "alcanzado": bool(alcanzado),
+                "muestras": int(muestras),
+                "rondas": rondas,
+                "fraccion_clasificada": round(min(muestras / total_pixeles, 1.0), 4)
+            }
+        }
+    
+    def extraer_caracteristicas_optimizadas(
+        self,
+        pixeles: np.ndarray,
+        out: np.ndarray = None,
+        dtype=None
+    ) -> np.ndarray:
         """
-        # RGB
-        r, g, b = pixeles[:, 0], pixeles[:, 1], pixeles[:, 2]
+        Extrae las 10 características del modelo (canales, HSV, luminancia, saturación,
+        NDVI aproximado y varianza entre canales) escribiéndolas en un único buffer
         
-        # HSV
-        pixeles_uint8 = pixeles.astype(np.uint8)
-        hsv = cv2.cvtColor(pixeles_uint8.reshape(-1, 1, 3), cv2.COLOR_BGR2HSV).reshape(-1, 3)
-        h, s, v = hsv[:, 0], hsv[:, 1], hsv[:, 2]
+        Args:
+            pixeles: Píxeles BGR uint8, N x 3 o una banda de imagen alto x ancho x 3
+            out: Buffer (10 x capacidad) a reutilizar entre bloques; se usan sus primeras
+                N columnas (por defecto se crea uno nuevo)
+            dtype: Tipo del buffer nuevo (por defecto el del servicio, ver DTYPE_CARACTERISTICAS)
         
-        # Luminancia
-        luminance = 0.299 * r + 0.587 * g + 0.114 * b
+        Returns:
+            np.ndarray: Vista N x 10 del buffer (una fila por píxel)
+        """
+        pixeles = np.ascontiguousarray(pixeles, dtype=np.uint8)
+        plano = pixeles.reshape(-1, 3)
+        n = len(plano)
+        if out is None:
+            out = np.empty((10, n), dtype=dtype or self.dtype_caracteristicas)
+        elif out.shape[0] != 10 or out.shape[1] < n:
+            raise ValueError(f"El buffer de características debe ser 10 x >= {n}, es {out.shape}")
+        f = out[:, :n]
         
-        # Saturación
-        saturation = s
+        # Canales tal como llegan (el modelo se entrenó con este orden)
+        f[0:3] = plano.T
         
-        # NDVI aproximado
-        ndvi = (g - r) / (g + r + 1e-8)
+        # HSV sobre la banda 2-D (o una sola fila), no sobre una tira N x 1
+        imagen = pixeles if pixeles.ndim == 3 else plano.reshape(1, -1, 3)
+        f[3:6] = cv2.cvtColor(imagen, cv2.COLOR_BGR2HSV).reshape(-1, 3).T
         
-        # Textura (varianza local)
-        texture = np.var(pixeles, axis=1)
+        # Textura: varianza de los 3 canales con las mismas operaciones, en el mismo orden, que np.var
+        np.add(f[0], f[1], out=f[6])
+        f[6] += f[2]
+        f[6] /= 3
+        np.subtract(f[0], f[6], out=f[9])
+        np.square(f[9], out=f[9])
+        for canal in (1, 2):
+            np.subtract(f[canal], f[6], out=f[7])
+            np.square(f[7], out=f[7])
+            f[9] += f[7]
+        f[9] /= 3
         
-        return np.column_stack([r, g, b, h, s, v, luminance, saturation, ndvi, texture])
+        # NDVI aproximado; resta y suma en uint8 (con desborde), como en el cálculo original
+        np.subtract(plano[:, 1], plano[:, 0], out=f[8])
+        np.add(plano[:, 1], plano[:, 0], out=f[6])
+        f[6] += 1e-8
+        f[8] /= f[6]
+        
+        # Luminancia (la fila de saturación sirve de temporal)
+        np.multiply(f[0], 0.299, out=f[6])
+        np.multiply(f[1], 0.587, out=f[7])
+        f[6] += f[7]
+        np.multiply(f[2], 0.114, out=f[7])
+        f[6] += f[7]
+        
+        # Saturación: duplicado de S que el modelo espera en su propia columna
+        f[7] = f[4]
+        
+        return f.T
+    
+    def extraer_caracteristicas_escaladas(self, pixeles: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Características ya escaladas, listas para el modelo. Con un StandardScaler la
+        resta de la media y la división por la escala se hacen en el mismo buffer
+        (mismas operaciones que `transform`, resultado idéntico).
+        
+        Args:
+            pixeles: Píxeles BGR uint8, N x 3 o una banda alto x ancho x 3
+            out: Buffer (10 x capacidad) a reutilizar entre bloques
+        
+        Returns:
+            np.ndarray: N x 10 (vista del buffer, salvo con escaladores sin versión en sitio)
+        """
+        caracteristicas = self.extraer_caracteristicas_optimizadas(pixeles, out=out)
+        if not self._scaler_en_sitio:
+            return self.scaler.transform(caracteristicas)
+        
+        filas = caracteristicas.T  # Una fila contigua por característica
+        if self._media_scaler is not None:
+            filas -= self._media_scaler
+        if self._escala_scaler is not None:
+            filas /= self._escala_scaler
+        return caracteristicas
     
     def procesar_imagen_completa(
         self,
@@ -89,30 +736,45 @@ class ProcesamientoServiceV2:
         nombre_json: str
     ) -> Dict[str, Any]:
         """
-        Procesa imagen completa con modelo perfeccionado
+        Procesa imagen completa con modelo perfeccionado (desde archivos en disco)
+        """
+        with open(imagen_path, 'rb') as f:
+            imagen_bytes = f.read()
+        return self.procesar_imagen(imagen_bytes, lugar, nombre_imagen, nombre_json)
+    
+    def procesar_imagen(
+        self,
+        imagen: Union[bytes, np.ndarray],
+        lugar: str,
+        nombre_imagen: str,
+        nombre_json: str
+    ) -> Dict[str, Any]:
+        """
+        Procesa imagen completa con modelo perfeccionado, en memoria
+        
+        Args:
+            imagen: Bytes del archivo (se decodifican con cv2.imdecode y pasan por la caché
+                de resultados) o imagen BGR ya decodificada
         """
         print(f"📸 Procesando: {nombre_imagen}")
         
-        # Cargar imagen
-        imagen = cv2.imread(imagen_path)
-        if imagen is None:
-            raise ValueError(f"No se pudo cargar la imagen: {imagen_path}")
+        # Clasificar la imagen (o recuperar el resultado de la caché)
+        if isinstance(imagen, np.ndarray):
+            analisis = self.analizar_imagen(imagen)
+        else:
+            analisis = self.analizar_imagen_bytes(imagen)
+        if analisis is None or analisis["ids"] is None:
+            raise ValueError(f"No se pudo cargar la imagen: {nombre_imagen}")
         
-        height, width = imagen.shape[:2]
+        ids_pred = analisis["ids"]
+        height, width = ids_pred.shape
         print(f"📏 Dimensiones: {width}x{height}")
         
-        # Procesar imagen completa
-        pixeles = imagen.reshape(-1, 3)
-        caracteristicas = self.extraer_caracteristicas_optimizadas(pixeles)
-        
-        # Escalar características
-        caracteristicas_scaled = self.scaler.transform(caracteristicas)
-        
-        # Clasificar
-        etiquetas_pred = self.modelo.predict(caracteristicas_scaled)
-        
-        # Calcular porcentajes
-        porc_luz, porc_sombra, total_suelo = calcular_porcentaje_suelo(etiquetas_pred)
+        # Porcentajes
+        conteo = analisis["conteo_clases"]
+        porc_luz = analisis["porcentaje_luz"]
+        porc_sombra = analisis["porcentaje_sombra"]
+        total_suelo = analisis["total_pixeles_suelo"]
         
         print(f"📊 Resultados:")
         print(f"  Luz: {porc_luz:.1f}%")
@@ -121,16 +783,16 @@ class ProcesamientoServiceV2:
         
         # Generar imagen resultado
         ruta_imagen_resultado = self._generar_imagen_resultado_completa(
-            imagen, etiquetas_pred, nombre_imagen
+            (height, width), ids_pred, nombre_imagen
         )
         
         # Generar estadísticas detalladas
         estadisticas_detalladas = {
-            "total_pixeles": len(pixeles),
-            "pixeles_luz": np.sum(etiquetas_pred == "LUZ"),
-            "pixeles_sombra": np.sum(etiquetas_pred == "SOMBRA"),
-            "pixeles_tronco": np.sum(etiquetas_pred == "TRONCO"),
-            "pixeles_ignorado": np.sum(etiquetas_pred == "IGNORADO"),
+            "total_pixeles": height * width,
+            "pixeles_luz": conteo.get("LUZ", 0),
+            "pixeles_sombra": conteo.get("SOMBRA", 0),
+            "pixeles_tronco": conteo.get("TRONCO", 0),
+            "pixeles_ignorado": conteo.get("IGNORADO", 0),
             "dimensiones": {"ancho": width, "alto": height}
         }
         
@@ -151,35 +813,17 @@ class ProcesamientoServiceV2:
     
     def _generar_imagen_resultado_completa(
         self,
-        imagen_original: np.ndarray,
-        etiquetas_pred_labels: np.ndarray,
+        dimensiones: Tuple[int, int],
+        ids_pred: np.ndarray,
         nombre_imagen: str
     ) -> str:
         """
         Genera imagen resultado completa con colores correctos
         """
-        height, width = imagen_original.shape[:2]
-        
-        # Crear visualización
-        visual_rgb = np.zeros((height, width, 3), dtype=np.uint8)
-        
-        # Mapear etiquetas a colores
-        mask_luz = etiquetas_pred_labels == "LUZ"
-        mask_sombra = etiquetas_pred_labels == "SOMBRA"
-        mask_tronco = etiquetas_pred_labels == "TRONCO"
-        mask_ignorado = etiquetas_pred_labels == "IGNORADO"
+        height, width = dimensiones
         
-        # Reshape para imagen 2D
-        mask_luz_2d = mask_luz.reshape((height, width))
-        mask_sombra_2d = mask_sombra.reshape((height, width))
-        mask_tronco_2d = mask_tronco.reshape((height, width))
-        mask_ignorado_2d = mask_ignorado.reshape((height, width))
-        
-        # Aplicar colores (BGR format)
-        visual_rgb[mask_luz_2d] = [0, 255, 255]      # Amarillo para luz (BGR)
-        visual_rgb[mask_sombra_2d] = [50, 50, 50]    # Gris para sombra
-        visual_rgb[mask_tronco_2d] = [0, 0, 255]     # Rojo para tronco (BGR)
-        visual_rgb[mask_ignorado_2d] = [0, 0, 255]   # Rojo para ignorado (BGR)
+        # Mapear ids de clase a colores (BGR) con una sola tabla de consulta
+        visual_rgb = self._lut_colores[ids_pred].reshape((height, width, 3))
         
         # Crear directorio de resultados si no existe
         os.makedirs("resultados", exist_ok=True)
@@ -194,40 +838,17 @@ class ProcesamientoServiceV2:
     
     def procesar_imagen_bytes(
         self,
-        imagen_bytes: bytes,
+        imagen_bytes: Union[bytes, np.ndarray],
         anotaciones_json: str,
         lugar: str,
         nombre_imagen: str = "imagen.jpg",
         nombre_json: str = "anotaciones.json"
     ) -> Dict[str, Any]:
         """
-        Procesa imagen desde bytes (para API)
+        Procesa imagen desde bytes (para API), sin archivos temporales: se decodifica
+        directamente del buffer (o se usa el ndarray si ya viene decodificada)
         """
-        # Crear archivos temporales
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp_img:
-            temp_img.write(imagen_bytes)
-            temp_img_path = temp_img.name
-        
-        with tempfile.NamedTemporaryFile(mode='w', suffix=".json", delete=False) as temp_json:
-            temp_json.write(anotaciones_json)
-            temp_json_path = temp_json.name
-        
-        try:
-            # Procesar imagen
-            resultado = self.procesar_imagen_completa(
-                temp_img_path,
-                temp_json_path,
-                lugar,
-                nombre_imagen,
-                nombre_json
-            )
-            
-            return resultado
-            
-        finally:
-            # Limpiar archivos temporales
-            os.unlink(temp_img_path)
-            os.unlink(temp_json_path)
+        return self.procesar_imagen(imagen_bytes, lugar, nombre_imagen, nombre_json)
     
     def procesar_imagen_visual(self, imagen: np.ndarray) -> Tuple[float, float, np.ndarray]:
         """
@@ -239,38 +860,17 @@ class ProcesamientoServiceV2:
             
             # Aplicar el modelo si está disponible
             if self.modelo is not None and self.scaler is not None:
-                # Procesar imagen completa como en el código original
-                pixeles = imagen.reshape(-1, 3)
-                caracteristicas = self.extraer_caracteristicas_optimizadas(pixeles)
-                
-                # Escalar características
-                caracteristicas_scaled = self.scaler.transform(caracteristicas)
-                
-                # Clasificar
-                etiquetas_pred = self.modelo.predict(caracteristicas_scaled)
+                # Procesar imagen completa por bloques (ids de clase uint8)
+                ids_pred = self.clasificar_imagen_ids(imagen)
                 
-                # Decodificar etiquetas si hay encoder
-                if self.encoder is not None:
-                    etiquetas_pred = self.encoder.inverse_transform(etiquetas_pred)
+                conteo = self.contar_clases_ids(ids_pred)
+                print(f"🔍 Etiquetas predichas: {conteo}")
                 
-                print(f"🔍 Etiquetas predichas: {np.unique(etiquetas_pred, return_counts=True)}")
-                
-                # Calcular porcentajes usando la función original
-                from src.procesamiento.postprocesamiento import calcular_porcentaje_suelo
-                porc_luz, porc_sombra, total_suelo = calcular_porcentaje_suelo(etiquetas_pred)
-                
-                # Crear máscaras como en el código original
-                mask_luz = etiquetas_pred == "LUZ"
-                mask_sombra = etiquetas_pred == "SOMBRA"
-                
-                # Reshape para imagen 2D
-                mask_luz_2d = mask_luz.reshape((height, width))
-                mask_sombra_2d = mask_sombra.reshape((height, width))
+                # Calcular porcentajes a partir del conteo por clase
+                porc_luz, porc_sombra, total_suelo = calcular_porcentaje_suelo_conteo(conteo)
                 
                 # Crear máscara combinada (luz = 255, sombra = 128, resto = 0)
-                light_mask = np.zeros((height, width), dtype=np.uint8)
-                light_mask[mask_luz_2d] = 255
-                light_mask[mask_sombra_2d] = 128
+                light_mask = self.mascara_luz_desde_ids(ids_pred, height, width)
                 
                 print(f"🤖 Modelo aplicado - Luz: {porc_luz:.1f}%, Sombra: {porc_sombra:.1f}%")
                 
@@ -294,6 +894,112 @@ class ProcesamientoServiceV2:
             # Fallback: porcentajes aleatorios para testing
             return 50.0, 50.0, np.zeros((imagen.shape[0], imagen.shape[1]), dtype=np.uint8)
     
+    def procesar_lote(
+        self,
+        imagenes: Iterable[Union[bytes, np.ndarray]],
+        decodificar: Callable[[bytes], Optional[np.ndarray]] = None,
+        parametros: Dict[str, Any] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Procesa un lote de imágenes (bytes codificados o arrays ya decodificados) con el
+        mínimo de llamadas al modelo: se calcula el histograma de colores de cada imagen,
+        se clasifica una sola vez la unión de colores de todo el lote (por bloques) y los
+        porcentajes de cada imagen se obtienen ponderando por el conteo de cada color.
+        
+        Las imágenes se recorren una sola vez, así que `imagenes` puede ser un generador
+        (solo una imagen decodificada en memoria a la vez). Las que llegan como bytes pasan
+        por la caché de resultados: un acierto no se decodifica ni se clasifica.
+        
+        Los tres pasos (`histogramar_lote`, `clasificar_colores`, `completar_lote`) también
+        se pueden ejecutar por separado, ej. repartidos entre varios procesos.
+        
+        Args:
+            imagenes: Imágenes codificadas (bytes) o decodificadas (BGR)
+            decodificar: Convierte bytes en imagen (por defecto cv2.imdecode, BGR)
+            parametros: Describe `decodificar` para la clave de caché
+        
+        Returns:
+            Lista alineada con la entrada; cada elemento tiene porcentaje_luz,
+            porcentaje_sombra, total_pixeles_suelo y dimensiones, o "error" si falló.
+        """
+        resultados, histogramas, claves = self.histogramar_lote(imagenes, decodificar, parametros)
+        colores = union_colores(histogramas)
+        if len(colores) == 0:
+            return resultados
+        
+        ids_colores = self.clasificar_colores(colores)
+        print(f"📦 Lote: {len(resultados)} imágenes, {len(colores)} colores distintos clasificados")
+        return completar_lote(resultados, histogramas, claves, colores, ids_colores, self.clases)
+    
+    def histogramar_lote(
+        self,
+        imagenes: Iterable[Union[bytes, np.ndarray]],
+        decodificar: Callable[[bytes], Optional[np.ndarray]] = None,
+        parametros: Dict[str, Any] = None
+    ) -> Tuple[List[Dict[str, Any]], List[Optional[Tuple[np.ndarray, np.ndarray]]], List[Optional[str]]]:
+        """
+        Primer paso de `procesar_lote`: decodifica cada imagen y calcula su histograma de colores
+        
+        Returns:
+            (resultados, histogramas, claves) alineados con la entrada. El histograma es
+            (índices de color, conteos), o None si la imagen ya quedó resuelta (acierto de
+            caché, error o fallback sin modelo); la clave es la de la caché de resultados.
+        """
+        resultados = []
+        histogramas = []
+        claves = []
+        cache = obtener_cache_resultados()
+        
+        for indice, imagen in enumerate(imagenes):
+            clave = None
+            if isinstance(imagen, (bytes, bytearray)):
+                clave = self.clave_cache(imagen, parametros) if cache is not None else None
+                guardado = cache.obtener(clave) if clave is not None else None
+                if guardado is not None:
+                    resultados.append({"indice": indice, **guardado})
+                    histogramas.append(None)
+                    claves.append(None)
+                    continue
+                if decodificar is None:
+                    imagen = cv2.imdecode(np.frombuffer(imagen, np.uint8), cv2.IMREAD_COLOR)
+                else:
+                    imagen = decodificar(imagen)
+            claves.append(clave)
+            if imagen is None:
+                resultados.append({"indice": indice, "error": "No se pudo decodificar la imagen"})
+                histogramas.append(None)
+                continue
+            
+            height, width = imagen.shape[:2]
+            resultados.append({"indice": indice, "dimensiones": {"ancho": width, "alto": height}})
+            
+            if self.modelo is None or self.scaler is None:
+                # Sin modelo: mismo fallback por umbral que procesar_imagen_visual
+                porc_luz, porc_sombra, _ = self.procesar_imagen_visual(imagen)
+                resultados[-1].update({"porcentaje_luz": float(porc_luz), "porcentaje_sombra": float(porc_sombra)})
+                histogramas.append(None)
+                continue
+            
+            histogramas.append(np.unique(indices_color(imagen.reshape(-1, 3)), return_counts=True))
+        
+        return resultados, histogramas, claves
+    
+    def clasificar_colores(self, colores: np.ndarray) -> np.ndarray:
+        """
+        Segundo paso de `procesar_lote`: clasifica índices de color (ver `indices_color`) por bloques
+        
+        Returns:
+            np.ndarray: Id de clase (uint8) de cada color
+        """
+        ids_colores = np.empty(len(colores), dtype=np.uint8)
+        if len(colores) == 0:
+            return ids_colores
+        buffer = np.empty((10, min(self.pixeles_por_bloque, len(colores))), dtype=self.dtype_caracteristicas)
+        for inicio in range(0, len(colores), self.pixeles_por_bloque):
+            fin = min(inicio + self.pixeles_por_bloque, len(colores))
+            ids_colores[inicio:fin] = self._clasificar_pixeles(pixeles_desde_indices(colores[inicio:fin]), buffer)
+        return ids_colores
+    
     def _extraer_caracteristicas_simples(self, gray: np.ndarray) -> np.ndarray:
         """
         Extrae características simples de la imagen en escala de grises
@@ -312,4 +1018,84 @@ class ProcesamientoServiceV2:
             hist_normalized
         ])
         
-        return features
\ No newline at end of file
+        return features
+
+
+def union_colores(histogramas: Iterable[Optional[Tuple[np.ndarray, np.ndarray]]]) -> np.ndarray:
+    """Índices de color distintos (ordenados) de un conjunto de histogramas de `histogramar_lote`"""
+    colores = [colores_imagen for colores_imagen, _ in (h for h in histogramas if h is not None)]
+    if not colores:
+        return np.empty(0, dtype=np.uint32)
+    return np.unique(np.concatenate(colores))
+
+
+def completar_lote(
+    resultados: List[Dict[str, Any]],
+    histogramas: List[Optional[Tuple[np.ndarray, np.ndarray]]],
+    claves: List[Optional[str]],
+    colores: np.ndarray,
+    ids_colores: np.ndarray,
+    clases: np.ndarray
+) -> List[Dict[str, Any]]:
+    """
+    Último paso de `procesar_lote`: conteo por clase de cada imagen, ponderando por la
+    frecuencia de cada color, y guardado en la caché de resultados. No necesita el modelo.
+    
+    Args:
+        resultados, histogramas, claves: Salida de `histogramar_lote`
+        colores: Unión ordenada de los colores de los histogramas (`union_colores`)
+        ids_colores: Id de clase de cada color (`clasificar_colores`)
+        clases: Nombre de clase de cada id
+    
+    Returns:
+        List: Los mismos `resultados`, completados
+    """
+    cache = obtener_cache_resultados()
+    for resultado, histograma, clave in zip(resultados, histogramas, claves):
+        if histograma is None:
+            continue
+        colores_imagen, cuentas = histograma
+        ids = ids_colores[np.searchsorted(colores, colores_imagen)]
+        conteo_ids = np.bincount(ids, weights=cuentas, minlength=len(clases))
+        conteo = {clase: int(conteo_ids[id_clase]) for id_clase, clase in enumerate(clases)}
+        
+        porc_luz, porc_sombra, total_suelo = calcular_porcentaje_suelo_conteo(conteo)
+        resultado.update({
+            "porcentaje_luz": float(porc_luz),
+            "porcentaje_sombra": float(porc_sombra),
+            "total_pixeles_suelo": int(total_suelo),
+            "conteo_clases": conteo
+        })
+        
+        # Solo porcentajes: el lote no calcula la máscara de ids por píxel
+        if clave is not None and cache is not None:
+            try:
+                cache.guardar(clave, {k: v for k, v in resultado.items() if k != "indice"})
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar en la caché de resultados: {e}")
+    
+    return resultados
+
+
+def _construir_servicio_lut(modelo_path: str) -> ProcesamientoServiceV2:
+    """Construye el servicio en modo LUT (bits por canal desde MODELO_LUT_BITS)"""
+    return ProcesamientoServiceV2(
+        modelo_path,
+        usar_lut=True,
+        bits_lut=int(os.getenv('MODELO_LUT_BITS', BITS_COMPLETOS))
+    )
+
+
+def obtener_servicio(modelo_path: str = "modelo_perfeccionado.pkl", usar_lut: bool = None) -> ProcesamientoServiceV2:
+    """
+    Devuelve el servicio compartido del proceso para `modelo_path`.
+    Se construye una sola vez y se reconstruye solo si el archivo del modelo cambia.
+    
+    Si usar_lut es None, el modo LUT se activa con la variable de entorno MODELO_MODO_LUT=1.
+    Con MODELO_ARBOLES_COMPILADOS=1 el modelo se evalúa con los árboles compilados
+    (ver src/services/arboles_compilados.py) en lugar de scikit-learn.
+    """
+    if usar_lut is None:
+        usar_lut = os.getenv('MODELO_MODO_LUT', '').lower() in ('1', 'true', 'si', 'sí')
+    cargador = _construir_servicio_lut if usar_lut else ProcesamientoServiceV2
+    return registro_modelos.obtener(modelo_path, cargador)
@@ -0,0 +1,123 @@
+"""
+Registro de modelos compartido por todo el proceso.
+
+Carga cada artefacto (.pkl) una sola vez, de forma perezosa y segura entre hilos,
+y lo vuelve a cargar automáticamente si el archivo cambia en disco (mtime).
+Lo usan la API (FastAPI), la app de Streamlit y `clasificar_imagen`.
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+from typing import Any, Callable, Dict, Tuple
+
+import joblib
+
+
+def cargar_artefacto(ruta: str) -> Any:
+    """
+    Carga un artefacto serializado con joblib, con fallback a pickle
+
+    Args:
+        ruta: Ruta del archivo .pkl
+
+    Returns:
+        El objeto deserializado (ej. tupla (modelo, scaler[, encoder]))
+    """
+    try:
+        artefacto = joblib.load(ruta)
+        print(f"✅ Modelo cargado con joblib desde: {ruta}")
+    except FileNotFoundError:
+        raise
+    except Exception as joblib_error:
+        print(f"⚠️ Joblib falló, intentando con pickle: {joblib_error}")
+        with open(ruta, 'rb') as f:
+            artefacto = pickle.load(f)
+        print(f"✅ Modelo cargado con pickle desde: {ruta}")
+    return artefacto
+
+
+def huella_archivo(ruta: str) -> str:
+    """
+    Huella SHA-256 del contenido de un archivo (identifica una versión concreta del modelo)
+
+    Args:
+        ruta: Ruta del archivo
+
+    Returns:
+        str: Hash hexadecimal
+    """
+    sha = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 20), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+
+class RegistroModelos:
+    """Caché de objetos construidos a partir de archivos, indexada por ruta y mtime"""
+
+    def __init__(self):
+        self._entradas: Dict[Tuple[str, Callable], Tuple[int, Any]] = {}
+        self._locks: Dict[Tuple[str, Callable], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, ruta: str, cargador: Callable[[str], Any] = cargar_artefacto) -> Any:
+        """
+        Devuelve el objeto asociado a `ruta`, cargándolo con `cargador` solo si aún no
+        está en caché o si el archivo fue modificado desde la última carga
+
+        Args:
+            ruta: Ruta del archivo del modelo
+            cargador: Función que construye el objeto a partir de la ruta
+
+        Returns:
+            El objeto cargado (compartido entre todas las llamadas del proceso)
+        """
+        ruta_abs = os.path.abspath(ruta)
+        mtime = os.stat(ruta_abs).st_mtime_ns
+        clave = (ruta_abs, cargador)
+
+        entrada = self._entradas.get(clave)
+        if entrada is not None and entrada[0] == mtime:
+            return entrada[1]
+
+        with self._lock:
+            lock_clave = self._locks.setdefault(clave, threading.Lock())
+
+        # Un lock por clave: otras rutas no esperan mientras se carga esta
+        with lock_clave:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada[0] == mtime:
+                return entrada[1]
+
+            if entrada is not None:
+                print(f"🔄 Modelo modificado en disco, recargando: {ruta_abs}")
+            objeto = cargador(ruta)
+            self._entradas[clave] = (mtime, objeto)
+            return objeto
+
+    def invalidar(self, ruta: str = None):
+        """Descarta de la caché la ruta indicada (o todas si no se indica)"""
+        with self._lock:
+            if ruta is None:
+                self._entradas.clear()
+                return
+            ruta_abs = os.path.abspath(ruta)
+            for clave in [clave for clave in self._entradas if clave[0] == ruta_abs]:
+                del self._entradas[clave]
+
+
+# Instancia única por proceso
+registro_modelos = RegistroModelos()
+
+
+def obtener_modelo(ruta: str) -> Any:
+    """Atajo para obtener un artefacto deserializado desde el registro del proceso"""
+    return registro_modelos.obtener(ruta, cargar_artefacto)
+
+
+def obtener_huella_modelo(ruta: str) -> str:
+    """Huella del modelo, calculada una vez por versión del archivo (mtime)"""
+    return registro_modelos.obtener(ruta, huella_archivo)
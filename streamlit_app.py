@@ -151,44 +151,41 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Índice jerárquico de Data-campo (uno por proceso de Streamlit, refrescado en segundo plano)
+@st.cache_resource
+def obtener_indice_campo():
+    """Índice empresa → fundo → sector → lote; None si no hay hoja configurada"""
+    import sys
+    import os
+    import functools
+    sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+    
+    from google_sheets.sheets_client import GoogleSheetsClient
+    from google_sheets.indice_jerarquia import obtener_indice
+    
+    client = GoogleSheetsClient()
+    if not client.spreadsheet_id:
+        return None
+    
+    return obtener_indice(
+        client.spreadsheet_id, functools.partial(client.leer_datos_campo, client.spreadsheet_id)
+    )
+
 # Función para cargar datos reales de Google Sheets
-@st.cache_data(ttl=300)  # Cache por 5 minutos
 def load_dropdown_data():
-    """Cargar datos reales de Google Sheets"""
+    """Cargar datos reales de Google Sheets (desde el índice de Data-campo)"""
     try:
-        # Importar el cliente de Google Sheets
-        import sys
-        import os
-        sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
-        
-        from google_sheets.sheets_client import GoogleSheetsClient
-        
-        # Inicializar cliente
-        client = GoogleSheetsClient()
-        
-        # Cargar datos de la hoja "Data-campo"
-        empresas = client.get_column_data('Data-campo', 'B')[1:]  # Columna B, sin header
-        fundos = client.get_column_data('Data-campo', 'D')[1:]    # Columna D, sin header
-        sectores = client.get_column_data('Data-campo', 'G')[1:]  # Columna G, sin header
-        lotes = client.get_column_data('Data-campo', 'I')[1:]     # Columna I, sin header
+        indice = obtener_indice_campo()
+        if indice is None:
+            raise Exception("No se pudo cargar el ID de la hoja de cálculo")
         
-        # Filtrar valores únicos y no vacíos
-        empresas = list(set([emp for emp in empresas if emp and emp.strip()]))
-        fundos = list(set([fun for fun in fundos if fun and fun.strip()]))
-        sectores = list(set([sec for sec in sectores if sec and sec.strip()]))
-        lotes = list(set([lot for lot in lotes if lot and lot.strip()]))
-        
-        # Ordenar alfabéticamente
-        empresas.sort()
-        fundos.sort()
-        sectores.sort()
-        lotes.sort()
+        datos, _ = indice.obtener()
         
         return {
-            'empresas': empresas,
-            'fundos': fundos,
-            'sectores': sectores,
-            'lotes': lotes
+            'empresas': datos['empresa'],
+            'fundos': datos['fundo'],
+            'sectores': datos['sector'],
+            'lotes': datos['lote']
         }
         
     except Exception as e:
@@ -201,65 +198,118 @@ def load_dropdown_data():
             'lotes': ['Lote 1', 'Lote 2', 'Lote 3']
         }
 
-# Función para cargar todos los datos de la hoja con cache
-@st.cache_data(ttl=300)  # Cache por 5 minutos
-def load_sheet_data():
-    """Cargar todos los datos de la hoja Data-campo"""
+# Espejo local de la hoja de registros (uno por proceso de Streamlit, sincronizado en segundo plano)
+@st.cache_resource
+def obtener_espejo_historial():
+    """Espejo local de la hoja Data-app; None si no hay hoja configurada"""
+    import sys
+    import os
+    import json
+    import functools
+    sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+    
+    from google_sheets.sheets_client import GoogleSheetsClient
+    from google_sheets.espejo_registros import obtener_espejo
+    
+    client = GoogleSheetsClient()
+    if not client.spreadsheet_id:
+        return None
+    
     try:
-        import sys
-        import os
-        sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
-        
-        from google_sheets.sheets_client import GoogleSheetsClient
-        
-        client = GoogleSheetsClient()
-        return client.get_sheet_data('Data-campo')
+        with open('google_sheets_config.json', 'r') as f:
+            sheet_name = json.load(f).get('sheet_name', 'Data-app')
+    except Exception:
+        sheet_name = 'Data-app'
+    
+    return obtener_espejo(
+        client.spreadsheet_id, sheet_name,
+        functools.partial(client.leer_filas, client.spreadsheet_id, sheet_name)
+    )
+
+# Polígonos de lotes/hileras para asignar fotos por GPS (uno por proceso de Streamlit)
+@st.cache_resource
+def obtener_indice_parcelas_gps():
+    """Índice de parcelas (GeoJSON local); None si no hay archivo de parcelas"""
+    import sys
+    import os
+    sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+    
+    from metadata.parcelas import obtener_indice_parcelas
+    
+    return obtener_indice_parcelas()
+
+# Preprocesamiento de preparar_imagen (forma parte de la clave de la caché de resultados)
+MAX_DIMENSION_IMAGEN = 2048
+PARAMETROS_PREPARACION = {"decodificacion": "preparar_imagen", "max_dimension": MAX_DIMENSION_IMAGEN, "canales": "RGB"}
+
+# Función para decodificar y preparar una imagen para el modelo
+def preparar_imagen(image_bytes):
+    """Decodifica la imagen, la redimensiona si es muy grande y la convierte a RGB"""
+    # Convertir bytes a imagen OpenCV
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    
+    # Optimización para imágenes grandes: redimensionar si es necesario
+    original_height, original_width = img.shape[:2]
+    max_dimension = MAX_DIMENSION_IMAGEN  # Máximo 2048px en cualquier dimensión
+    
+    if original_height > max_dimension or original_width > max_dimension:
+        # Calcular factor de escala
+        scale_factor = min(max_dimension / original_height, max_dimension / original_width)
+        new_width = int(original_width * scale_factor)
+        new_height = int(original_height * scale_factor)
         
-    except Exception as e:
-        print(f"Error cargando datos de hoja: {e}")
-        return []
+        # Redimensionar imagen
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
+        st.info(f"📏 Imagen redimensionada de {original_width}x{original_height} a {new_width}x{new_height} para optimizar memoria")
+    
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+# Función para obtener el servicio de procesamiento compartido
+def obtener_servicio_ml():
+    """Servicio compartido del proceso (el modelo se carga una sola vez)"""
+    import sys
+    import os
+    sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+    
+    from services.procesamiento_service_v2 import obtener_servicio
+    
+    return obtener_servicio("modelo_perfeccionado.pkl")
 
-# Función para análisis de imagen con modelo Random Forest original
-def analizar_imagen_ml(image_bytes):
-    """Analizar imagen usando el modelo Random Forest original"""
+# Función para análisis de imagen con el modelo de árboles (HistGradientBoosting)
+def analizar_imagen_ml(image_bytes, preview=False, refinar=False):
+    """
+    Analizar imagen usando el modelo perfeccionado (HistGradientBoosting)
+    Con preview=True clasifica solo una muestra de píxeles (ver analizar_imagen_preview)
+    y el resultado incluye 'estimacion' con el intervalo de confianza.
+    """
     try:
         # Verificar si el modelo está disponible
         if not model_available:
             st.error("❌ Modelo no disponible. Por favor, sube el archivo modelo_perfeccionado.pkl")
             return None
             
-        # Importar el servicio de procesamiento original
-        import sys
-        import os
-        sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
-        
-        from services.procesamiento_service_v2 import ProcesamientoServiceV2
-        
-        # Crear instancia del servicio
-        servicio = ProcesamientoServiceV2("modelo_perfeccionado.pkl")
-        
-        # Convertir bytes a imagen OpenCV
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        # Optimización para imágenes grandes: redimensionar si es necesario
-        original_height, original_width = img.shape[:2]
-        max_dimension = 2048  # Máximo 2048px en cualquier dimensión
-        
-        if original_height > max_dimension or original_width > max_dimension:
-            # Calcular factor de escala
-            scale_factor = min(max_dimension / original_height, max_dimension / original_width)
-            new_width = int(original_width * scale_factor)
-            new_height = int(original_height * scale_factor)
-            
-            # Redimensionar imagen
-            img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-            st.info(f"📏 Imagen redimensionada de {original_width}x{original_height} a {new_width}x{new_height} para optimizar memoria")
+        # Servicio de procesamiento original
+        servicio = obtener_servicio_ml()
         
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img_rgb = preparar_imagen(image_bytes)
+        if img_rgb is None:
+            st.error("❌ No se pudo leer la imagen")
+            return None
         
-        # Procesar imagen con el modelo original
-        light_percentage, shadow_percentage, light_mask = servicio.procesar_imagen_visual(img_rgb)
+        if preview:
+            # Vista previa aproximada: muestra de píxeles, con margen de error
+            analisis = servicio.analizar_imagen_preview(img_rgb, refinar=refinar)
+        else:
+            # Procesar imagen con el modelo original (o recuperar el resultado de la caché)
+            analisis = servicio.analizar_imagen_bytes(
+                image_bytes, decodificar=lambda _: img_rgb, parametros=PARAMETROS_PREPARACION
+            )
+        light_percentage = analisis['porcentaje_luz']
+        shadow_percentage = analisis['porcentaje_sombra']
+        light_mask = analisis['mascara_luz']
         
         # Crear imagen de análisis visual
         analysis_img = img_rgb.copy()
@@ -272,11 +322,12 @@ def analizar_imagen_ml(image_bytes):
             'shadow_percentage': shadow_percentage,
             'analysis_image': analysis_img,
             'original_image': img_rgb,
-            'processing_time': 0
+            'processing_time': 0,
+            'estimacion': analisis.get('estimacion')
         }
         
         # Limpiar variables grandes de memoria
-        del img, img_rgb, nparr
+        del img_rgb
         if 'light_mask' in locals():
             del light_mask
         if 'analysis_img' in locals():
@@ -290,15 +341,44 @@ def analizar_imagen_ml(image_bytes):
     except Exception as e:
         st.error(f"Error en análisis ML: {str(e)}")
         # Limpiar memoria en caso de error
-        if 'img' in locals():
-            del img
         if 'img_rgb' in locals():
             del img_rgb
-        if 'nparr' in locals():
-            del nparr
         gc.collect()
         return None
 
+# Función para análisis de un lote de imágenes en una sola pasada del modelo
+def analizar_lote_ml(lista_image_bytes):
+    """
+    Analiza varias imágenes clasificando juntos los colores de todo el lote.
+    Retorna una lista alineada con la entrada (None para las imágenes que fallaron).
+    """
+    try:
+        if not model_available:
+            st.error("❌ Modelo no disponible. Por favor, sube el archivo modelo_perfeccionado.pkl")
+            return [None] * len(lista_image_bytes)
+        
+        servicio = obtener_servicio_ml()
+        
+        # Se decodifican de a una (y solo las que no están en la caché de resultados)
+        resultados_lote = servicio.procesar_lote(
+            lista_image_bytes, decodificar=preparar_imagen, parametros=PARAMETROS_PREPARACION
+        )
+        gc.collect()
+        
+        return [
+            {
+                'light_percentage': r['porcentaje_luz'],
+                'shadow_percentage': r['porcentaje_sombra'],
+                'processing_time': 0
+            } if 'error' not in r else None
+            for r in resultados_lote
+        ]
+        
+    except Exception as e:
+        st.error(f"Error en análisis ML del lote: {str(e)}")
+        gc.collect()
+        return [None] * len(lista_image_bytes)
+
 # Función para extraer información del nombre del archivo
 def extract_info_from_filename(filename):
     """
@@ -319,76 +399,76 @@ def extract_info_from_filename(filename):
     
     return None, None
 
-# Función para extraer información GPS de la imagen
-def extract_gps_info(image_bytes):
-    """
-    Extrae información GPS de los metadatos EXIF de la imagen
-    Retorna: (latitud, longitud) si encuentra GPS, (None, None) si no
+# Pre-escaneo de metadatos de los archivos subidos
+def preescanear_archivos(uploaded_files):
     """
-    try:
-        from PIL import Image
-        from PIL.ExifTags import TAGS, GPSTAGS
-        import io
-        
-        # Crear objeto Image desde bytes
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Obtener metadatos EXIF
-        exifdata = image.getexif()
-        
-        # Buscar información GPS
-        gps_info = None
-        for tag_id in exifdata:
-            tag = TAGS.get(tag_id, tag_id)
-            if tag == "GPSInfo":
-                gps_info = exifdata[tag_id]
-                break
-        
-        if gps_info:
-            # Extraer latitud y longitud
-            lat = gps_info.get(2)  # GPSLatitude
-            lat_ref = gps_info.get(1)  # GPSLatitudeRef
-            lon = gps_info.get(4)  # GPSLongitude  
-            lon_ref = gps_info.get(3)  # GPSLongitudeRef
-            
-            if lat and lon:
-                # Convertir a decimal
-                lat_decimal = convert_to_decimal(lat, lat_ref)
-                lon_decimal = convert_to_decimal(lon, lon_ref)
-                
-                if lat_decimal and lon_decimal:
-                    return lat_decimal, lon_decimal
-        
-        return None, None
-        
-    except Exception as e:
-        # Si hay cualquier error, retornar None (sin GPS)
-        print(f"⚠️ Error leyendo GPS: {str(e)}")
-        return None, None
-
-def convert_to_decimal(coord, ref):
-    """
-    Convierte coordenadas GPS de grados/minutos/segundos a decimal
+    Extrae EXIF/GPS (lector compartido con la API), hilera/planta del nombre y la parcela por GPS
+    de todos los archivos nuevos en un pool de hilos. Los resultados se memorizan en session_state
+    por hash del contenido, así que un rerun no vuelve a leer ningún archivo.
+    
+    Returns:
+        list: Clave de cada archivo (hash del contenido), en el mismo orden
     """
-    try:
-        if not coord or not ref:
-            return None
-            
-        # coord es una tupla (grados, minutos, segundos)
-        degrees = float(coord[0])
-        minutes = float(coord[1])
-        seconds = float(coord[2])
-        
-        decimal = degrees + (minutes / 60.0) + (seconds / 3600.0)
-        
-        # Aplicar referencia (N/S, E/W)
-        if ref in ['S', 'W']:
-            decimal = -decimal
-            
-        return decimal
-        
-    except Exception:
-        return None
+    import sys
+    import os
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+    ruta_src = os.path.join(os.path.dirname(__file__), 'src')
+    if ruta_src not in sys.path:  # Se llama en cada rerun
+        sys.path.append(ruta_src)
+    
+    from metadata.lector_exif import leer_exif
+    
+    metadatos = st.session_state.setdefault('metadatos_archivos', {})  # hash -> metadatos
+    hashes = st.session_state.setdefault('hash_archivos', {})  # archivo subido -> hash
+    
+    def id_archivo(file):
+        return getattr(file, 'file_id', None) or (file.name, file.size)
+    
+    def escanear(file):
+        contenido = file.getvalue()
+        clave = hashlib.sha256(contenido).hexdigest()
+        if clave in metadatos:
+            return clave, None
+        try:
+            datos_exif = leer_exif(contenido)
+            lat, lon = datos_exif.latitud, datos_exif.longitud
+        except Exception as e:
+            # Si hay error, asumir sin GPS
+            lat, lon = None, None
+            print(f"⚠️ Error detectando GPS para {file.name}: {str(e)}")
+        hilera, planta = extract_info_from_filename(file.name)
+        return clave, {
+            'gps_detected': lat is not None and lon is not None,
+            'gps_lat': lat,
+            'gps_lon': lon,
+            'hilera': hilera,
+            'n_planta': planta,
+            'parcela': None
+        }
+    
+    pendientes = [file for file in uploaded_files if id_archivo(file) not in hashes]
+    if pendientes:
+        nuevos = []
+        with ThreadPoolExecutor(max_workers=min(8, len(pendientes))) as pool:
+            for file, (clave, datos) in zip(pendientes, pool.map(escanear, pendientes)):
+                hashes[id_archivo(file)] = clave
+                if datos is not None and clave not in metadatos:
+                    metadatos[clave] = datos
+                    nuevos.append(clave)
+        
+        # Lote/hilera por GPS de todos los archivos nuevos en una sola consulta
+        con_gps = [clave for clave in nuevos if metadatos[clave]['gps_detected']]
+        indice_parcelas = obtener_indice_parcelas_gps() if con_gps else None
+        if indice_parcelas is not None:
+            parcelas = indice_parcelas.asignar(
+                [metadatos[clave]['gps_lat'] for clave in con_gps],
+                [metadatos[clave]['gps_lon'] for clave in con_gps]
+            )
+            for clave, parcela in zip(con_gps, parcelas):
+                metadatos[clave]['parcela'] = parcela
+    
+    return [hashes[id_archivo(file)] for file in uploaded_files]
 
 # Función para mostrar resultados
 def mostrar_resultados(resultado, nombre_archivo, mostrar_imagenes=False):
@@ -413,6 +493,15 @@ def mostrar_resultados(resultado, nombre_archivo, mostrar_imagenes=False):
         with col_shadow:
             st.metric("Sombra detectada", f"{resultado['shadow_percentage']:.1f}%")
         
+        estimacion = resultado.get('estimacion')
+        if estimacion and estimacion.get('intervalo_luz'):
+            inferior, superior = estimacion['intervalo_luz']
+            st.caption(
+                f"⚡ Vista previa: luz entre {inferior:.1f}% y {superior:.1f}% "
+                f"(±{estimacion['margen_error']:.2f} puntos, confianza {estimacion['confianza']:.0%}); "
+                f"se clasificó el {estimacion['fraccion_clasificada']:.1%} de los píxeles"
+            )
+        
         st.info(f"📁 Archivo: {nombre_archivo}")
 
 # Sidebar
@@ -446,19 +535,9 @@ if page == "Analizar Imágenes":
     with col2:
         # Filtrar fundos por empresa seleccionada
         if empresa:
-            # Obtener todos los datos de la hoja (con cache)
-            all_data = load_sheet_data()
-            
-            # Filtrar fundos por empresa
-            filtered_fundos = []
-            if all_data:
-                for row in all_data[1:]:  # Saltar header
-                    if len(row) > 1 and row[1] == empresa:  # Columna B (índice 1)
-                        if len(row) > 3 and row[3]:  # Columna D (índice 3)
-                            filtered_fundos.append(row[3])
-            
-            # Eliminar duplicados y ordenar
-            filtered_fundos = sorted(list(set(filtered_fundos)))
+            # Fundos de la empresa (búsqueda en el índice de Data-campo)
+            indice = obtener_indice_campo()
+            filtered_fundos = indice.fundos(empresa) if indice else []
             
             if filtered_fundos:
                 fundo = st.selectbox("Fundo *", [""] + filtered_fundos, index=0)
@@ -471,19 +550,9 @@ if page == "Analizar Imágenes":
     with col3:
         # Filtrar sectores por fundo seleccionado
         if fundo:
-            # Obtener todos los datos de la hoja (con cache)
-            all_data = load_sheet_data()
-            
-            # Filtrar sectores por fundo
-            filtered_sectores = []
-            if all_data:
-                for row in all_data[1:]:  # Saltar header
-                    if len(row) > 3 and row[3] == fundo:  # Columna D (índice 3)
-                        if len(row) > 6 and row[6]:  # Columna G (índice 6)
-                            filtered_sectores.append(row[6])
-            
-            # Eliminar duplicados y ordenar
-            filtered_sectores = sorted(list(set(filtered_sectores)))
+            # Sectores del fundo (búsqueda en el índice de Data-campo)
+            indice = obtener_indice_campo()
+            filtered_sectores = indice.sectores(fundo) if indice else []
             
             if filtered_sectores:
                 sector = st.selectbox("Sector *", [""] + filtered_sectores, index=0)
@@ -496,19 +565,9 @@ if page == "Analizar Imágenes":
     with col4:
         # Filtrar lotes por sector seleccionado
         if sector:
-            # Obtener todos los datos de la hoja (con cache)
-            all_data = load_sheet_data()
-            
-            # Filtrar lotes por sector
-            filtered_lotes = []
-            if all_data:
-                for row in all_data[1:]:  # Saltar header
-                    if len(row) > 6 and row[6] == sector:  # Columna G (índice 6)
-                        if len(row) > 8 and row[8]:  # Columna I (índice 8)
-                            filtered_lotes.append(row[8])
-            
-            # Eliminar duplicados y ordenar
-            filtered_lotes = sorted(list(set(filtered_lotes)))
+            # Lotes del sector (búsqueda en el índice de Data-campo)
+            indice = obtener_indice_campo()
+            filtered_lotes = indice.lotes(sector) if indice else []
             
             if filtered_lotes:
                 lote = st.selectbox("Lote *", [""] + filtered_lotes, index=0)
@@ -546,34 +605,30 @@ if page == "Analizar Imágenes":
         st.markdown("---")
         st.subheader("📸 Imágenes Subidas")
         
+        # Metadatos de todos los archivos (solo se leen los que no se habían visto)
+        claves_archivos = preescanear_archivos(uploaded_files)
+        metadatos_archivos = st.session_state['metadatos_archivos']
+        
+        # Claves de los widgets por contenido: no se mezclan al quitar o reordenar archivos
+        claves_widgets = []
+        for clave in claves_archivos:
+            repetidos = sum(1 for k in claves_widgets if k.startswith(clave[:16]))
+            claves_widgets.append(f"{clave[:16]}_{repetidos}")
+        
         # Mostrar cada imagen en una fila compacta
         for i, file in enumerate(uploaded_files):
+            datos_archivo = metadatos_archivos[claves_archivos[i]]
+            k = claves_widgets[i]
             # Container compacto para cada imagen
             with st.container():
-                # Extraer información del nombre del archivo si no está ya guardada
-                if f"hilera_{i}" not in st.session_state or f"n_planta_{i}" not in st.session_state:
-                    extracted_hilera, extracted_planta = extract_info_from_filename(file.name)
-                    if extracted_hilera and extracted_planta:
-                        st.session_state[f"hilera_{i}"] = extracted_hilera
-                        st.session_state[f"n_planta_{i}"] = extracted_planta
-                
-                # Detectar GPS si no está ya guardado
-                if f"gps_detected_{i}" not in st.session_state:
-                    try:
-                        # Leer imagen para detectar GPS
-                        file.seek(0)  # Resetear posición del archivo
-                        image_bytes = file.read()
-                        file.seek(0)  # Resetear para uso posterior
-                        
-                        lat, lon = extract_gps_info(image_bytes)
-                        st.session_state[f"gps_detected_{i}"] = lat is not None and lon is not None
-                        if lat and lon:
-                            st.session_state[f"gps_lat_{i}"] = lat
-                            st.session_state[f"gps_lon_{i}"] = lon
-                    except Exception as e:
-                        # Si hay error, asumir sin GPS
-                        st.session_state[f"gps_detected_{i}"] = False
-                        print(f"⚠️ Error detectando GPS para {file.name}: {str(e)}")
+                # Valores iniciales de hilera/planta: nombre del archivo y, si falta la hilera, su parcela por GPS
+                if f"hilera_{k}" not in st.session_state or f"n_planta_{k}" not in st.session_state:
+                    if datos_archivo['hilera'] and datos_archivo['n_planta']:
+                        st.session_state[f"hilera_{k}"] = datos_archivo['hilera']
+                        st.session_state[f"n_planta_{k}"] = datos_archivo['n_planta']
+                    parcela = datos_archivo['parcela']
+                    if parcela and parcela['hilera'] and not st.session_state.get(f"hilera_{k}"):
+                        st.session_state[f"hilera_{k}"] = parcela['hilera']
                 
                 # Todo en una sola fila: nombre, GPS status, botón ver, hilera, planta
                 col1, col2, col3, col4, col5 = st.columns([3, 1, 1, 2, 2])
@@ -583,21 +638,21 @@ if page == "Analizar Imágenes":
                 
                 with col2:
                     # Mostrar estado GPS
-                    if st.session_state.get(f"gps_detected_{i}", False):
+                    if datos_archivo['gps_detected']:
                         st.markdown('<span style="color: green; font-size: 0.8em;">📍 GPS</span>', unsafe_allow_html=True)
                     else:
                         st.markdown('<span style="color: red; font-size: 0.8em;">❌ Sin GPS</span>', unsafe_allow_html=True)
                 
                 with col3:
-                    if st.button("👁️ Ver", key=f"view_{i}"):
-                        st.session_state[f"show_image_{i}"] = True
+                    if st.button("👁️ Ver", key=f"view_{k}"):
+                        st.session_state[f"show_image_{k}"] = True
                 
                 with col4:
                     # Campos condicionales basados en GPS
-                    gps_detected = st.session_state.get(f"gps_detected_{i}", False)
+                    gps_detected = datos_archivo['gps_detected']
                     hilera = st.text_input(
                         "Hilera", 
-                        key=f"hilera_{i}",
+                        key=f"hilera_{k}",
                         placeholder="Ej: 114",
                         disabled=gps_detected
                     )
@@ -605,18 +660,18 @@ if page == "Analizar Imágenes":
                 with col5:
                     n_planta = st.text_input(
                         "N° Planta", 
-                        key=f"n_planta_{i}",
+                        key=f"n_planta_{k}",
                         placeholder="Ej: 22",
                         disabled=gps_detected
                     )
             
             # Mostrar imagen en modal si se presiona Ver
-            if st.session_state.get(f"show_image_{i}", False):
+            if st.session_state.get(f"show_image_{k}", False):
                 with st.expander(f"👁️ Vista: {file.name}", expanded=True):
                     # Imagen más pequeña (1/3 del tamaño)
                     st.image(file, caption=f"Vista completa: {file.name}", width=300)
-                    if st.button("❌ Cerrar", key=f"close_view_{i}"):
-                        st.session_state[f"show_image_{i}"] = False
+                    if st.button("❌ Cerrar", key=f"close_view_{k}"):
+                        st.session_state[f"show_image_{k}"] = False
                         st.rerun()
             
             
@@ -638,75 +693,78 @@ if page == "Analizar Imágenes":
             **Empresa:** {empresa} | **Fundo:** {fundo} | **Sector:** {sector} | **Lote:** {lote}
             """)
             
-            # Procesar cada imagen
-            for i, uploaded_file in enumerate(uploaded_files):
+            # Analizar todas las imágenes en un solo lote
+            with st.spinner(f"🔍 Analizando {len(uploaded_files)} imágenes..."):
+                resultados = analizar_lote_ml([f.getvalue() for f in uploaded_files])
+            
+            # Mostrar resultados y preparar registros
+            records = []
+            for i, (uploaded_file, resultado) in enumerate(zip(uploaded_files, resultados)):
                 # Obtener información específica de esta imagen
-                hilera_info = st.session_state.get(f"hilera_{i}", "")
-                n_planta_info = st.session_state.get(f"n_planta_{i}", "")
-                
-                # Leer imagen
-                image_bytes = uploaded_file.read()
-                
-                # Analizar imagen
-                resultado = analizar_imagen_ml(image_bytes)
+                datos_archivo = metadatos_archivos[claves_archivos[i]]
+                hilera_info = st.session_state.get(f"hilera_{claves_widgets[i]}", "")
+                n_planta_info = st.session_state.get(f"n_planta_{claves_widgets[i]}", "")
                 
                 if resultado:
                     mostrar_resultados(resultado, uploaded_file.name)
                     
-                    # Guardar en Google Sheets
-                    try:
-                        import sys
-                        import os
-                        sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
-                        
-                        from google_sheets.sheets_client import GoogleSheetsClient
-                        
-                        client = GoogleSheetsClient()
+                    # Obtener coordenadas GPS si están disponibles
+                    gps_lat = datos_archivo['gps_lat']
+                    gps_lon = datos_archivo['gps_lon']
+                    
+                    records.append({
+                        'id': '',  # Se generará automáticamente
+                        'fecha': datetime.now().strftime('%Y-%m-%d'),
+                        'hora': datetime.now().strftime('%H:%M:%S'),
+                        'imagen': uploaded_file.name,
+                        'empresa': empresa,
+                        'fundo': fundo,
+                        'sector': sector,
+                        'lote': lote,
+                        'hilera': hilera_info if hilera_info else '',
+                        'numero_planta': n_planta_info if n_planta_info else '',
+                        'latitud': gps_lat if gps_lat else '',
+                        'longitud': gps_lon if gps_lon else '',
+                        'porcentaje_luz': float(resultado['light_percentage']),  # Convertir a float
+                        'porcentaje_sombra': float(resultado['shadow_percentage']),  # Convertir a float
+                        'dispositivo': '{}',
+                        'software': 'Streamlit App',
+                        'direccion': 'None',
+                        'timestamp': datetime.now().isoformat()
+                    })
+                else:
+                    st.warning(f"⚠️ No se pudo analizar {uploaded_file.name}")
+            
+            # Guardar todos los resultados en Google Sheets con una sola escritura
+            if records:
+                try:
+                    import sys
+                    import os
+                    sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+                    
+                    from google_sheets.sheets_client import GoogleSheetsClient
+                    
+                    client = GoogleSheetsClient()
+                    
+                    # Verificar autenticación
+                    if not client.authenticate():
+                        st.error("❌ Error de autenticación con Google Sheets")
+                        print("❌ Error de autenticación")
+                    else:
+                        print(f"🔄 Intentando guardar {len(records)} registros en Google Sheets...")
                         
-                        # Verificar autenticación
-                        if not client.authenticate():
-                            st.error("❌ Error de autenticación con Google Sheets")
-                            print("❌ Error de autenticación")
+                        if client.add_processing_records(client.spreadsheet_id, records, 'Data-app'):
+                            st.success(f"✅ {len(records)} resultados guardados en Google Sheets")
+                            print("✅ Guardado exitoso")
+                            espejo = obtener_espejo_historial()
+                            if espejo is not None:
+                                espejo.avisar()  # Traer las filas nuevas al historial local
                         else:
-                            # Preparar datos para guardar
-                            # Obtener coordenadas GPS si están disponibles
-                            gps_lat = st.session_state.get(f"gps_lat_{i}", "")
-                            gps_lon = st.session_state.get(f"gps_lon_{i}", "")
-                            
-                            record_data = {
-                                'id': '',  # Se generará automáticamente
-                                'fecha': datetime.now().strftime('%Y-%m-%d'),
-                                'hora': datetime.now().strftime('%H:%M:%S'),
-                                'imagen': uploaded_file.name,
-                                'empresa': empresa,
-                                'fundo': fundo,
-                                'sector': sector,
-                                'lote': lote,
-                                'hilera': hilera_info if hilera_info else '',
-                                'numero_planta': n_planta_info if n_planta_info else '',
-                                'latitud': gps_lat if gps_lat else '',
-                                'longitud': gps_lon if gps_lon else '',
-                                'porcentaje_luz': float(resultado['light_percentage']),  # Convertir a float
-                                'porcentaje_sombra': float(resultado['shadow_percentage']),  # Convertir a float
-                                'dispositivo': '{}',
-                                'software': 'Streamlit App',
-                                'direccion': 'None',
-                                'timestamp': datetime.now().isoformat()
-                            }
-                            
-                            # Guardar en Google Sheets
-                            print(f"🔄 Intentando guardar en Google Sheets...")
-                            print(f"📋 Datos: {record_data}")
-                            
-                            if client.add_processing_record(client.spreadsheet_id, record_data, 'Data-app'):
-                                st.success("✅ Resultados guardados en Google Sheets")
-                                print("✅ Guardado exitoso")
-                            else:
-                                st.warning("⚠️ Error guardando en Google Sheets")
-                                print("❌ Error en el guardado")
-                            
-                    except Exception as e:
-                        st.error(f"❌ Error guardando resultados: {str(e)}")
+                            st.warning("⚠️ Error guardando en Google Sheets")
+                            print("❌ Error en el guardado")
+                        
+                except Exception as e:
+                    st.error(f"❌ Error guardando resultados: {str(e)}")
 
 elif page == "Probar Modelo":
     st.markdown('<h1 class="main-header">🧪 Probar Modelo</h1>', unsafe_allow_html=True)
@@ -718,12 +776,25 @@ elif page == "Probar Modelo":
         help="Sube una imagen para probar el modelo de análisis"
     )
     
+    col_preview, col_refinar = st.columns(2)
+    with col_preview:
+        modo_preview = st.checkbox(
+            "⚡ Vista previa rápida",
+            help="Clasifica solo una muestra de píxeles; muestra el margen de error de los porcentajes"
+        )
+    with col_refinar:
+        refinar_preview = st.checkbox(
+            "🔍 Refinar bordes luz/sombra",
+            disabled=not modo_preview,
+            help="Clasifica a resolución completa las zonas con mezcla de clases"
+        )
+    
     if uploaded_file:
         # Leer imagen
         image_bytes = uploaded_file.read()
         
         # Analizar imagen
-        resultado = analizar_imagen_ml(image_bytes)
+        resultado = analizar_imagen_ml(image_bytes, preview=modo_preview, refinar=refinar_preview)
         
         if resultado:
             mostrar_resultados(resultado, uploaded_file.name, mostrar_imagenes=True)
@@ -735,7 +806,7 @@ elif page == "Probar Modelo":
             - 🟡 **Amarillo**: Áreas de luz
             - ⚫ **Gris oscuro**: Áreas de sombra
             
-            **Método:** Random Forest (scikit-learn) con modelo perfeccionado
+            **Método:** HistGradientBoosting (scikit-learn) con modelo perfeccionado
             """)
 
 elif page == "Historial":
@@ -745,29 +816,10 @@ elif page == "Historial":
     st.subheader("📋 Resultados")
     
     try:
-        # Cargar datos reales de Google Sheets
-        import sys
-        import os
-        sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
-        
-        from google_sheets.sheets_client import GoogleSheetsClient
-        
-        client = GoogleSheetsClient()
-        if client.spreadsheet_id:
-            if client.authenticate():
-                # Cargar configuración para obtener el nombre de la hoja
-                import json
-                try:
-                    with open('google_sheets_config.json', 'r') as f:
-                        config = json.load(f)
-                        sheet_name = config.get('sheet_name', 'Data-app')
-                except:
-                    sheet_name = 'Data-app'
-                
-                records = client.get_processing_records(client.spreadsheet_id, limit=50, sheet_name=sheet_name)
-            else:
-                st.error("❌ Error de autenticación con Google Sheets")
-                records = []
+        # Cargar datos reales desde el espejo local de Google Sheets
+        espejo = obtener_espejo_historial()
+        if espejo is not None:
+            records = espejo.obtener_registros(limit=50)
         else:
             st.error("❌ No se pudo cargar el ID de la hoja de cálculo")
             records = []